@@ -0,0 +1,211 @@
+import csv
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from .exposure import COLOR_CHANNELS, compute_sampled_exposure_histograms
+from .file_structure import iso_datetime_for_filename
+from .open import RAW_BIT_DEPTH, as_raw_bayer
+
+AutoExposureBounds = namedtuple(
+    "AutoExposureBounds",
+    [
+        "min_exposure_time",  # shortest exposure time auto-exposure may use, seconds
+        "max_exposure_time",  # longest exposure time auto-exposure may use, seconds
+        "min_iso",  # lowest ISO auto-exposure may use
+        "max_iso",  # highest ISO auto-exposure may use
+    ],
+)
+
+# Behavior for exposure times >6s is undefined (see --exposure-time)
+DEFAULT_AUTO_EXPOSURE_BOUNDS = AutoExposureBounds(
+    min_exposure_time=0.0001, max_exposure_time=6, min_iso=100, max_iso=800
+)
+
+# Aim for the brightest pixels (this percentile of each color channel's raw values) to sit at this fraction of full
+# scale: bright enough to use most of the sensor's range, with headroom for things to get a bit brighter
+HIGHLIGHT_PERCENTILE = 99
+TARGET_HIGHLIGHT_LEVEL = 0.8
+# Leave settings alone while the highlight level is within this factor of the target, so that noise from frame to
+# frame doesn't cause a new adjustment every interval
+ADJUSTMENT_DEADBAND = 1.25
+# Change the total exposure (exposure time x ISO) by at most this factor per interval. Also the factor used when the
+# highlights are saturated, since there's then no telling how far over they are
+MAX_ADJUSTMENT = 4
+
+# Raw values from the V2 camera's IMX219 sensor sit on top of this black level, so brightness is proportional to
+# exposure above it
+RAW_BLACK_LEVEL = 64
+# Largest value in each exposure histogram: green histograms count sums of two green sites
+_FULL_SCALE_VALUES = {
+    "r": RAW_BIT_DEPTH - 1,
+    "g": 2 * (RAW_BIT_DEPTH - 1),
+    "b": RAW_BIT_DEPTH - 1,
+}
+_BLACK_LEVELS = {"r": RAW_BLACK_LEVEL, "g": 2 * RAW_BLACK_LEVEL, "b": RAW_BLACK_LEVEL}
+
+AUTO_EXPOSURE_FILENAME_SUFFIX = "_auto_exposure.log"
+AUTO_EXPOSURE_FIELDS = [
+    "adjusted_at",
+    "variant_index",
+    "image_filename",  # the image whose statistics triggered the adjustment
+    "highlight_level",
+    "previous_exposure_time",
+    "previous_iso",
+    "exposure_time",
+    "iso",
+]
+
+
+def get_highlight_level(histograms):
+    """ The HIGHLIGHT_PERCENTILE value of the brightest color channel, as a fraction of the range from black to full
+    scale
+
+    Args:
+        histograms: dictionary of exposure histograms by color (see exposure.compute_exposure_histograms())
+    Returns:
+        highlight level: 1 if the highlights are saturated, 0 (or a little less, with noise) if they're black
+    """
+    highlight_levels = []
+    for color in COLOR_CHANNELS:
+        cumulative_counts = np.cumsum(histograms[color])
+        percentile_value = np.searchsorted(
+            cumulative_counts, cumulative_counts[-1] * HIGHLIGHT_PERCENTILE / 100
+        )
+        highlight_levels.append(
+            (percentile_value - _BLACK_LEVELS[color])
+            / (_FULL_SCALE_VALUES[color] - _BLACK_LEVELS[color])
+        )
+    return float(max(highlight_levels))
+
+
+def get_exposure_adjustment(highlight_level):
+    """ Factor to multiply the total exposure (exposure time x ISO) by to bring the highlight level to the target
+
+    Returns:
+        factor between 1 / MAX_ADJUSTMENT and MAX_ADJUSTMENT, or None if no adjustment is needed
+    """
+    # Saturated highlights could be any amount over
+    if highlight_level >= 1:
+        return 1 / MAX_ADJUSTMENT
+    # Nothing above black: no telling how far under
+    if highlight_level <= 0:
+        return MAX_ADJUSTMENT
+
+    adjustment = TARGET_HIGHLIGHT_LEVEL / highlight_level
+    if 1 / ADJUSTMENT_DEADBAND < adjustment < ADJUSTMENT_DEADBAND:
+        return None
+    return min(max(adjustment, 1 / MAX_ADJUSTMENT), MAX_ADJUSTMENT)
+
+
+def adjust_variant(variant, adjustment, bounds):
+    """ Change a variant's exposure time and ISO to multiply its total exposure by `adjustment`, within bounds.
+    Exposure time is changed in preference to ISO, since higher ISOs are noisier.
+
+    Args:
+        variant: ExperimentVariant to adjust
+        adjustment: factor to multiply the total exposure by
+        bounds: AutoExposureBounds
+    Returns:
+        adjusted ExperimentVariant
+    """
+    total_exposure = variant.exposure_time * variant.iso * adjustment
+
+    exposure_time = min(
+        max(total_exposure / bounds.min_iso, bounds.min_exposure_time),
+        bounds.max_exposure_time,
+    )
+    iso = min(max(total_exposure / exposure_time, bounds.min_iso), bounds.max_iso)
+
+    return variant._replace(exposure_time=round(exposure_time, 6), iso=round(iso))
+
+
+def get_auto_exposure_filepath(experiment_directory_path, start_date):
+    iso_ish_datetime = iso_datetime_for_filename(start_date)
+    return os.path.join(
+        experiment_directory_path, f"{iso_ish_datetime}{AUTO_EXPOSURE_FILENAME_SUFFIX}"
+    )
+
+
+class AutoExposure:
+    """ Closed-loop auto-exposure for the variants of an experiment.
+
+    After each capture cycle, the exposure statistics of each variant's latest image decide its exposure time and ISO
+    for the next cycle. Every adjustment is appended to an auto-exposure log file in the experiment directory (and
+    each image's filename and capture timing row carry the settings it was actually captured with), so the data can
+    be reproduced.
+    """
+
+    def __init__(self, variants, bounds, log_filepath):
+        """
+        Args:
+            variants: the experiment's ExperimentVariants, as configured
+            bounds: AutoExposureBounds to keep adjustments within
+            log_filepath: path of the auto-exposure log file, from get_auto_exposure_filepath()
+        """
+        self.variants = list(variants)
+        self.bounds = bounds
+        self.log_filepath = log_filepath
+
+    def update(self, variant_index, image_filepath):
+        """ Adjust a variant's settings for the next cycle based on the image it just captured
+
+        Args:
+            variant_index: index of the variant in the experiment's variants
+            image_filepath: full path of the image just captured with self.variants[variant_index]
+        Returns:
+            None
+        """
+        try:
+            # Runs between captures: a sample of the image's rows is plenty to place its highlights
+            histograms = compute_sampled_exposure_histograms(
+                as_raw_bayer(image_filepath)
+            )
+        except (OSError, ValueError) as e:
+            logging.warning(
+                f"Auto-exposure couldn't read {image_filepath} ({e}); keeping its settings"
+            )
+            return
+
+        highlight_level = get_highlight_level(histograms)
+        adjustment = get_exposure_adjustment(highlight_level)
+        if adjustment is None:
+            return
+
+        previous_variant = self.variants[variant_index]
+        variant = adjust_variant(previous_variant, adjustment, self.bounds)
+        if variant == previous_variant:
+            # Already as far as the bounds allow
+            return
+
+        self.variants[variant_index] = variant
+        logging.info(
+            f"Auto-exposure: variant {variant_index} highlight level {highlight_level:.3f}; "
+            f"exposure time {previous_variant.exposure_time}s -> {variant.exposure_time}s, "
+            f"ISO {previous_variant.iso} -> {variant.iso}"
+        )
+        self._record_adjustment(
+            {
+                "adjusted_at": datetime.now().isoformat(),
+                "variant_index": variant_index,
+                "image_filename": os.path.basename(image_filepath),
+                "highlight_level": f"{highlight_level:.4f}",
+                "previous_exposure_time": previous_variant.exposure_time,
+                "previous_iso": previous_variant.iso,
+                "exposure_time": variant.exposure_time,
+                "iso": variant.iso,
+            }
+        )
+
+    def _record_adjustment(self, row):
+        # Opened for append on every row (like the capture timing file) so that nothing is lost if the experiment is
+        # killed
+        is_new_file = not os.path.exists(self.log_filepath)
+        with open(self.log_filepath, "a", newline="") as log_file:
+            writer = csv.DictWriter(log_file, fieldnames=AUTO_EXPOSURE_FIELDS)
+            if is_new_file:
+                writer.writeheader()
+            writer.writerow(row)
@@ -0,0 +1,119 @@
+import csv
+
+import numpy as np
+import pytest
+
+from . import auto_exposure as module
+from .prepare import ExperimentVariant
+
+BOUNDS = module.AutoExposureBounds(
+    min_exposure_time=0.001, max_exposure_time=2, min_iso=100, max_iso=800
+)
+
+
+def _variant_with(exposure_time, iso):
+    return ExperimentVariant(
+        additional_capture_params="",
+        exposure_time=exposure_time,
+        iso=iso,
+        camera_warm_up=5,
+    )
+
+
+def _histograms_at_level(level):
+    """ Exposure histograms with every value at `level` of the range from black to full scale """
+    histograms = {}
+    for color, bin_count in [("r", 1024), ("g", 2048), ("b", 1024)]:
+        black_level = module._BLACK_LEVELS[color]
+        value = round(
+            black_level + level * (module._FULL_SCALE_VALUES[color] - black_level)
+        )
+        histograms[color] = np.bincount([value] * 10, minlength=bin_count)
+    return histograms
+
+
+class TestGetHighlightLevel:
+    @pytest.mark.parametrize("level", [0, 0.5, 1])
+    def test_level(self, level):
+        assert module.get_highlight_level(_histograms_at_level(level)) == pytest.approx(
+            level, abs=0.002
+        )
+
+    def test_brightest_channel(self):
+        histograms = _histograms_at_level(0.2)
+        histograms["b"] = _histograms_at_level(0.6)["b"]
+
+        assert module.get_highlight_level(histograms) == pytest.approx(0.6, abs=0.002)
+
+
+@pytest.mark.parametrize(
+    "highlight_level, expected_adjustment",
+    [
+        (1, 1 / module.MAX_ADJUSTMENT),
+        (0, module.MAX_ADJUSTMENT),
+        (0.01, module.MAX_ADJUSTMENT),
+        (0.4, 2),
+        (0.7, None),
+        (0.9, None),
+    ],
+)
+def test_get_exposure_adjustment(highlight_level, expected_adjustment):
+    assert module.get_exposure_adjustment(highlight_level) == (
+        expected_adjustment and pytest.approx(expected_adjustment)
+    )
+
+
+@pytest.mark.parametrize(
+    "name, variant, adjustment, expected_variant",
+    [
+        ("exposure time first", _variant_with(0.5, 100), 2, _variant_with(1, 100)),
+        ("then ISO", _variant_with(1, 100), 4, _variant_with(2, 200)),
+        ("ISO back down first", _variant_with(2, 400), 0.25, _variant_with(2, 100)),
+        ("within max bounds", _variant_with(2, 800), 4, _variant_with(2, 800)),
+        (
+            "within min bounds",
+            _variant_with(0.001, 100),
+            0.25,
+            _variant_with(0.001, 100),
+        ),
+    ],
+)
+def test_adjust_variant(name, variant, adjustment, expected_variant):
+    assert module.adjust_variant(variant, adjustment, BOUNDS) == expected_variant
+
+
+class TestAutoExposure:
+    def test_adjusts_variant_and_logs_adjustment(self, mocker, tmp_path):
+        mocker.patch.object(module, "as_raw_bayer")
+        mocker.patch.object(
+            module,
+            "compute_sampled_exposure_histograms",
+            return_value=_histograms_at_level(0.1),
+        )
+        log_filepath = str(tmp_path / "auto_exposure.log")
+        auto_exposure = module.AutoExposure(
+            [_variant_with(0.1, 100), _variant_with(0.5, 100)], BOUNDS, log_filepath
+        )
+
+        auto_exposure.update(1, str(tmp_path / "image.jpeg"))
+
+        assert auto_exposure.variants == [
+            _variant_with(0.1, 100),
+            _variant_with(2, 100),
+        ]
+        with open(log_filepath, newline="") as log_file:
+            (row,) = csv.DictReader(log_file)
+        assert row["variant_index"] == "1"
+        assert row["image_filename"] == "image.jpeg"
+        assert (row["previous_exposure_time"], row["exposure_time"]) == ("0.5", "2.0")
+
+    def test_keeps_settings_if_image_is_missing(self, tmp_path):
+        log_filepath = str(tmp_path / "auto_exposure.log")
+        auto_exposure = module.AutoExposure(
+            [_variant_with(0.1, 100)], BOUNDS, log_filepath
+        )
+
+        auto_exposure.update(0, str(tmp_path / "missing.jpeg"))
+
+        assert auto_exposure.variants == [_variant_with(0.1, 100)]
+        assert not (tmp_path / "auto_exposure.log").exists()
@@ -1,5 +1,11 @@
+import os
 import pkg_resources
 import logging
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
 from subprocess import check_call
 
 # defaults recommended by Pagnutti. These only affect the .jpegs
@@ -9,6 +15,16 @@ DEFAULT_EXPOSURE_TIME = 0.8
 DEFAULT_ISO = 100
 DEFAULT_WARM_UP_TIME = 5
 
+RASPISTILL_COMMAND = "raspistill"
+
+# How long to wait for a triggered frame to show up, on top of the exposure time itself
+SESSION_CAPTURE_TIMEOUT = 10
+SESSION_POLL_INTERVAL = 0.01
+# raspistill numbers each frame of a session: frame0001.jpeg, frame0002.jpeg...
+SESSION_FRAME_PREFIX = "frame"
+
+_CAPTURE_SESSION = None
+
 
 def capture(
     filename,
@@ -64,3 +80,175 @@ def simulate_capture_with_copy(
     command = f'cp "{test_image_path}" "{filename}"'
     logging.info(f"Simulate capture: {command}")
     check_call(command, shell=True)
+
+
+def _get_frame_number(frame_filename):
+    frame_name, _ = os.path.splitext(frame_filename)
+    return int(frame_name.replace(SESSION_FRAME_PREFIX, "", 1))
+
+
+class CaptureSession:
+    """ A long-lived raspistill process that keeps the camera open between captures.
+
+    raspistill is started in keypress mode (`--keypress --timeout 0`), so the camera is initialized and warmed up
+    once and each press of ENTER on its stdin captures one more frame. raspistill writes each frame to a "~" temp
+    file in a scratch directory and renames it when complete; completed frames are moved to the requested filename.
+
+    raspistill can't change exposure or ISO on a running process, so a session is tied to one set of camera
+    settings. See `capture_in_session()` for reusing a session across captures.
+    """
+
+    def __init__(
+        self,
+        exposure_time=DEFAULT_EXPOSURE_TIME,
+        iso=DEFAULT_ISO,
+        warm_up_time=DEFAULT_WARM_UP_TIME,
+        additional_capture_params="",
+        raspistill_command=RASPISTILL_COMMAND,
+    ):
+        self.settings = (exposure_time, iso, warm_up_time, additional_capture_params)
+        self.exposure_time = exposure_time
+        self.warm_up_time = warm_up_time
+        self._scratch_directory = tempfile.mkdtemp(prefix="raspistill_session_")
+
+        exposure_time_microseconds = int(exposure_time * 1e6)
+        self.command = [
+            raspistill_command,
+            "--raw",
+            "-o",
+            os.path.join(self._scratch_directory, f"{SESSION_FRAME_PREFIX}%04d.jpeg"),
+            *shlex.split(AWB_QUALITY_CAPTURE_PARAMS),
+            "-ss",
+            str(exposure_time_microseconds),
+            "-ISO",
+            str(iso),
+            "--timeout",
+            "0",
+            "--keypress",
+            *shlex.split(additional_capture_params),
+        ]
+
+        logging.info(f"Starting raspistill capture session: {' '.join(self.command)}")
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE)
+
+        # Only the first frame of a session needs to wait for the camera to warm up
+        time.sleep(warm_up_time)
+
+    def is_running(self):
+        return self._process.poll() is None
+
+    def _completed_frames(self):
+        """ Filenames of the completed frames in the scratch directory, oldest (lowest frame number) first """
+        # Frames still being written have a "~" suffix
+        return sorted(
+            (
+                filename
+                for filename in os.listdir(self._scratch_directory)
+                if not filename.endswith("~")
+            ),
+            key=_get_frame_number,
+        )
+
+    def _discard_frames(self, frame_filenames):
+        for frame_filename in frame_filenames:
+            logging.warning(
+                f"Discarding stale raspistill session frame {frame_filename}"
+            )
+            os.remove(os.path.join(self._scratch_directory, frame_filename))
+
+    def capture(self, filename):
+        """ Trigger a single frame and move it to `filename` once raspistill has finished writing it
+
+        Args:
+            filename: filename to save an image to
+
+        Returns:
+            None
+        """
+        if not self.is_running():
+            raise subprocess.CalledProcessError(self._process.returncode, self.command)
+
+        # Any frame already here predates this keypress, e.g. that of an earlier capture that timed out but finished
+        # late: it mustn't be mistaken for this capture's frame
+        self._discard_frames(self._completed_frames())
+
+        logging.info(f"Capturing image using raspistill session: {filename}")
+        self._process.stdin.write(b"\n")
+        self._process.stdin.flush()
+
+        timeout = self.exposure_time + SESSION_CAPTURE_TIMEOUT
+        deadline = time.monotonic() + timeout
+        while not self._completed_frames():
+            if not self.is_running():
+                raise subprocess.CalledProcessError(
+                    self._process.returncode, self.command
+                )
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(self.command, timeout)
+            time.sleep(SESSION_POLL_INTERVAL)
+
+        # Normally there is exactly one completed frame here. If a late frame from an earlier keypress finished in the
+        # meantime too, this keypress's frame is the newest
+        *stale_frame_filenames, frame_filename = self._completed_frames()
+        shutil.move(os.path.join(self._scratch_directory, frame_filename), filename)
+        self._discard_frames(stale_frame_filenames)
+
+    def close(self):
+        """ Ask raspistill to exit ("x" + ENTER in keypress mode), killing it if it doesn't go quietly
+        """
+        if self.is_running():
+            try:
+                self._process.stdin.write(b"x\n")
+                self._process.stdin.flush()
+                self._process.wait(timeout=SESSION_CAPTURE_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+
+        shutil.rmtree(self._scratch_directory, ignore_errors=True)
+
+
+def capture_in_session(
+    filename,
+    exposure_time=DEFAULT_EXPOSURE_TIME,
+    iso=DEFAULT_ISO,
+    warm_up_time=DEFAULT_WARM_UP_TIME,
+    additional_capture_params="",
+):
+    """ Capture raw image JPEG+EXIF using a persistent raspistill session. Drop-in replacement for `capture()`.
+
+    The session is kept open between calls and only restarted (paying camera start-up and warm-up again) when the
+    camera settings change. With a single variant, only the very first capture of an experiment waits for warm-up.
+
+    Args:
+        filename: filename to save an image to
+        exposure_time: number of seconds in the exposure
+        iso: the ISO setting
+        warm_up_time: number of seconds to wait for the camera to warm up when (re)starting the session
+        additional_capture_params: Additional parameters to pass to raspistill command
+
+    Returns:
+        None
+    """
+    global _CAPTURE_SESSION
+
+    settings = (exposure_time, iso, warm_up_time, additional_capture_params)
+    if _CAPTURE_SESSION is not None and (
+        _CAPTURE_SESSION.settings != settings or not _CAPTURE_SESSION.is_running()
+    ):
+        end_capture_session()
+
+    if _CAPTURE_SESSION is None:
+        _CAPTURE_SESSION = CaptureSession(*settings)
+
+    _CAPTURE_SESSION.capture(filename)
+
+
+def end_capture_session():
+    """ Close the persistent raspistill session, if there is one, releasing the camera
+    """
+    global _CAPTURE_SESSION
+
+    if _CAPTURE_SESSION is not None:
+        _CAPTURE_SESSION.close()
+        _CAPTURE_SESSION = None
@@ -1,3 +1,7 @@
+import os
+import subprocess
+import sys
+
 import pytest
 from . import camera as module
 
@@ -84,3 +88,131 @@ class TestSimulateCaptureWithCopy:
         )
 
         assert mock_check_call.called
+
+
+FAKE_RASPISTILL_SCRIPT = """#!{python}
+# Minimal stand-in for raspistill in keypress mode: ENTER captures a frame, "x" + ENTER exits
+import os
+import sys
+
+output_pattern = sys.argv[sys.argv.index("-o") + 1]
+frame = 0
+for line in sys.stdin:
+    if line.strip() == "x":
+        break
+    frame += 1
+    filename = output_pattern % frame
+    with open(filename + "~", "w") as temp_file:
+        temp_file.write("frame %d" % frame)
+    os.rename(filename + "~", filename)
+"""
+
+
+@pytest.fixture
+def fake_raspistill(tmp_path):
+    script_path = tmp_path / "fake_raspistill"
+    script_path.write_text(FAKE_RASPISTILL_SCRIPT.format(python=sys.executable))
+    script_path.chmod(0o755)
+    return str(script_path)
+
+
+class TestCaptureSession:
+    def test_captures_multiple_frames_from_one_process(self, fake_raspistill, tmp_path):
+        session = module.CaptureSession(
+            warm_up_time=0, raspistill_command=fake_raspistill
+        )
+
+        session.capture(str(tmp_path / "first.jpeg"))
+        session.capture(str(tmp_path / "second.jpeg"))
+        session.close()
+
+        assert (tmp_path / "first.jpeg").read_text() == "frame 1"
+        assert (tmp_path / "second.jpeg").read_text() == "frame 2"
+
+    def test_discards_frames_from_before_keypress(self, fake_raspistill, tmp_path):
+        session = module.CaptureSession(
+            warm_up_time=0, raspistill_command=fake_raspistill
+        )
+        # e.g. an earlier capture timed out, then its frame showed up late
+        stale_frame_path = os.path.join(session._scratch_directory, "frame0000.jpeg")
+        with open(stale_frame_path, "w") as stale_frame:
+            stale_frame.write("stale frame")
+
+        session.capture(str(tmp_path / "image.jpeg"))
+        session.close()
+
+        assert (tmp_path / "image.jpeg").read_text() == "frame 1"
+        assert not os.path.exists(stale_frame_path)
+
+    def test_completed_frames_sorted_by_frame_number(self, fake_raspistill):
+        session = module.CaptureSession(
+            warm_up_time=0, raspistill_command=fake_raspistill
+        )
+        for frame_filename in ["frame10000.jpeg", "frame0009.jpeg", "frame0010.jpeg~"]:
+            with open(os.path.join(session._scratch_directory, frame_filename), "w"):
+                pass
+
+        completed_frames = session._completed_frames()
+        session.close()
+
+        assert completed_frames == ["frame0009.jpeg", "frame10000.jpeg"]
+
+    def test_builds_keypress_command_with_settings(self, fake_raspistill):
+        session = module.CaptureSession(
+            exposure_time=1 / 3,
+            iso=200,
+            warm_up_time=0,
+            additional_capture_params="--extra 1",
+            raspistill_command=fake_raspistill,
+        )
+        session.close()
+
+        command = " ".join(session.command)
+        assert "-ss 333333 -ISO 200 --timeout 0 --keypress --extra 1" in command
+
+    def test_close_stops_process(self, fake_raspistill):
+        session = module.CaptureSession(
+            warm_up_time=0, raspistill_command=fake_raspistill
+        )
+        session.close()
+
+        assert not session.is_running()
+
+    def test_blows_up_if_raspistill_has_exited(self, tmp_path):
+        session = module.CaptureSession(warm_up_time=0, raspistill_command="false")
+        session._process.wait()
+
+        with pytest.raises(subprocess.CalledProcessError):
+            session.capture(str(tmp_path / "image.jpeg"))
+
+
+class TestCaptureInSession:
+    @pytest.fixture(autouse=True)
+    def mock_capture_session(self, mocker):
+        module._CAPTURE_SESSION = None
+        mock_capture_session = mocker.patch.object(module, "CaptureSession")
+        mock_capture_session.return_value.settings = (0.8, 100, 5, "")
+        mock_capture_session.return_value.is_running.return_value = True
+        yield mock_capture_session
+        module._CAPTURE_SESSION = None
+
+    def test_reuses_session_with_same_settings(self, mock_capture_session):
+        module.capture_in_session("first.jpeg")
+        module.capture_in_session("second.jpeg")
+
+        assert mock_capture_session.call_count == 1
+        assert mock_capture_session.return_value.capture.call_count == 2
+
+    def test_restarts_session_when_settings_change(self, mock_capture_session):
+        module.capture_in_session("first.jpeg")
+        module.capture_in_session("second.jpeg", iso=200)
+
+        assert mock_capture_session.call_count == 2
+        assert mock_capture_session.return_value.close.call_count == 1
+
+    def test_end_capture_session_closes_session(self, mock_capture_session):
+        module.capture_in_session("first.jpeg")
+        module.end_capture_session()
+
+        assert mock_capture_session.return_value.close.call_count == 1
+        assert module._CAPTURE_SESSION is None
@@ -0,0 +1,212 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .file_structure import get_files_with_extension, iso_datetime_for_filename
+
+# Phases of a single capture, in the order they happen. Each is recorded as seconds since the scheduler woke up
+# for the capture cycle ("schedule wake"), so all variants captured in one cycle share the same zero point.
+CAPTURE_PHASES = [
+    "free_space_checked",
+    "command_start",
+    "raspistill_exit",
+    "led_off",
+    "sync_triggered",
+]
+
+VARIANT_FIELDS = ["exposure_time", "iso", "camera_warm_up", "additional_capture_params"]
+
+CAPTURE_TIMING_FIELDS = [
+    "schedule_wake",  # wall-clock time the capture cycle started, for lining up with logs
+    "image_filename",
+    *VARIANT_FIELDS,
+    *CAPTURE_PHASES,
+    "file_size_bytes",
+]
+
+CAPTURE_TIMING_FILENAME_SUFFIX = "_capture_timing.log"
+
+PERCENTILES = [50, 90, 99]
+
+
+class CaptureTiming:
+    """ Collects the time at which each phase of a single capture happens, on the monotonic clock
+    """
+
+    def __init__(self, schedule_wake_time):
+        """
+        Args:
+            schedule_wake_time: `time.monotonic()` at which the capture cycle started
+        """
+        self.schedule_wake_time = schedule_wake_time
+        self.schedule_wake_datetime = datetime.now() - timedelta(
+            seconds=time.monotonic() - schedule_wake_time
+        )
+        self.phase_times = {}
+
+    def mark(self, phase):
+        """ Record that `phase` (one of CAPTURE_PHASES) has just happened """
+        self.phase_times[phase] = time.monotonic()
+
+    def seconds_since_wake(self, phase):
+        phase_time = self.phase_times.get(phase)
+        return None if phase_time is None else phase_time - self.schedule_wake_time
+
+
+def get_capture_timing_filepath(experiment_directory_path, start_date):
+    iso_ish_datetime = iso_datetime_for_filename(start_date)
+    return os.path.join(
+        experiment_directory_path, f"{iso_ish_datetime}{CAPTURE_TIMING_FILENAME_SUFFIX}"
+    )
+
+
+def record_capture_timing(capture_timing_filepath, image_filepath, variant, timing):
+    """ Append one row describing a capture to the capture timing file, creating the file (with header) if necessary.
+
+    The file is CSV, opened for append on every row so that nothing is lost if the experiment is killed. Like the
+    experiment log, it is only synced to s3 at the end of the experiment.
+
+    Args:
+        capture_timing_filepath: path of the capture timing file, from get_capture_timing_filepath()
+        image_filepath: full path to the captured image
+        variant: ExperimentVariant used for the capture
+        timing: CaptureTiming instance for the capture
+    Returns:
+        None
+    """
+    try:
+        file_size_bytes = os.path.getsize(image_filepath)
+    except OSError:
+        file_size_bytes = None
+
+    row = {
+        "schedule_wake": timing.schedule_wake_datetime.isoformat(),
+        "image_filename": os.path.basename(image_filepath),
+        **{field: getattr(variant, field) for field in VARIANT_FIELDS},
+        **{
+            phase: _format_seconds(timing.seconds_since_wake(phase))
+            for phase in CAPTURE_PHASES
+        },
+        "file_size_bytes": file_size_bytes,
+    }
+
+    is_new_file = not os.path.exists(capture_timing_filepath)
+    with open(capture_timing_filepath, "a", newline="") as capture_timing_file:
+        writer = csv.DictWriter(capture_timing_file, fieldnames=CAPTURE_TIMING_FIELDS)
+        if is_new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def _format_seconds(seconds):
+    return None if seconds is None else f"{seconds:.4f}"
+
+
+def _read_capture_timing_rows(directory):
+    rows = []
+    for capture_timing_filepath in get_files_with_extension(directory, ".log"):
+        if not capture_timing_filepath.endswith(CAPTURE_TIMING_FILENAME_SUFFIX):
+            continue
+        with open(capture_timing_filepath, newline="") as capture_timing_file:
+            rows.extend(csv.DictReader(capture_timing_file))
+    return rows
+
+
+def _phase_durations(row):
+    """ Seconds spent in each step between consecutive phases (and from wake to the first phase), keyed by the
+    phase the step ends at. Steps with a missing end point are omitted.
+    """
+    durations = {}
+    previous_seconds = 0.0
+    for phase in CAPTURE_PHASES:
+        if not row[phase]:
+            continue
+        seconds = float(row[phase])
+        durations[phase] = seconds - previous_seconds
+        previous_seconds = seconds
+    durations["total"] = previous_seconds
+    return durations
+
+
+def summarize_capture_timing_rows(rows):
+    """ Summarize capture timing rows into latency percentiles per variant
+
+    Args:
+        rows: iterable of dicts as read from a capture timing file
+    Returns:
+        dict of {variant description: {step: {"p50": seconds, "p90": ..., "p99": ..., "max": ..., "count": n}}}
+        where each step is named after the phase it ends at, plus "total" (wake to last phase) and "file_size_bytes"
+    """
+    samples_by_variant = defaultdict(lambda: defaultdict(list))
+    for row in rows:
+        variant_description = " ".join(
+            f"{field}={row[field]}" for field in VARIANT_FIELDS
+        )
+        samples = samples_by_variant[variant_description]
+        for step, seconds in _phase_durations(row).items():
+            samples[step].append(seconds)
+        if row["file_size_bytes"]:
+            samples["file_size_bytes"].append(int(row["file_size_bytes"]))
+
+    return {
+        variant_description: {
+            step: {
+                **{
+                    f"p{percentile}": float(np.percentile(values, percentile))
+                    for percentile in PERCENTILES
+                },
+                "max": float(np.max(values)),
+                "count": len(values),
+            }
+            for step, values in samples.items()
+        }
+        for variant_description, samples in samples_by_variant.items()
+    }
+
+
+def summarize_capture_timing(cli_args=None):
+    """ Print latency percentiles for each capture phase, per variant, from the capture timing files in a directory
+     Args:
+        cli_args: list of command-line-like argument strings such as sys.argv. if not provided, sys.argv[1:] is used
+     Returns:
+        None
+    """
+    if cli_args is None:
+        # First argument is the name of the command itself, not an "argument" we want to parse
+        cli_args = sys.argv[1:]
+
+    arg_parser = argparse.ArgumentParser(
+        description="Summarize capture phase latencies recorded during an experiment"
+    )
+    arg_parser.add_argument(
+        "--directory",
+        required=True,
+        type=str,
+        help="experiment directory containing *_capture_timing.log files",
+    )
+    args = arg_parser.parse_args(cli_args)
+
+    summary = summarize_capture_timing_rows(_read_capture_timing_rows(args.directory))
+
+    for variant_description, steps in summary.items():
+        print(variant_description)
+        print(
+            f"  {'step':<20}"
+            + "".join(f"{f'p{percentile}':>12}" for percentile in PERCENTILES)
+            + f"{'max':>12}{'count':>8}"
+        )
+        for step, statistics in steps.items():
+            print(
+                f"  {step:<20}"
+                + "".join(
+                    f"{statistics[f'p{percentile}']:>12.4f}"
+                    for percentile in PERCENTILES
+                )
+                + f"{statistics['max']:>12.4f}{statistics['count']:>8}"
+            )
@@ -0,0 +1,111 @@
+import csv
+
+import pytest
+
+from .prepare import ExperimentVariant
+from . import capture_timing as module
+
+
+VARIANT = ExperimentVariant(
+    additional_capture_params="", exposure_time=0.8, iso=100, camera_warm_up=5
+)
+
+
+@pytest.fixture
+def mock_monotonic(mocker):
+    return mocker.patch.object(module.time, "monotonic")
+
+
+def _timing_with_phases(mock_monotonic, seconds_by_phase):
+    mock_monotonic.return_value = 100
+    timing = module.CaptureTiming(schedule_wake_time=100)
+    for phase, seconds in seconds_by_phase.items():
+        mock_monotonic.return_value = 100 + seconds
+        timing.mark(phase)
+    return timing
+
+
+class TestRecordCaptureTiming:
+    def test_appends_rows_with_header_once(self, tmp_path, mock_monotonic):
+        capture_timing_filepath = str(tmp_path / "timing_capture_timing.log")
+        image_filepath = tmp_path / "image.jpeg"
+        image_filepath.write_bytes(b"12345")
+        timing = _timing_with_phases(
+            mock_monotonic, {"free_space_checked": 0.01, "command_start": 0.02}
+        )
+
+        module.record_capture_timing(
+            capture_timing_filepath, str(image_filepath), VARIANT, timing
+        )
+        module.record_capture_timing(
+            capture_timing_filepath, str(image_filepath), VARIANT, timing
+        )
+
+        with open(capture_timing_filepath) as capture_timing_file:
+            rows = list(csv.DictReader(capture_timing_file))
+
+        assert len(rows) == 2
+        assert rows[0]["image_filename"] == "image.jpeg"
+        assert rows[0]["iso"] == "100"
+        assert rows[0]["command_start"] == "0.0200"
+        assert rows[0]["led_off"] == ""
+        assert rows[0]["file_size_bytes"] == "5"
+
+    def test_missing_image_has_no_file_size(self, tmp_path, mock_monotonic):
+        capture_timing_filepath = str(tmp_path / "timing_capture_timing.log")
+        timing = _timing_with_phases(mock_monotonic, {})
+
+        module.record_capture_timing(
+            capture_timing_filepath, str(tmp_path / "nope.jpeg"), VARIANT, timing
+        )
+
+        with open(capture_timing_filepath) as capture_timing_file:
+            (row,) = csv.DictReader(capture_timing_file)
+        assert row["file_size_bytes"] == ""
+
+
+class TestSummarizeCaptureTimingRows:
+    def test_percentiles_of_steps_between_phases(self):
+        rows = [
+            {
+                "exposure_time": "0.8",
+                "iso": "100",
+                "camera_warm_up": "5",
+                "additional_capture_params": "",
+                "free_space_checked": "0.1",
+                "command_start": "0.2",
+                "raspistill_exit": str(6.2 + index),
+                "led_off": str(6.3 + index),
+                "sync_triggered": str(6.4 + index),
+                "file_size_bytes": "1000",
+            }
+            for index in range(3)
+        ]
+
+        summary = module.summarize_capture_timing_rows(rows)
+
+        (variant_summary,) = summary.values()
+        assert variant_summary["raspistill_exit"]["p50"] == pytest.approx(7)
+        assert variant_summary["raspistill_exit"]["max"] == pytest.approx(8)
+        assert variant_summary["led_off"]["p99"] == pytest.approx(0.1)
+        assert variant_summary["total"]["count"] == 3
+        assert variant_summary["file_size_bytes"]["p90"] == 1000
+
+
+class TestSummarizeCaptureTiming:
+    def test_prints_summary_for_directory(self, tmp_path, mock_monotonic, capsys):
+        capture_timing_filepath = module.get_capture_timing_filepath(
+            str(tmp_path), module.datetime(2019, 1, 1)
+        )
+        timing = _timing_with_phases(
+            mock_monotonic, {phase: 0.1 for phase in module.CAPTURE_PHASES}
+        )
+        module.record_capture_timing(
+            capture_timing_filepath, "image.jpeg", VARIANT, timing
+        )
+
+        module.summarize_capture_timing(["--directory", str(tmp_path)])
+
+        output = capsys.readouterr().out
+        assert "iso=100" in output
+        assert "raspistill_exit" in output
@@ -0,0 +1,31 @@
+from urllib.request import urlopen
+
+import pytest
+
+from .s3 import CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME
+from .s3_uploader import S3_ENDPOINT_ENVIRONMENT_VARIABLE, connect_to_s3
+
+
+@pytest.fixture
+def s3_stand_in(monkeypatch):
+    """ Run a local S3 stand-in server (moto) with an empty experiments bucket, and point our S3 connections at it
+
+    Returns:
+        boto Bucket for the experiments bucket on the stand-in server
+    """
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f"http://{host}:{port}"
+    # moto keeps its state between server instances, so start each test from an empty slate
+    urlopen(f"{endpoint}/moto-api/reset", data=b"")
+
+    monkeypatch.setenv(S3_ENDPOINT_ENVIRONMENT_VARIABLE, endpoint)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "stand-in")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "stand-in")
+
+    yield connect_to_s3().create_bucket(CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME)
+
+    server.stop()
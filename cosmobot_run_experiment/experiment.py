@@ -4,17 +4,56 @@ import time
 import logging
 import traceback
 
-from cosmobot_run_experiment.file_structure import get_image_filename
-from .camera import capture
-from .file_structure import iso_datetime_for_filename, remove_experiment_directory
+from cosmobot_run_experiment.file_structure import get_image_relative_path
+from .auto_exposure import AutoExposure, get_auto_exposure_filepath
+from .camera import capture, capture_in_session, end_capture_session
+from .capture_timing import (
+    CaptureTiming,
+    get_capture_timing_filepath,
+    record_capture_timing,
+)
+from .file_structure import (
+    get_base_output_path,
+    iso_datetime_for_filename,
+    remove_experiment_directory,
+)
 from .prepare import (
     create_file_structure_for_experiment,
     get_experiment_configuration,
     hostname_is_correct,
+    record_experiment_directory,
+)
+from .staging import (
+    end_staging_mover_process,
+    find_tiered_file,
+    start_staging_mover_in_separate_process,
+)
+from .s3 import CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME
+from .storage import (
+    ImageSizeModel,
+    StorageBudget,
+    end_eviction_process,
+    has_free_space_for,
+    start_evicting_synced_files_in_separate_process,
+)
+from .sync_manager import (
+    WATCH_SYNC,
+    configure_upload_governor,
+    end_resume_process,
+    end_syncing_process,
+    end_watching_process,
+    resume_queued_uploads_in_separate_process,
+    start_watching_directory_in_separate_process,
+    sync_directory_in_separate_process,
+    uploads_paused,
 )
-from .storage import free_space_for_one_image, how_many_images_with_free_space
-from .sync_manager import end_syncing_process, sync_directory_in_separate_process
-from .exposure import review_exposure_statistics
+from .exposure import (
+    end_live_exposure_analysis_process,
+    queue_live_exposure_analysis,
+    review_exposure_statistics,
+    start_live_exposure_analysis_in_separate_process,
+)
+from .scheduler import CaptureScheduler
 from .led_control import control_led
 
 from datetime import datetime, timedelta
@@ -30,20 +69,59 @@ logging.basicConfig(
 )
 
 
-def _end_experiment_if_not_enough_space(configuration):
-    if not free_space_for_one_image():
+def _end_experiment_if_not_enough_space(configuration, storage_budget, image_size):
+    # Images are captured into the staging directory first, so it needs space too. It only runs out if the mover process
+    # has stopped or can't keep up with the experiment
+    staging_directory_path = configuration.staging_directory_path
+    if staging_directory_path and not has_free_space_for(
+        staging_directory_path, image_size
+    ):
         end_experiment(
             configuration,
-            experiment_ended_message="Insufficient space to save the image. Quitting...",
+            experiment_ended_message="Insufficient space in the staging directory to save the image. Quitting...",
             has_errored=True,
         )
 
+    if storage_budget.has_space_for(image_size):
+        return
+
+    # Before giving up, read free space again: other processes (eviction, syncing with erase) may have freed some since
+    # the last reading
+    storage_budget.refresh()
+    if storage_budget.has_space_for(image_size):
+        return
+
+    end_experiment(
+        configuration,
+        experiment_ended_message="Insufficient space to save the image. Quitting...",
+        has_errored=True,
+    )
+
 
-def _get_variant_image_filepath(variant, experiment_directory_path):
+def _log_remaining_capacity(storage_budget, image_size_model, variants, interval):
+    cycle_count = storage_budget.free_bytes() // image_size_model.get_cycle_size(
+        len(variants)
+    )
+    logging.info(
+        "Estimated number of images that can be captured with free space: "
+        f"{int(cycle_count) * len(variants)}"
+    )
+    logging.info(
+        "Estimated runtime with free space (if nothing is erased): "
+        f"{timedelta(seconds=cycle_count * interval)}"
+    )
+
+
+def _get_variant_image_filepath(variant, experiment_directory_path, sharded=False):
     capture_timestamp = datetime.now()
 
-    image_filename = get_image_filename(capture_timestamp, variant)
-    return os.path.join(experiment_directory_path, image_filename)
+    image_relative_path = get_image_relative_path(
+        capture_timestamp, variant, sharded=sharded
+    )
+    image_filepath = os.path.join(experiment_directory_path, image_relative_path)
+    if sharded:
+        os.makedirs(os.path.dirname(image_filepath), exist_ok=True)
+    return image_filepath
 
 
 def perform_experiment(configuration):
@@ -65,59 +143,161 @@ def perform_experiment(configuration):
        and using simulate_capture_with_copy instead of capture.
     """
     duration = configuration.duration
+    capture_image = capture_in_session if configuration.persistent_camera else capture
+    storage_budget = StorageBudget(configuration.experiment_directory_path)
+    image_size_model = ImageSizeModel()
 
     # print out warning that no duration has been set and inform how many
     # estimated images can be stored
     if duration is None:
-        how_many_images_can_be_captured = how_many_images_with_free_space()
         logging.info("No experimental duration provided.")
-        logging.info(
-            "Estimated number of images that can be captured with free space: "
-            f"{how_many_images_can_be_captured}"
+        _log_remaining_capacity(
+            storage_budget,
+            image_size_model,
+            configuration.variants,
+            configuration.interval,
         )
-    # Start capturing immediately
-    first_capture_time = datetime.now()
-    next_capture_time = first_capture_time
+    # Start capturing immediately and continue capturing for set duration or indefinitely
+    scheduler = CaptureScheduler(
+        interval=configuration.interval,
+        duration=duration,
+        overrun_policy=configuration.overrun_policy,
+    )
 
-    # Continue capturing for set duration or indefinitely
-    last_capture_time = (
-        None if duration is None else first_capture_time + timedelta(seconds=duration)
+    capture_timing_filepath = get_capture_timing_filepath(
+        configuration.experiment_directory_path, configuration.start_date
     )
 
-    while last_capture_time is None or datetime.now() < last_capture_time:
-        if datetime.now() < next_capture_time:
-            time.sleep(0.1)  # No need to totally peg the CPU
-            continue
+    watch_sync = not configuration.skip_sync and configuration.sync_mode == WATCH_SYNC
+    periodic_sync = not configuration.skip_sync and not watch_sync
+    if configuration.staging_directory_path:
+        start_staging_mover_in_separate_process(
+            configuration.staging_directory_path,
+            configuration.experiment_directory_path,
+        )
+    if watch_sync:
+        start_watching_directory_in_separate_process(
+            configuration.experiment_directory_path,
+            erase_uploaded_files=configuration.erase_synced_files,
+            staging_directory=configuration.staging_directory_path,
+        )
+    if configuration.evict_synced_files:
+        start_evicting_synced_files_in_separate_process(
+            configuration.experiment_directory_path,
+            CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME,
+        )
+    if configuration.review_exposure:
+        start_live_exposure_analysis_in_separate_process(
+            configuration.experiment_directory_path,
+            staging_directory=configuration.staging_directory_path,
+        )
 
-        # next_capture_time is agnostic to the time needed for capture and writing of image
-        next_capture_time = next_capture_time + timedelta(
-            seconds=configuration.interval
+    auto_exposure = (
+        AutoExposure(
+            configuration.variants,
+            configuration.auto_exposure,
+            get_auto_exposure_filepath(
+                configuration.experiment_directory_path, configuration.start_date
+            ),
         )
+        if configuration.auto_exposure
+        else None
+    )
+    variants = auto_exposure.variants if auto_exposure else configuration.variants
+    # Where a captured image may be by the time it's read back: still staged, or already moved by the staging mover
+    image_directories = [
+        directory
+        for directory in [
+            configuration.staging_directory_path,
+            configuration.experiment_directory_path,
+        ]
+        if directory
+    ]
+
+    for cycle_index, _ in enumerate(scheduler):
+        schedule_wake_time = time.monotonic()
+        captured_image_relative_paths = []
 
         # iterate through each capture variant and capture an image with it's settings
-        for variant in configuration.variants:
-            _end_experiment_if_not_enough_space(configuration)
+        for variant_index, variant in enumerate(variants):
+            capture_timing = CaptureTiming(schedule_wake_time)
+
+            _end_experiment_if_not_enough_space(
+                configuration, storage_budget, image_size_model.get_size(variant_index)
+            )
+            capture_timing.mark("free_space_checked")
 
             experiment_directory_path = configuration.experiment_directory_path
+            capture_directory_path = (
+                configuration.staging_directory_path or experiment_directory_path
+            )
             image_filepath = _get_variant_image_filepath(
-                variant, experiment_directory_path
+                variant, capture_directory_path, sharded=configuration.shard_by_hour
             )
 
-            capture(
-                image_filepath,
-                exposure_time=variant.exposure_time,
-                iso=variant.iso,
-                warm_up_time=variant.camera_warm_up,
-                additional_capture_params=variant.additional_capture_params,
-            )
+            capture_timing.mark("command_start")
+            with uploads_paused():
+                capture_image(
+                    image_filepath,
+                    exposure_time=variant.exposure_time,
+                    iso=variant.iso,
+                    warm_up_time=variant.camera_warm_up,
+                    additional_capture_params=variant.additional_capture_params,
+                )
+            capture_timing.mark("raspistill_exit")
+
+            try:
+                image_size = os.path.getsize(image_filepath)
+            except OSError:
+                # No image to account for; the next poll will catch up with whatever did get written
+                pass
+            else:
+                storage_budget.record_written(image_size)
+                image_size_model.record(variant_index, image_size)
 
             # Doubly ensure the LED is turned off after capture (in case something goes wrong in raspistill land)
             control_led(led_on=False)
+            capture_timing.mark("led_off")
 
             # If a sync is currently occuring, this is a no-op.
-            if not configuration.skip_sync:
-                sync_directory_in_separate_process(experiment_directory_path)
+            if periodic_sync:
+                sync_directory_in_separate_process(
+                    experiment_directory_path,
+                    erase_synced_files=configuration.erase_synced_files,
+                )
+            capture_timing.mark("sync_triggered")
+
+            record_capture_timing(
+                capture_timing_filepath, image_filepath, variant, capture_timing
+            )
+
+            # If live exposure analysis isn't running, this is a no-op. The image is queued by its relative path as the
+            # staging mover may have moved it by the time it's analyzed
+            image_relative_path = os.path.relpath(
+                image_filepath, capture_directory_path
+            )
+            queue_live_exposure_analysis(image_relative_path)
+            captured_image_relative_paths.append(image_relative_path)
+
+        # Adjust settings for the next interval while the scheduler would otherwise be waiting
+        if auto_exposure:
+            for variant_index, image_relative_path in enumerate(
+                captured_image_relative_paths
+            ):
+                auto_exposure.update(
+                    variant_index,
+                    find_tiered_file(image_relative_path, image_directories),
+                )
+
+        # The estimate before the first capture had to assume image sizes: repeat it with sizes learned from the first
+        # cycle
+        if duration is None and cycle_index == 0:
+            _log_remaining_capacity(
+                storage_budget, image_size_model, variants, configuration.interval
+            )
 
+    scheduler.log_summary()
+    logging.info(storage_budget.describe())
     end_experiment(
         configuration,
         experiment_ended_message="Experiment completed successfully!",
@@ -131,7 +311,11 @@ def _perform_final_sync(experiment_directory_path, erase_synced_files):
         remaining images. To that end, we end any existing sync process and start a new one
     """
     logging.info("Beginning final sync to s3 due to end of experiment...")
+    end_resume_process()
+    end_watching_process()
     end_syncing_process()
+    # Nothing left to capture, so there's no reason to hold the final sync back
+    configure_upload_governor()
     sync_directory_in_separate_process(
         experiment_directory_path,
         wait_for_finish=True,
@@ -157,8 +341,14 @@ def end_experiment(experiment_configuration, experiment_ended_message, has_error
     Returns:
         None (exits with 1 if has_errored, otherwise 0)
     """
+    end_capture_session()
     control_led(led_on=False)
     logging.info(experiment_ended_message)
+    # Let live analysis catch up before the final sync, which may erase images out from under it
+    end_live_exposure_analysis_process()
+    # Everything has to be in the experiment directory for the final sync
+    end_staging_mover_process()
+    end_eviction_process()
 
     if not experiment_configuration.skip_sync:
         _perform_final_sync(
@@ -219,6 +409,25 @@ def run_experiment(cli_args=None):
             configuration.experiment_directory_path, configuration.start_date
         )
 
+        if not configuration.skip_sync:
+            try:
+                record_experiment_directory(configuration)
+            except Exception as exception:
+                # Only needed to speed up a later --group-results, so don't let it stop the experiment
+                logging.warning(
+                    f"Couldn't record experiment directory in s3 index: {exception}"
+                )
+
+            configure_upload_governor(
+                bandwidth_limit=configuration.upload_bandwidth_limit,
+                pause_during_capture=configuration.pause_uploads_during_capture,
+            )
+            # Pick up any uploads that earlier runs didn't get to finish
+            resume_queued_uploads_in_separate_process(
+                get_base_output_path(),
+                exclude_directory=configuration.experiment_directory_path,
+            )
+
         try:
             perform_experiment(configuration)
         except KeyboardInterrupt:
@@ -1,10 +1,12 @@
+import os
 from datetime import datetime, timedelta
-from unittest.mock import sentinel
+from unittest.mock import call, sentinel
 
 from freezegun import freeze_time
 import pytest
 
 from .prepare import ExperimentConfiguration, ExperimentVariant
+from .storage import IMAGE_SIZE_IN_BYTES
 from . import experiment as module
 
 
@@ -39,12 +41,11 @@ def mock_set_up_log_file_with_base_handler(mocker):
 
 
 @pytest.fixture
-def mock_free_space_for_one_image(mocker):
-    mock_free_space_for_one_image = mocker.patch.object(
-        module, "free_space_for_one_image"
-    )
-    mock_free_space_for_one_image.return_value = True
-    return mock_free_space_for_one_image
+def mock_storage_budget(mocker):
+    mock_storage_budget = mocker.patch.object(module, "StorageBudget").return_value
+    mock_storage_budget.has_space_for.return_value = True
+    mock_storage_budget.free_bytes.return_value = 1e12
+    return mock_storage_budget
 
 
 MOCK_EXPERIMENT_CONFIGURATION = {
@@ -67,6 +68,15 @@ MOCK_EXPERIMENT_CONFIGURATION = {
     "skip_sync": True,
     "erase_synced_files": False,
     "review_exposure": False,
+    "persistent_camera": False,
+    "overrun_policy": "catch-up",
+    "sync_mode": "periodic",
+    "upload_bandwidth_limit": None,
+    "pause_uploads_during_capture": False,
+    "auto_exposure": None,
+    "staging_directory_path": None,
+    "evict_synced_files": False,
+    "shard_by_hour": False,
 }
 
 
@@ -75,9 +85,12 @@ def _mock_experiment_configuration_with(**kwargs):
 
 
 class TestPerformExperiment:
-    def test_dry_run_duration_roughly_correct(
-        self, mock_capture, mock_free_space_for_one_image
-    ):
+    @pytest.fixture(autouse=True)
+    def mock_record_capture_timing(self, mocker):
+        mocker.patch.object(module, "get_capture_timing_filepath")
+        return mocker.patch.object(module, "record_capture_timing")
+
+    def test_dry_run_duration_roughly_correct(self, mock_capture, mock_storage_budget):
         start_time = datetime.now()
         mock_configuration = _mock_experiment_configuration_with(duration=0.2)
 
@@ -95,7 +108,7 @@ class TestPerformExperiment:
 
     @freeze_time("2019-01-01 12:00:01")
     def test_capture_called_with_correct_params(
-        self, mock_capture, mock_free_space_for_one_image
+        self, mock_capture, mock_storage_budget
     ):
         # With time frozen, force the experiment to end
         mock_capture.side_effect = SystemExit()
@@ -114,9 +127,22 @@ class TestPerformExperiment:
             additional_capture_params="",
         )
 
-    def test_image_count_roughly_correct(
-        self, mock_capture, mock_free_space_for_one_image
+    @freeze_time("2019-01-01 12:00:01")
+    def test_captures_into_shard_directory(
+        self, mocker, mock_capture, mock_storage_budget
     ):
+        mock_makedirs = mocker.patch.object(module.os, "makedirs")
+        mock_capture.side_effect = SystemExit()
+        mock_configuration = _mock_experiment_configuration_with(shard_by_hour=True)
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        expected_directory = "/mock/path/to/2019-01-01/12"
+        assert os.path.dirname(mock_capture.call_args[0][0]) == expected_directory
+        mock_makedirs.assert_called_once_with(expected_directory, exist_ok=True)
+
+    def test_image_count_roughly_correct(self, mock_capture, mock_storage_budget):
         mock_configuration = _mock_experiment_configuration_with(
             duration=0.5, interval=0.2
         )
@@ -127,9 +153,9 @@ class TestPerformExperiment:
         assert mock_capture.call_count == 3
 
     def test_ends_experiment_without_capture_if_no_free_space(
-        self, mock_capture, mock_free_space_for_one_image
+        self, mock_capture, mock_storage_budget
     ):
-        mock_free_space_for_one_image.return_value = False
+        mock_storage_budget.has_space_for.return_value = False
         mock_configuration = _mock_experiment_configuration_with()
 
         with pytest.raises(SystemExit):
@@ -137,6 +163,240 @@ class TestPerformExperiment:
 
         assert mock_capture.call_count == 0
 
+    def test_checks_space_for_learned_image_size(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        mocker.patch.object(module.os.path, "getsize").return_value = 1234
+        mock_configuration = _mock_experiment_configuration_with(
+            duration=0.3, interval=0.2
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        mock_storage_budget.record_written.assert_called_with(1234)
+        assert mock_storage_budget.has_space_for.call_args_list == [
+            call(IMAGE_SIZE_IN_BYTES),
+            call(1234),
+        ]
+
+    def test_evicts_synced_files_in_background(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        mock_start_eviction = mocker.patch.object(
+            module, "start_evicting_synced_files_in_separate_process"
+        )
+        mock_end_eviction = mocker.patch.object(module, "end_eviction_process")
+        mock_configuration = _mock_experiment_configuration_with(
+            evict_synced_files=True
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        mock_start_eviction.assert_called_once_with(
+            "/mock/path/to", module.CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME
+        )
+        mock_end_eviction.assert_called_once_with()
+
+    def test_rereads_free_space_before_ending_experiment(
+        self, mock_capture, mock_storage_budget
+    ):
+        # e.g. the eviction process has freed space since the last reading
+        mock_storage_budget.has_space_for.side_effect = [False, True]
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(_mock_experiment_configuration_with())
+
+        mock_storage_budget.refresh.assert_called_once_with()
+        assert mock_capture.call_count == 1
+
+    def test_ends_experiment_if_still_no_space_after_rereading(
+        self, mock_capture, mock_storage_budget
+    ):
+        mock_storage_budget.has_space_for.return_value = False
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(_mock_experiment_configuration_with())
+
+        mock_storage_budget.refresh.assert_called_once_with()
+        assert mock_capture.call_count == 0
+
+    def test_records_timing_for_each_capture(
+        self, mock_capture, mock_storage_budget, mock_record_capture_timing
+    ):
+        mock_configuration = _mock_experiment_configuration_with(
+            duration=0.5, interval=0.2
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        assert mock_record_capture_timing.call_count == 3
+        capture_timing = mock_record_capture_timing.call_args[0][3]
+        assert list(capture_timing.phase_times) == [
+            "free_space_checked",
+            "command_start",
+            "raspistill_exit",
+            "led_off",
+            "sync_triggered",
+        ]
+
+    def test_captures_with_auto_exposed_variants(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        variant = MOCK_EXPERIMENT_CONFIGURATION["variants"][0]
+        mocker.patch.object(module, "get_auto_exposure_filepath")
+        mock_auto_exposure = mocker.patch.object(module, "AutoExposure").return_value
+        mock_auto_exposure.variants = [variant]
+
+        def double_exposure_time(variant_index, image_filepath):
+            mock_auto_exposure.variants[variant_index] = variant._replace(
+                exposure_time=mock_auto_exposure.variants[variant_index].exposure_time
+                * 2
+            )
+
+        mock_auto_exposure.update.side_effect = double_exposure_time
+        mock_configuration = _mock_experiment_configuration_with(
+            duration=0.5, interval=0.2, auto_exposure=sentinel.auto_exposure_bounds
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        assert [call[1]["exposure_time"] for call in mock_capture.call_args_list] == [
+            0.123,
+            0.246,
+            0.492,
+        ]
+        assert mock_auto_exposure.update.call_args_list[0][0] == (
+            0,
+            mock_capture.call_args_list[0][0][0],
+        )
+
+    def test_keeps_learned_image_size_when_auto_exposure_adjusts_variant(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        variant = MOCK_EXPERIMENT_CONFIGURATION["variants"][0]
+        mocker.patch.object(module.os.path, "getsize").return_value = 1234
+        mocker.patch.object(module, "get_auto_exposure_filepath")
+        mock_auto_exposure = mocker.patch.object(module, "AutoExposure").return_value
+        mock_auto_exposure.variants = [variant]
+
+        def double_exposure_time(variant_index, image_filepath):
+            mock_auto_exposure.variants[variant_index] = variant._replace(
+                exposure_time=mock_auto_exposure.variants[variant_index].exposure_time
+                * 2
+            )
+
+        mock_auto_exposure.update.side_effect = double_exposure_time
+        mock_configuration = _mock_experiment_configuration_with(
+            duration=0.5, interval=0.2, auto_exposure=sentinel.auto_exposure_bounds
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        assert mock_storage_budget.has_space_for.call_args_list == [
+            call(IMAGE_SIZE_IN_BYTES),
+            call(1234),
+            call(1234),
+        ]
+
+    def test_queues_each_capture_for_live_exposure_analysis(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        mocker.patch.object(module, "review_exposure_statistics")
+        mock_start_analysis = mocker.patch.object(
+            module, "start_live_exposure_analysis_in_separate_process"
+        )
+        mock_queue_analysis = mocker.patch.object(
+            module, "queue_live_exposure_analysis"
+        )
+        mock_end_analysis = mocker.patch.object(
+            module, "end_live_exposure_analysis_process"
+        )
+        mock_configuration = _mock_experiment_configuration_with(
+            duration=0.5, interval=0.2, review_exposure=True
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        mock_start_analysis.assert_called_once_with(
+            "/mock/path/to", staging_directory=None
+        )
+        assert [call[0][0] for call in mock_queue_analysis.call_args_list] == [
+            os.path.relpath(call[0][0], "/mock/path/to")
+            for call in mock_capture.call_args_list
+        ]
+        mock_end_analysis.assert_called_once()
+
+    def test_captures_into_staging_directory(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        mock_start_mover = mocker.patch.object(
+            module, "start_staging_mover_in_separate_process"
+        )
+        mock_end_mover = mocker.patch.object(module, "end_staging_mover_process")
+        mocker.patch.object(module, "has_free_space_for").return_value = True
+        mock_configuration = _mock_experiment_configuration_with(
+            staging_directory_path="/mock/staging/to"
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        mock_start_mover.assert_called_once_with("/mock/staging/to", "/mock/path/to")
+        assert os.path.dirname(mock_capture.call_args[0][0]) == "/mock/staging/to"
+        mock_end_mover.assert_called_once_with()
+
+    def test_auto_exposure_reads_image_wherever_mover_put_it(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        mocker.patch.object(module, "start_staging_mover_in_separate_process")
+        mocker.patch.object(module, "end_staging_mover_process")
+        mocker.patch.object(module, "has_free_space_for").return_value = True
+        mocker.patch.object(module, "get_auto_exposure_filepath")
+        mock_auto_exposure = mocker.patch.object(module, "AutoExposure").return_value
+        mock_auto_exposure.variants = MOCK_EXPERIMENT_CONFIGURATION["variants"]
+        mock_find_tiered_file = mocker.patch.object(module, "find_tiered_file")
+        mock_find_tiered_file.return_value = sentinel.moved_image_filepath
+        mock_configuration = _mock_experiment_configuration_with(
+            staging_directory_path="/mock/staging/to",
+            auto_exposure=sentinel.auto_exposure_bounds,
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        image_filename = os.path.basename(mock_capture.call_args[0][0])
+        mock_find_tiered_file.assert_called_once_with(
+            image_filename, ["/mock/staging/to", "/mock/path/to"]
+        )
+        mock_auto_exposure.update.assert_called_once_with(
+            0, sentinel.moved_image_filepath
+        )
+
+    def test_ends_experiment_if_staging_directory_is_full(
+        self, mocker, mock_capture, mock_storage_budget
+    ):
+        mocker.patch.object(module, "start_staging_mover_in_separate_process")
+        mocker.patch.object(module, "end_staging_mover_process")
+        mock_has_free_space_for = mocker.patch.object(module, "has_free_space_for")
+        mock_has_free_space_for.return_value = False
+        mock_configuration = _mock_experiment_configuration_with(
+            staging_directory_path="/mock/staging/to"
+        )
+
+        with pytest.raises(SystemExit):
+            module.perform_experiment(mock_configuration)
+
+        mock_has_free_space_for.assert_called_once_with(
+            "/mock/staging/to", IMAGE_SIZE_IN_BYTES
+        )
+        assert mock_capture.call_count == 0
+
 
 MOCK_BASIC_PARAMETERS = [
     "--name",
@@ -182,3 +442,31 @@ class TestRunExperiment:
 
         assert exception_info.value.code == 1
         assert mock_perform_experiment.call_count == 0
+
+    def test_resumes_queued_uploads_unless_skipping_sync(
+        self,
+        mocker,
+        mock_get_experiment_configuration,
+        mock_hostname_is_correct,
+        mock_create_file_structure_for_experiment,
+        mock_set_up_log_file_with_base_handler,
+        mock_perform_experiment,
+    ):
+        mock_hostname_is_correct.return_value = True
+        mock_get_experiment_configuration.return_value = _mock_experiment_configuration_with(
+            skip_sync=False
+        )
+        mocker.patch.object(module, "get_base_output_path", return_value="/mock/base")
+        mock_record_experiment_directory = mocker.patch.object(
+            module, "record_experiment_directory"
+        )
+        mock_resume = mocker.patch.object(
+            module, "resume_queued_uploads_in_separate_process"
+        )
+
+        module.run_experiment(MOCK_BASIC_PARAMETERS)
+
+        mock_resume.assert_called_once_with(
+            "/mock/base", exclude_directory="/mock/path/to"
+        )
+        assert mock_record_experiment_directory.call_count == 1
@@ -1,15 +1,72 @@
+import collections
+import csv
+import itertools
+import json
+import logging
+import math
+import multiprocessing
 import os
 import sys
 import argparse
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
 from .file_structure import get_files_with_extension
-from .open import as_rgb
+from .exposure_cache import ExposureCache
+from .staging import find_tiered_file
+from .open import (
+    DEFAULT_BAND_MEMORY_LIMIT,
+    RAW_BIT_DEPTH,
+    as_jpeg_preview_rgb,
+    as_raw_bayer,
+    as_rgb,
+    bayer_channels,
+    iterate_bayer_bands,
+    sample_bayer_cell_rows,
+)
 
 COLOR_CHANNELS = "rgb"
 COLOR_CHANNEL_COUNT = len(COLOR_CHANNELS)
 
+DEFAULT_OVEREXPOSED_THRESHOLD = 0.99
+DEFAULT_UNDEREXPOSED_THRESHOLD = 0.1
+
+HISTOGRAM_BIN_COUNTS = {"r": RAW_BIT_DEPTH, "g": 2 * RAW_BIT_DEPTH, "b": RAW_BIT_DEPTH}
+# compute_sampled_exposure_histograms() reads one row of bayer cells out of this many
+DEFAULT_SAMPLE_CELL_ROW_STEP = 8
+
+# review_exposure output formats
+DICT_OUTPUT = "dict"
+CSV_OUTPUT = "csv"
+JSON_LINES_OUTPUT = "jsonl"
+OUTPUT_FORMATS = [DICT_OUTPUT, CSV_OUTPUT, JSON_LINES_OUTPUT]
+
+BYTES_PER_MEGABYTE = 1024 * 1024
+
+# review_exposure methods
+HISTOGRAM_METHOD = "histogram"
+SUPERPIXEL_RGB_METHOD = "superpixel-rgb"
+JPEG_PREVIEW_METHOD = "jpeg-preview"
+METHODS = [HISTOGRAM_METHOD, SUPERPIXEL_RGB_METHOD, JPEG_PREVIEW_METHOD]
+
+# With the jpeg-preview method, also review every nth image from its raw data to estimate the error of the preview
+DEFAULT_ERROR_SAMPLE_INTERVAL = 20
+
+# Live analysis runs at the lowest CPU priority so that it never holds up a capture
+LIVE_ANALYSIS_NICENESS = 19
+# How long to let the live analysis process catch up on its backlog when the experiment ends
+LIVE_ANALYSIS_STOP_TIMEOUT = 60
+
+_LIVE_ANALYSIS_PROCESS = None
+_LIVE_ANALYSIS_QUEUE = None
+
 
 def _generate_statistics(
-    rgb_image, overexposed_threshold=0.99, underexposed_threshold=0.1
+    rgb_image,
+    overexposed_threshold=DEFAULT_OVEREXPOSED_THRESHOLD,
+    underexposed_threshold=DEFAULT_UNDEREXPOSED_THRESHOLD,
 ):
     """ Generate pixel percentage overexposure & underexposure of entire image and overexposure pixel percentage by
         color channel
@@ -28,14 +85,164 @@ def _generate_statistics(
     underexposed_pixel_count_by_channel = (rgb_image < underexposed_threshold).sum(
         axis=(0, 1)
     )
-    per_channel_pixel_count = rgb_image.size / COLOR_CHANNEL_COUNT
+
+    return _statistics_from_counts(
+        overexposed_pixel_count_by_channel,
+        underexposed_pixel_count_by_channel,
+        rgb_image.size,
+        overexposed_threshold,
+        underexposed_threshold,
+    )
+
+
+def compute_exposure_histograms(raw_bayer, band_memory_limit=DEFAULT_BAND_MEMORY_LIMIT):
+    """ Count how many times each raw value occurs in each color channel of a raw image. The image is processed in
+        bands of rows (see open.iterate_bayer_bands()) and the counts added up, so memory use stays within a ceiling
+        however large the image.
+
+        Green is histogrammed as the sum G1 + G2 of each pair of green sites (the `RGB Image` averages them), so that
+        it keeps its full precision: averages can land on half-values, which 1024 bins couldn't tell apart.
+
+    Args:
+        raw_bayer: a `MappedRawBayer` or picamraw `PiRawBayer`, e.g. from as_raw_bayer()
+        band_memory_limit: Optional. Approximate ceiling, in bytes, on the working memory used for each band
+    Returns:
+        dictionary of {color: 1D numpy array of counts indexed by value}, with RAW_BIT_DEPTH bins for "r" and "b" and
+        2 * RAW_BIT_DEPTH bins for "g"
+    """
+    histograms = _empty_exposure_histograms()
+    for _, band in iterate_bayer_bands(raw_bayer, band_memory_limit):
+        _add_to_exposure_histograms(histograms, band, raw_bayer.bayer_order)
+    return histograms
+
+
+def compute_sampled_exposure_histograms(
+    raw_bayer, cell_row_step=DEFAULT_SAMPLE_CELL_ROW_STEP
+):
+    """ Exposure histograms (see compute_exposure_histograms()) of a sample of a raw image's rows: one row of bayer
+        cells out of every `cell_row_step`. Only those rows are read and unpacked, so this takes a fraction of the
+        time. The counts are of the sampled pixels only, but their distribution (e.g. percentiles) closely follows the
+        whole image's.
+
+    Args:
+        raw_bayer: a `MappedRawBayer` or picamraw `PiRawBayer`, e.g. from as_raw_bayer()
+        cell_row_step: Optional. Sample one row of bayer cells out of this many
+    Returns:
+        dictionary of {color: 1D numpy array of counts indexed by value}, as compute_exposure_histograms()
+    """
+    histograms = _empty_exposure_histograms()
+    _add_to_exposure_histograms(
+        histograms,
+        sample_bayer_cell_rows(raw_bayer, cell_row_step),
+        raw_bayer.bayer_order,
+    )
+    return histograms
+
+
+def _empty_exposure_histograms():
+    return {
+        color: np.zeros(HISTOGRAM_BIN_COUNTS[color], dtype=np.int64)
+        for color in COLOR_CHANNELS
+    }
+
+
+def _add_to_exposure_histograms(histograms, bayer_array, bayer_order):
+    red, green_1, green_2, blue = bayer_channels(bayer_array, bayer_order)
+    # 10-bit values, so the sum of two fits comfortably in the uint16 they're stored as
+    green_sum = green_1 + green_2
+
+    for color, channel in zip(COLOR_CHANNELS, [red, green_sum, blue]):
+        histograms[color] += np.bincount(
+            channel.ravel(), minlength=HISTOGRAM_BIN_COUNTS[color]
+        )
+
+
+def _count_above(cumulative_counts, threshold_value):
+    """ How many values are > threshold_value, given cumulative counts of integer values """
+    # For integer v: v > x <=> v > floor(x)
+    index = math.floor(threshold_value)
+    if index < 0:
+        return cumulative_counts[-1]
+    if index >= len(cumulative_counts):
+        return 0
+    return cumulative_counts[-1] - cumulative_counts[index]
+
+
+def _count_below(cumulative_counts, threshold_value):
+    """ How many values are < threshold_value, given cumulative counts of integer values """
+    # For integer v: v < x <=> v < ceil(x) <=> v <= ceil(x) - 1
+    index = math.ceil(threshold_value) - 1
+    if index < 0:
+        return 0
+    return cumulative_counts[min(index, len(cumulative_counts) - 1)]
+
+
+def _generate_statistics_from_histograms(histograms, threshold_pairs):
+    """ Same statistics as _generate_statistics() of the `RGB Image`, for any number of threshold pairs, from exposure
+        histograms (see compute_exposure_histograms()).
+
+        Thresholds are scaled to raw values: by RAW_BIT_DEPTH for red and blue, and by 2 * RAW_BIT_DEPTH for the green
+        sums. Both scalings are by powers of two, so they are exact and the results are identical to comparing the
+        normalized floats.
+
+    Args:
+        histograms: dictionary of exposure histograms by color
+        threshold_pairs: iterable of (overexposed_threshold, underexposed_threshold) pairs
+    Returns:
+        list of dictionaries of overexposure & underexposure statistics, one per threshold pair
+    """
+    cumulative_counts_by_color = {
+        color: np.cumsum(histograms[color]) for color in COLOR_CHANNELS
+    }
+    image_size = sum(
+        cumulative_counts[-1]
+        for cumulative_counts in cumulative_counts_by_color.values()
+    )
+    # Raw values are the normalized thresholds scaled by the number of possible values in each channel
+    scales = [HISTOGRAM_BIN_COUNTS[color] for color in COLOR_CHANNELS]
+
+    return [
+        _statistics_from_counts(
+            np.array(
+                [
+                    _count_above(
+                        cumulative_counts_by_color[color], overexposed_threshold * scale
+                    )
+                    for color, scale in zip(COLOR_CHANNELS, scales)
+                ]
+            ),
+            np.array(
+                [
+                    _count_below(
+                        cumulative_counts_by_color[color],
+                        underexposed_threshold * scale,
+                    )
+                    for color, scale in zip(COLOR_CHANNELS, scales)
+                ]
+            ),
+            image_size,
+            overexposed_threshold,
+            underexposed_threshold,
+        )
+        for overexposed_threshold, underexposed_threshold in threshold_pairs
+    ]
+
+
+def _statistics_from_counts(
+    overexposed_pixel_count_by_channel,
+    underexposed_pixel_count_by_channel,
+    image_size,
+    overexposed_threshold,
+    underexposed_threshold,
+):
+    per_channel_pixel_count = image_size / COLOR_CHANNEL_COUNT
 
     return {
         # fmt: off
         "overexposed_threshold": overexposed_threshold,
         "underexposed_threshold": underexposed_threshold,
-        "overexposed_percent": overexposed_pixel_count_by_channel.sum() / rgb_image.size,
-        "underexposed_percent": underexposed_pixel_count_by_channel.sum() / rgb_image.size,
+        "overexposed_percent": overexposed_pixel_count_by_channel.sum() / image_size,
+        "underexposed_percent": underexposed_pixel_count_by_channel.sum() / image_size,
         **{
             f"overexposed_percent_{color}":
                 overexposed_pixel_count_by_channel[color_index] / per_channel_pixel_count
@@ -50,14 +257,385 @@ def _generate_statistics(
     }
 
 
-def review_exposure_statistics(experiment_directory_path):
-    print("Reviewing exposure settings:")
+def _compute_image_exposure_histograms(image_path, band_memory_limit):
+    """ Decode an image's raw data and compute its exposure histograms. Runs in review worker processes. """
+    return compute_exposure_histograms(as_raw_bayer(image_path), band_memory_limit)
+
+
+def _completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _iterate_image_exposure_histograms(
+    image_paths, exposure_cache, workers, band_memory_limit=DEFAULT_BAND_MEMORY_LIMIT
+):
+    """ Yield (image path, exposure histograms) for each image, in order.
+
+        Histograms come from the exposure cache where it has an up-to-date entry. Otherwise the image is decoded (up to
+        `workers` images at a time, in separate processes) and the result added to the cache. Never more than a couple
+        of images per worker are submitted ahead of the one being yielded, so memory use doesn't grow with the number
+        of images, and each worker processes its image in bands within `band_memory_limit`.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    in_flight = collections.deque()
+    compute_histograms = partial(
+        _compute_image_exposure_histograms, band_memory_limit=band_memory_limit
+    )
+
+    def finish_oldest():
+        image_path, file_stat, histograms = in_flight.popleft()
+        if file_stat is not None:
+            exposure_cache.put_histograms(
+                os.path.basename(image_path), file_stat, histograms.result()
+            )
+        return image_path, histograms.result()
+
+    try:
+        for image_path in image_paths:
+            file_stat = os.stat(image_path)
+            cached_histograms = exposure_cache.get_histograms(
+                os.path.basename(image_path), file_stat
+            )
+            if cached_histograms is not None:
+                # Nothing to cache
+                in_flight.append(
+                    (image_path, None, _completed_future(cached_histograms))
+                )
+            elif executor is None:
+                in_flight.append(
+                    (
+                        image_path,
+                        file_stat,
+                        _completed_future(compute_histograms(image_path)),
+                    )
+                )
+            else:
+                in_flight.append(
+                    (
+                        image_path,
+                        file_stat,
+                        executor.submit(compute_histograms, image_path),
+                    )
+                )
+
+            if len(in_flight) >= max(workers, 1) * 2:
+                yield finish_oldest()
+
+        while in_flight:
+            yield finish_oldest()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _compute_image_rgb_statistics(image_path, threshold_pairs, method):
+    """ Generate statistics for each threshold pair by thresholding an RGB image of an image: its superpixel `RGB Image`
+    or its JPEG preview, depending on the method. Runs in review worker processes.
+    """
+    rgb_image = (
+        as_jpeg_preview_rgb(image_path)
+        if method == JPEG_PREVIEW_METHOD
+        else as_rgb(image_path, superpixel=True)
+    )
+    return [
+        _generate_statistics(rgb_image, overexposed_threshold, underexposed_threshold)
+        for overexposed_threshold, underexposed_threshold in threshold_pairs
+    ]
+
+
+def _iterate_image_rgb_statistics(image_paths, threshold_pairs, workers, method):
+    """ Yield (image path, list of statistics for each threshold pair) for each image, in order, computed from an RGB
+    image of each (see _compute_image_rgb_statistics()), up to `workers` images at a time, in separate processes
+    """
+    compute_statistics = partial(
+        _compute_image_rgb_statistics, threshold_pairs=threshold_pairs, method=method
+    )
+    if workers <= 1:
+        yield from zip(image_paths, map(compute_statistics, image_paths))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from zip(image_paths, executor.map(compute_statistics, image_paths))
+
+
+def _iterate_image_statistics(
+    image_paths,
+    threshold_pairs,
+    workers,
+    method,
+    experiment_directory_path,
+    band_memory_limit,
+):
+    """ Yield (image path, list of statistics for each threshold pair) for each image, in order, by the given method
+    """
+    if method != HISTOGRAM_METHOD:
+        yield from _iterate_image_rgb_statistics(
+            image_paths, threshold_pairs, workers, method
+        )
+        return
+
+    with ExposureCache(experiment_directory_path) as exposure_cache:
+        for image_path, histograms in _iterate_image_exposure_histograms(
+            image_paths, exposure_cache, workers, band_memory_limit
+        ):
+            yield image_path, _generate_statistics_from_histograms(
+                histograms, threshold_pairs
+            )
+
+
+def analyze_exposures_from_queue(directory, image_path_queue, staging_directory=None):
+    """ Compute exposure histograms (into the directory's ExposureCache) and log default exposure statistics for each
+    image path taken from a queue, until a None is taken from it.
+
+    Args:
+        directory: experiment directory that the images are in
+        image_path_queue: multiprocessing.Queue (or queue.Queue) of image paths relative to the experiment directory
+        staging_directory: Optional. Directory that images are captured into before being moved to the experiment
+            directory. Each image is read from whichever of the two it's in at the time
+    Returns:
+        None
+    """
+    threshold_pairs = [(DEFAULT_OVEREXPOSED_THRESHOLD, DEFAULT_UNDEREXPOSED_THRESHOLD)]
+    directories = [staging_directory, directory] if staging_directory else [directory]
+
+    with ExposureCache(directory) as exposure_cache:
+        for image_relative_path in iter(image_path_queue.get, None):
+            image_path = find_tiered_file(image_relative_path, directories)
+            image_filename = os.path.basename(image_path)
+            try:
+                file_stat = os.stat(image_path)
+                histograms = exposure_cache.get_histograms(image_filename, file_stat)
+                if histograms is None:
+                    histograms = compute_exposure_histograms(as_raw_bayer(image_path))
+                    exposure_cache.put_histograms(image_filename, file_stat, histograms)
+            except FileNotFoundError:
+                # e.g. already erased after syncing
+                continue
+            except (OSError, ValueError) as e:
+                # e.g. a truncated or corrupt image: it mustn't stop the analysis of the images after it
+                logging.warning(f"Couldn't analyze the exposure of {image_path} ({e})")
+                continue
+
+            (statistics,) = _generate_statistics_from_histograms(
+                histograms, threshold_pairs
+            )
+            logging.info(f"Exposure of {image_filename}: {statistics}")
+
+
+def _analyze_exposures_at_low_priority(directory, image_path_queue, staging_directory):
+    os.nice(LIVE_ANALYSIS_NICENESS)
+    analyze_exposures_from_queue(directory, image_path_queue, staging_directory)
+
+
+def start_live_exposure_analysis_in_separate_process(directory, staging_directory=None):
+    """ Instantiates a low-priority process that analyzes the exposure of each image passed to
+    queue_live_exposure_analysis() while the experiment runs. Results are logged as they come, and cached so that
+    review_exposure_statistics() at the end of the experiment only has to handle images the process didn't get to.
+
+     Args:
+        directory: experiment directory
+        staging_directory: Optional. Directory that images are captured into before being moved to the experiment
+            directory
+     Returns:
+        None.
+    """
+    global _LIVE_ANALYSIS_PROCESS, _LIVE_ANALYSIS_QUEUE
+
+    _LIVE_ANALYSIS_QUEUE = multiprocessing.Queue()
+    _LIVE_ANALYSIS_PROCESS = multiprocessing.Process(
+        target=_analyze_exposures_at_low_priority,
+        args=(directory, _LIVE_ANALYSIS_QUEUE, staging_directory),
+    )
+    _LIVE_ANALYSIS_PROCESS.start()
+
+
+def queue_live_exposure_analysis(image_relative_path):
+    """ Hand a newly captured image, by its path relative to the experiment (or staging) directory, to the live
+    analysis process, if there is one. Never blocks.
+    """
+    if _LIVE_ANALYSIS_QUEUE is not None:
+        _LIVE_ANALYSIS_QUEUE.put_nowait(image_relative_path)
+
+
+def end_live_exposure_analysis_process():
+    """ Stops the live analysis process, giving it a chance to finish the images it has been handed.
+     Args:
+        None
+     Returns:
+        None
+    """
+    global _LIVE_ANALYSIS_PROCESS, _LIVE_ANALYSIS_QUEUE
+
+    if _LIVE_ANALYSIS_PROCESS and _LIVE_ANALYSIS_PROCESS.is_alive():
+        _LIVE_ANALYSIS_QUEUE.put(None)
+        _LIVE_ANALYSIS_PROCESS.join(LIVE_ANALYSIS_STOP_TIMEOUT)
+        if _LIVE_ANALYSIS_PROCESS.is_alive():
+            # Not kill(), which is only in Python 3.7+. The process has no children of its own to clean up
+            _LIVE_ANALYSIS_PROCESS.terminate()
+
+    _LIVE_ANALYSIS_PROCESS = None
+    _LIVE_ANALYSIS_QUEUE = None
+
+
+def review_exposure_statistics(
+    experiment_directory_path,
+    overexposed_thresholds=(DEFAULT_OVEREXPOSED_THRESHOLD,),
+    underexposed_thresholds=(DEFAULT_UNDEREXPOSED_THRESHOLD,),
+    workers=1,
+    output_format=DICT_OUTPUT,
+    output_file=None,
+    method=HISTOGRAM_METHOD,
+    band_memory_limit=DEFAULT_BAND_MEMORY_LIMIT,
+    error_sample_interval=DEFAULT_ERROR_SAMPLE_INTERVAL,
+):
+    """ Print exposure statistics of each image in a directory, for every combination of the given thresholds.
+        Exposure histograms are kept in an ExposureCache in the directory, so reviewing again (with any thresholds)
+        only has to decode images that are new or have changed.
+
+    Args:
+        experiment_directory_path: directory of JPEG+RAW images
+        overexposed_thresholds: thresholds at which a color's intensity is overexposed
+        underexposed_thresholds: thresholds at which a color's intensity is underexposed
+        workers: Optional. Number of images to process at once, in separate processes
+        output_format: Optional. One of OUTPUT_FORMATS:
+            dict: a progress line then a Python dict per threshold pair, per image
+            csv: one CSV row per image and threshold pair, after a header row
+            jsonl: one JSON object per image and threshold pair, per line
+        output_file: Optional. File to write to. Defaults to stdout
+        method: Optional. One of METHODS:
+            histogram: count exposures from each image's raw exposure histograms (the default; cached)
+            superpixel-rgb: threshold each image's superpixel `RGB Image` (see open.superpixel_rgb()). Slower and
+                never cached, but a direct check of the statistics against the `RGB Image`
+            jpeg-preview: threshold a reduced-scale decode of the JPEG in front of each image's raw data (see
+                open.as_jpeg_preview_rgb()). A quick estimate for triage: the JPEG has been processed by the camera,
+                so its statistics differ from the raw ones
+        band_memory_limit: Optional. Approximate ceiling, in bytes, on the working memory each worker uses to process
+            a band of rows of an image with the histogram method
+        error_sample_interval: Optional. With the jpeg-preview method, also review every nth image with the histogram
+            method and report how far the preview statistics are from the raw ones. 0 to skip
+    Returns:
+        None
+    """
+    output_file = output_file or sys.stdout
     image_paths = get_files_with_extension(experiment_directory_path, ".jpeg")
+    threshold_pairs = list(
+        itertools.product(overexposed_thresholds, underexposed_thresholds)
+    )
+
+    if output_format == DICT_OUTPUT:
+        print("Reviewing exposure settings:", file=output_file)
+
+    sample_statistics_by_image = {}
+    for index, (image_path, image_statistics) in enumerate(
+        _iterate_image_statistics(
+            image_paths,
+            threshold_pairs,
+            workers,
+            method,
+            experiment_directory_path,
+            band_memory_limit,
+        )
+    ):
+        _write_image_exposure_statistics(
+            output_file,
+            output_format,
+            image_path,
+            image_statistics,
+            progress=f"({index + 1}/{len(image_paths)})",
+            write_header=index == 0,
+        )
+        if (
+            method == JPEG_PREVIEW_METHOD
+            and error_sample_interval
+            and index % error_sample_interval == 0
+        ):
+            sample_statistics_by_image[image_path] = image_statistics
+
+    if sample_statistics_by_image:
+        raw_statistics_by_image = _iterate_image_statistics(
+            list(sample_statistics_by_image),
+            threshold_pairs,
+            workers,
+            HISTOGRAM_METHOD,
+            experiment_directory_path,
+            band_memory_limit,
+        )
+        error_summary = summarize_statistics_error(
+            [
+                (estimate, raw)
+                for image_path, raw_statistics in raw_statistics_by_image
+                for estimate, raw in zip(
+                    sample_statistics_by_image[image_path], raw_statistics
+                )
+            ]
+        )
+        # Keep csv and jsonl output machine-readable
+        summary_file = output_file if output_format == DICT_OUTPUT else sys.stderr
+        print(
+            f"Error of {method} statistics vs. raw, from {len(sample_statistics_by_image)} sample images:",
+            file=summary_file,
+        )
+        for statistic, error in error_summary.items():
+            print(
+                f"  {statistic:<28} mean {error['mean_absolute_error']:.4f}"
+                f"  max {error['max_absolute_error']:.4f}",
+                file=summary_file,
+            )
+
+
+def summarize_statistics_error(statistics_pairs):
+    """ Summarize how far estimated exposure statistics are from the actual ones
 
-    for index, image_path in enumerate(image_paths):
-        rgb_image = as_rgb(os.path.join(experiment_directory_path, image_path))
-        print("({}/{}) - {}".format(index + 1, len(image_paths), image_path))
-        print(_generate_statistics(rgb_image))
+    Args:
+        statistics_pairs: list of (estimated statistics, actual statistics) dictionaries, for the same image and
+            thresholds
+    Returns:
+        dict of {statistic name: {"mean_absolute_error": ..., "max_absolute_error": ...}} for each of the
+        overexposed/underexposed percent statistics, in the same units as the statistic
+    """
+    statistic_names = [name for name in statistics_pairs[0][1] if "_percent" in name]
+    absolute_errors = {
+        name: np.array(
+            [
+                abs(estimate[name] - actual[name])
+                for estimate, actual in statistics_pairs
+            ]
+        )
+        for name in statistic_names
+    }
+    return {
+        name: {
+            "mean_absolute_error": float(errors.mean()),
+            "max_absolute_error": float(errors.max()),
+        }
+        for name, errors in absolute_errors.items()
+    }
+
+
+def _write_image_exposure_statistics(
+    output_file, output_format, image_path, image_statistics, progress, write_header
+):
+    image_filename = os.path.basename(image_path)
+    if output_format == DICT_OUTPUT:
+        print(f"{progress} - {image_path}", file=output_file)
+
+    for statistics in image_statistics:
+        row = {"image": image_filename, **statistics}
+        if output_format == CSV_OUTPUT:
+            csv_writer = csv.DictWriter(output_file, fieldnames=list(row))
+            if write_header:
+                csv_writer.writeheader()
+                write_header = False
+            csv_writer.writerow(row)
+        elif output_format == JSON_LINES_OUTPUT:
+            print(json.dumps(row), file=output_file)
+        else:
+            print(statistics, file=output_file)
+
+    # Stream results out as they come, e.g. to a pipe
+    output_file.flush()
 
 
 def review_exposure(cli_args=None):
@@ -80,5 +658,64 @@ def review_exposure(cli_args=None):
         type=str,
         help="directory to use to review image exposures",
     )
+    arg_parser.add_argument(
+        "--overexposed-thresholds",
+        type=float,
+        nargs="+",
+        default=[DEFAULT_OVEREXPOSED_THRESHOLD],
+        help="one or more thresholds (0-1) at which a color's intensity is overexposed",
+    )
+    arg_parser.add_argument(
+        "--underexposed-thresholds",
+        type=float,
+        nargs="+",
+        default=[DEFAULT_UNDEREXPOSED_THRESHOLD],
+        help="one or more thresholds (0-1) at which a color's intensity is underexposed",
+    )
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of images to process at once, each in its own process."
+        " Try the number of CPU cores (%(default)s by default)",
+    )
+    arg_parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default=DICT_OUTPUT,
+        help="dict: human-readable (default); csv: CSV rows; jsonl: one JSON object per line."
+        " Each row/object is one image and threshold pair",
+    )
+    arg_parser.add_argument(
+        "--method",
+        choices=METHODS,
+        default=HISTOGRAM_METHOD,
+        help="histogram: count from raw exposure histograms, cached in the directory (default);"
+        " superpixel-rgb: threshold a half-resolution RGB image of each image, without caching;"
+        " jpeg-preview: quickly estimate from a 1/8 scale decode of each image's JPEG",
+    )
+    arg_parser.add_argument(
+        "--memory-limit",
+        type=float,
+        default=DEFAULT_BAND_MEMORY_LIMIT / BYTES_PER_MEGABYTE,
+        help="approximate ceiling on the working memory, in MB, each worker uses to process an image in bands of rows"
+        " (%(default)s by default)",
+    )
+    arg_parser.add_argument(
+        "--error-sample-interval",
+        type=int,
+        default=DEFAULT_ERROR_SAMPLE_INTERVAL,
+        help="with --method jpeg-preview, also review every nth image from its raw data and report the error of the"
+        " preview statistics (every %(default)s by default). 0 to skip",
+    )
     args = vars(arg_parser.parse_args(cli_args))
-    review_exposure_statistics(args["directory"])
+    review_exposure_statistics(
+        args["directory"],
+        args["overexposed_thresholds"],
+        args["underexposed_thresholds"],
+        workers=args["workers"],
+        output_format=args["output_format"],
+        method=args["method"],
+        band_memory_limit=int(args["memory_limit"] * BYTES_PER_MEGABYTE),
+        error_sample_interval=args["error_sample_interval"],
+    )
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+
+from .sqlite_database import SqliteDatabase
+
+# Lives in the experiment directory it describes. Derived from the images, so it is never synced
+EXPOSURE_CACHE_FILENAME = ".exposure_cache.sqlite3"
+# Also matches sqlite's temporary journal file
+EXPOSURE_CACHE_PATTERNS = [f"{EXPOSURE_CACHE_FILENAME}*"]
+
+_HISTOGRAM_DTYPE = np.int64
+_COLOR_CHANNELS = "rgb"
+
+
+class ExposureCache(SqliteDatabase):
+    """ A persistent record, in an SQLite database inside an experiment directory, of the exposure histograms of each
+    image in that directory (see exposure.compute_exposure_histograms()).
+
+    Entries are keyed by the image's filename, size and modified time, so an image that is replaced or rewritten is
+    never matched with stale histograms. Reviewing exposure again only has to decode new images.
+
+    Safe to share between threads. Use as a context manager to close the database when done.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS histograms (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            r BLOB NOT NULL,
+            g BLOB NOT NULL,
+            b BLOB NOT NULL
+        )
+    """
+
+    def __init__(self, directory):
+        super().__init__(os.path.join(directory, EXPOSURE_CACHE_FILENAME))
+
+    def get_histograms(self, relative_path, file_stat):
+        """ Get cached histograms for an image, if the image hasn't changed (by size or modified time) since
+
+        Args:
+            relative_path: path of the image relative to the experiment directory
+            file_stat: os.stat() result for the image
+        Returns:
+            dictionary of exposure histograms by color, or None if there is no up-to-date entry
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT r, g, b FROM histograms WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (relative_path, file_stat.st_size, file_stat.st_mtime_ns),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            color: np.frombuffer(histogram, dtype=_HISTOGRAM_DTYPE)
+            for color, histogram in zip(_COLOR_CHANNELS, row)
+        }
+
+    def put_histograms(self, relative_path, file_stat, histograms):
+        """ Cache histograms for an image, as it was when `file_stat` was taken """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO histograms (path, size, mtime_ns, r, g, b) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    relative_path,
+                    file_stat.st_size,
+                    file_stat.st_mtime_ns,
+                    *[
+                        np.asarray(histograms[color], dtype=_HISTOGRAM_DTYPE).tobytes()
+                        for color in _COLOR_CHANNELS
+                    ],
+                ),
+            )
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from . import exposure_cache as module
+
+
+HISTOGRAMS = {
+    "r": np.arange(1024),
+    "g": np.arange(2048),
+    "b": np.zeros(1024, dtype=np.int64),
+}
+
+
+class TestExposureCache:
+    def test_round_trips_histograms(self, tmp_path):
+        image_path = tmp_path / "image.jpeg"
+        image_path.write_bytes(b"image")
+
+        with module.ExposureCache(str(tmp_path)) as exposure_cache:
+            exposure_cache.put_histograms("image.jpeg", os.stat(image_path), HISTOGRAMS)
+
+        with module.ExposureCache(str(tmp_path)) as exposure_cache:
+            cached = exposure_cache.get_histograms("image.jpeg", os.stat(image_path))
+
+        for color, histogram in HISTOGRAMS.items():
+            np.testing.assert_array_equal(cached[color], histogram)
+
+    def test_changed_image_misses(self, tmp_path):
+        image_path = tmp_path / "image.jpeg"
+        image_path.write_bytes(b"image")
+
+        with module.ExposureCache(str(tmp_path)) as exposure_cache:
+            exposure_cache.put_histograms("image.jpeg", os.stat(image_path), HISTOGRAMS)
+            image_path.write_bytes(b"different image")
+
+            assert (
+                exposure_cache.get_histograms("image.jpeg", os.stat(image_path)) is None
+            )
+            assert (
+                exposure_cache.get_histograms("other.jpeg", os.stat(image_path)) is None
+            )
@@ -1,7 +1,19 @@
+import csv
+import io
+import json
+import os
+import queue
+from types import SimpleNamespace
+from unittest.mock import call
+
 import pytest
 import numpy as np
+from picamraw.constants import BayerOrder
+from picamraw.main import bayer_array_to_rgb
 
 from . import exposure as module
+from .open import superpixel_rgb
+from .exposure_cache import ExposureCache
 
 rgb_image = np.array(
     [[[0.0, 0.1, 0.2], [0.1, 0.2, 0.0]], [[0.0, 0.1, 0.999], [0.0, 0.999, 0.999]]]
@@ -38,3 +50,350 @@ class TestGenerateStastics:
         stats = module._generate_statistics(rgb_image)
         actual_invalid_exposure_percent = stats[color_channel_key]
         assert actual_invalid_exposure_percent == expected_invalid_exposure_percent
+
+
+def _random_raw_bayer(bayer_order=BayerOrder.RGGB, seed=0):
+    random_state = np.random.RandomState(seed)
+    bayer_array = random_state.randint(
+        0, module.RAW_BIT_DEPTH, size=(64, 48), dtype=np.uint16
+    )
+    return SimpleNamespace(bayer_array=bayer_array, bayer_order=bayer_order)
+
+
+class TestGenerateStatisticsFromHistograms:
+    @pytest.mark.parametrize("bayer_order", list(BayerOrder))
+    @pytest.mark.parametrize(
+        "overexposed_threshold, underexposed_threshold",
+        [(0.99, 0.1), (0.5, 0.5), (0.9990234375, 0.0009765625), (0.3, 0.7)],
+    )
+    def test_matches_rgb_image_statistics(
+        self, bayer_order, overexposed_threshold, underexposed_threshold
+    ):
+        random_state = np.random.RandomState(0)
+        bayer_array = random_state.randint(
+            0, module.RAW_BIT_DEPTH, size=(64, 48), dtype=np.uint16
+        )
+        # Make sure values right at each threshold are represented
+        bayer_array[:4, :4] = [
+            [1023, 1014, 102, 103],
+            [1013, 1015, 101, 1000],
+            [0, 1, 511, 512],
+            [513, 307, 716, 717],
+        ]
+        raw_bayer = SimpleNamespace(bayer_array=bayer_array, bayer_order=bayer_order)
+        rgb_image = bayer_array_to_rgb(bayer_array, bayer_order) / module.RAW_BIT_DEPTH
+
+        expected = module._generate_statistics(
+            rgb_image, overexposed_threshold, underexposed_threshold
+        )
+        actual = module._generate_statistics_from_histograms(
+            module.compute_exposure_histograms(raw_bayer),
+            [(overexposed_threshold, underexposed_threshold)],
+        )
+
+        assert actual == [expected]
+
+    def test_many_thresholds_match_rgb_image_statistics(self):
+        raw_bayer = _random_raw_bayer()
+        rgb_image = (
+            bayer_array_to_rgb(raw_bayer.bayer_array, raw_bayer.bayer_order)
+            / module.RAW_BIT_DEPTH
+        )
+        threshold_pairs = [(-1, 2), (0.99, 0.1), (0.75, 0.25), (2, -1)]
+
+        actual = module._generate_statistics_from_histograms(
+            module.compute_exposure_histograms(raw_bayer), threshold_pairs
+        )
+
+        assert actual == [
+            module._generate_statistics(rgb_image, overexposed, underexposed)
+            for overexposed, underexposed in threshold_pairs
+        ]
+
+
+class TestComputeExposureHistograms:
+    @pytest.mark.parametrize("band_memory_limit", [1, 1000, 10 ** 9])
+    def test_bands_add_up_to_whole_image(self, band_memory_limit):
+        raw_bayer = _random_raw_bayer()
+        red, green_1, green_2, blue = (
+            raw_bayer.bayer_array[0::2, 0::2],
+            raw_bayer.bayer_array[1::2, 0::2],
+            raw_bayer.bayer_array[0::2, 1::2],
+            raw_bayer.bayer_array[1::2, 1::2],
+        )
+
+        histograms = module.compute_exposure_histograms(raw_bayer, band_memory_limit)
+
+        np.testing.assert_array_equal(
+            histograms["r"], np.bincount(red.ravel(), minlength=1024)
+        )
+        np.testing.assert_array_equal(
+            histograms["g"], np.bincount((green_1 + green_2).ravel(), minlength=2048)
+        )
+        np.testing.assert_array_equal(
+            histograms["b"], np.bincount(blue.ravel(), minlength=1024)
+        )
+
+
+class TestComputeSampledExposureHistograms:
+    def test_step_of_one_matches_whole_image(self):
+        raw_bayer = _random_raw_bayer()
+
+        sampled = module.compute_sampled_exposure_histograms(raw_bayer, cell_row_step=1)
+        whole = module.compute_exposure_histograms(raw_bayer)
+
+        for color in module.COLOR_CHANNELS:
+            np.testing.assert_array_equal(sampled[color], whole[color])
+
+    def test_counts_only_sampled_cells(self):
+        raw_bayer = _random_raw_bayer()
+        red = raw_bayer.bayer_array[0::2, 0::2]
+
+        histograms = module.compute_sampled_exposure_histograms(
+            raw_bayer, cell_row_step=3
+        )
+
+        np.testing.assert_array_equal(
+            histograms["r"], np.bincount(red[::3].ravel(), minlength=1024)
+        )
+
+
+class TestReviewExposure:
+    def test_prints_statistics_for_each_threshold_pair(self, mocker, tmp_path, capsys):
+        mocker.patch.object(module, "as_raw_bayer", return_value=_random_raw_bayer())
+        (tmp_path / "image.jpeg").write_bytes(b"")
+
+        module.review_exposure(
+            [
+                "--directory",
+                str(tmp_path),
+                "--overexposed-thresholds",
+                "0.9",
+                "0.99",
+                "--underexposed-thresholds",
+                "0.1",
+            ]
+        )
+
+        output = capsys.readouterr().out
+        assert "'overexposed_threshold': 0.9," in output
+        assert "'overexposed_threshold': 0.99," in output
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_jsonl_output_in_order(self, mocker, tmp_path, workers):
+        image_names = [f"image{index}.jpeg" for index in range(5)]
+        # Only the first two are already in the cache: the rest are decoded by the workers
+        mocker.patch.object(module, "as_raw_bayer", return_value=_random_raw_bayer())
+        with ExposureCache(str(tmp_path)) as exposure_cache:
+            for image_name in image_names:
+                (tmp_path / image_name).write_bytes(b"")
+            for image_name in image_names[:2]:
+                exposure_cache.put_histograms(
+                    image_name,
+                    os.stat(tmp_path / image_name),
+                    module.compute_exposure_histograms(_random_raw_bayer(seed=1)),
+                )
+        output_file = io.StringIO()
+
+        module.review_exposure_statistics(
+            str(tmp_path),
+            workers=workers,
+            output_format=module.JSON_LINES_OUTPUT,
+            output_file=output_file,
+        )
+
+        rows = [json.loads(line) for line in output_file.getvalue().splitlines()]
+        assert [row["image"] for row in rows] == image_names
+        assert rows[0]["overexposed_threshold"] == module.DEFAULT_OVEREXPOSED_THRESHOLD
+        # Cached and freshly decoded images give different (random) statistics
+        assert rows[0]["overexposed_percent"] == rows[1]["overexposed_percent"]
+        assert rows[1]["overexposed_percent"] != rows[2]["overexposed_percent"]
+
+    def test_only_decodes_new_or_changed_images(self, mocker, tmp_path):
+        mock_as_raw_bayer = mocker.patch.object(
+            module, "as_raw_bayer", return_value=_random_raw_bayer()
+        )
+        (tmp_path / "first.jpeg").write_bytes(b"")
+        module.review_exposure_statistics(str(tmp_path), output_file=io.StringIO())
+
+        (tmp_path / "second.jpeg").write_bytes(b"")
+        module.review_exposure_statistics(str(tmp_path), output_file=io.StringIO())
+        (tmp_path / "first.jpeg").write_bytes(b"rewritten")
+        module.review_exposure_statistics(str(tmp_path), output_file=io.StringIO())
+
+        decoded_paths = [call[0][0] for call in mock_as_raw_bayer.call_args_list]
+        assert decoded_paths == [
+            str(tmp_path / "first.jpeg"),
+            str(tmp_path / "second.jpeg"),
+            str(tmp_path / "first.jpeg"),
+        ]
+
+    def test_csv_output(self, mocker, tmp_path):
+        mocker.patch.object(module, "as_raw_bayer", return_value=_random_raw_bayer())
+        (tmp_path / "image.jpeg").write_bytes(b"")
+        output_file = io.StringIO()
+
+        module.review_exposure_statistics(
+            str(tmp_path),
+            underexposed_thresholds=[0.1, 0.2],
+            output_format=module.CSV_OUTPUT,
+            output_file=output_file,
+        )
+
+        rows = list(csv.DictReader(io.StringIO(output_file.getvalue())))
+        assert [row["underexposed_threshold"] for row in rows] == ["0.1", "0.2"]
+        assert rows[0]["image"] == "image.jpeg"
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_superpixel_rgb_method_matches_histogram_method(
+        self, mocker, tmp_path, workers
+    ):
+        mocker.patch.object(module, "as_raw_bayer", return_value=_random_raw_bayer())
+        mocker.patch.object(
+            module,
+            "as_rgb",
+            side_effect=lambda image_path, superpixel: superpixel_rgb(
+                _random_raw_bayer()
+            ),
+        )
+        for index in range(3):
+            (tmp_path / f"image{index}.jpeg").write_bytes(b"")
+
+        def review(method):
+            output_file = io.StringIO()
+            module.review_exposure_statistics(
+                str(tmp_path),
+                overexposed_thresholds=[0.9, 0.99],
+                underexposed_thresholds=[0.1, 0.5],
+                workers=workers,
+                output_format=module.JSON_LINES_OUTPUT,
+                output_file=output_file,
+                method=method,
+            )
+            return output_file.getvalue()
+
+        superpixel_rgb_output = review(module.SUPERPIXEL_RGB_METHOD)
+
+        # Three images, four threshold pairs
+        assert len(superpixel_rgb_output.splitlines()) == 12
+        assert superpixel_rgb_output == review(module.HISTOGRAM_METHOD)
+
+    def test_jpeg_preview_method_reports_error_vs_raw(self, mocker, tmp_path, capsys):
+        mocker.patch.object(module, "as_raw_bayer", return_value=_random_raw_bayer())
+        mock_as_jpeg_preview_rgb = mocker.patch.object(
+            module, "as_jpeg_preview_rgb", return_value=np.full((4, 4, 3), 0.5)
+        )
+        for index in range(5):
+            (tmp_path / f"image{index}.jpeg").write_bytes(b"")
+        output_file = io.StringIO()
+
+        module.review_exposure_statistics(
+            str(tmp_path),
+            output_format=module.CSV_OUTPUT,
+            output_file=output_file,
+            method=module.JPEG_PREVIEW_METHOD,
+            error_sample_interval=2,
+        )
+
+        rows = list(csv.DictReader(io.StringIO(output_file.getvalue())))
+        assert [row["overexposed_percent"] for row in rows] == ["0.0"] * 5
+        assert mock_as_jpeg_preview_rgb.call_count == 5
+        error_summary = capsys.readouterr().err
+        assert "from 3 sample images" in error_summary
+        assert "underexposed_percent_g" in error_summary
+
+
+def test_summarize_statistics_error():
+    actual = {"overexposed_threshold": 0.99, "overexposed_percent": 0.5}
+
+    summary = module.summarize_statistics_error(
+        [
+            ({"overexposed_threshold": 0.99, "overexposed_percent": 0.4}, actual),
+            ({"overexposed_threshold": 0.99, "overexposed_percent": 0.8}, actual),
+        ]
+    )
+
+    assert summary == {
+        "overexposed_percent": {
+            "mean_absolute_error": pytest.approx(0.2),
+            "max_absolute_error": pytest.approx(0.3),
+        }
+    }
+
+
+class TestAnalyzeExposuresFromQueue:
+    def test_caches_histograms_for_queued_images(self, mocker, tmp_path):
+        mock_as_raw_bayer = mocker.patch.object(
+            module, "as_raw_bayer", return_value=_random_raw_bayer()
+        )
+        (tmp_path / "image.jpeg").write_bytes(b"")
+        image_path_queue = queue.Queue()
+        # The second image was erased (e.g. after syncing) before it could be analyzed
+        for image_name in ["image.jpeg", "erased.jpeg"]:
+            image_path_queue.put(image_name)
+        image_path_queue.put(None)
+
+        module.analyze_exposures_from_queue(str(tmp_path), image_path_queue)
+        # Reviewing at the end of the experiment reuses the live analysis
+        module.review_exposure_statistics(str(tmp_path), output_file=io.StringIO())
+
+        mock_as_raw_bayer.assert_called_once_with(str(tmp_path / "image.jpeg"))
+
+    def test_unreadable_image__skipped(self, mocker, tmp_path):
+        mock_as_raw_bayer = mocker.patch.object(
+            module,
+            "as_raw_bayer",
+            side_effect=[ValueError("corrupt image"), _random_raw_bayer()],
+        )
+        mock_warning = mocker.patch.object(module.logging, "warning")
+        image_path_queue = queue.Queue()
+        for image_name in ["corrupt.jpeg", "image.jpeg"]:
+            (tmp_path / image_name).write_bytes(b"")
+            image_path_queue.put(image_name)
+        image_path_queue.put(None)
+
+        module.analyze_exposures_from_queue(str(tmp_path), image_path_queue)
+
+        assert mock_as_raw_bayer.call_count == 2
+        mock_warning.assert_called_once()
+
+    def test_finds_images_in_staging_or_experiment_directory(self, mocker, tmp_path):
+        mock_as_raw_bayer = mocker.patch.object(
+            module, "as_raw_bayer", return_value=_random_raw_bayer()
+        )
+        staging_directory = tmp_path / "staging"
+        staging_directory.mkdir()
+        experiment_directory = tmp_path / "experiment"
+        experiment_directory.mkdir()
+        (staging_directory / "staged.jpeg").write_bytes(b"")
+        # Moved out of the staging directory before it could be analyzed
+        (experiment_directory / "moved.jpeg").write_bytes(b"")
+        image_path_queue = queue.Queue()
+        for image_name in ["staged.jpeg", "moved.jpeg"]:
+            image_path_queue.put(image_name)
+        image_path_queue.put(None)
+
+        module.analyze_exposures_from_queue(
+            str(experiment_directory),
+            image_path_queue,
+            staging_directory=str(staging_directory),
+        )
+
+        assert mock_as_raw_bayer.call_args_list == [
+            call(str(staging_directory / "staged.jpeg")),
+            call(str(experiment_directory / "moved.jpeg")),
+        ]
+
+    def test_end_process_that_doesnt_stop__terminates_it(self, mocker):
+        mock_process = mocker.patch.object(module, "_LIVE_ANALYSIS_PROCESS")
+        mock_process.is_alive.return_value = True
+        mock_queue = mocker.patch.object(module, "_LIVE_ANALYSIS_QUEUE")
+
+        module.end_live_exposure_analysis_process()
+
+        mock_queue.put.assert_called_once_with(None)
+        mock_process.terminate.assert_called_once_with()
+        assert module._LIVE_ANALYSIS_PROCESS is None
+
+    def test_queueing_without_live_analysis_is_a_no_op(self):
+        module.queue_live_exposure_analysis("/mock/image.jpeg")
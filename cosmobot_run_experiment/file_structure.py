@@ -1,10 +1,17 @@
 import datetime
 import os
+import re
 
 
 _FILENAME_DATETIME_FORMAT = "%Y-%m-%d--%H-%M-%S"
 FILENAME_TIMESTAMP_LENGTH = len("2018-01-01--12-01-01")
 
+# In the sharded layout, images go in a directory per hour: <experiment directory>/<YYYY-MM-DD>/<HH>/
+_SHARD_DATE_FORMAT = "%Y-%m-%d"
+_SHARD_HOUR_FORMAT = "%H"
+# Matches the shard directories at the start of a "/"-separated relative path
+_SHARD_PREFIX_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}/\d{2}/")
+
 
 def get_base_output_path():
     # Store output in pi user's home directory even if this command is run as root
@@ -53,8 +60,49 @@ def get_image_filename(current_datetime, variant):
     return image_filename
 
 
+def get_image_relative_path(current_datetime, variant, sharded=False):
+    """
+    Args:
+        current_datetime: datetime.datetime instance for when the image is taken
+        variant: ExperimentVariant instance for this image
+        sharded: Optional. If True, put the image in a directory for the hour it is taken in (<YYYY-MM-DD>/<HH>/), so
+            that no one directory of a long experiment holds too many files to list or sync quickly
+
+    Returns:
+        string - path of the image relative to the experiment directory
+    """
+    image_filename = get_image_filename(current_datetime, variant)
+    if not sharded:
+        return image_filename
+    return os.path.join(
+        current_datetime.strftime(_SHARD_DATE_FORMAT),
+        current_datetime.strftime(_SHARD_HOUR_FORMAT),
+        image_filename,
+    )
+
+
+def unshard_relative_path(relative_path):
+    """ Strip the shard directories, if any, from a "/"-separated path relative to an experiment directory.
+    Used to name files on s3, where experiments stay flat for downstream tools whether or not they were sharded.
+    Image filenames start with their capture time, so they are unique across shards.
+    """
+    return _SHARD_PREFIX_PATTERN.sub("", relative_path)
+
+
+def _iterate_file_paths(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield from _iterate_file_paths(entry.path)
+            else:
+                yield entry.path
+
+
 def get_files_with_extension(directory, extension):
-    """ Get all file paths in the given directory with the given extension, sorted alphanumerically
+    """ Get all file paths in the given directory with the given extension, sorted alphanumerically.
+    Includes files in subdirectories, such as the shard directories of a sharded experiment (see
+    get_image_relative_path()). Shard directories sort by time, so the images of a sharded experiment still sort by
+    capture time.
 
         NOTE: Duplicated from process_experiment
 
@@ -66,10 +114,10 @@ def get_files_with_extension(directory, extension):
         A sorted list of full file paths
     """
     file_paths = [
-        os.path.join(directory, filename)
-        for filename in os.listdir(directory)
+        file_path
+        for file_path in _iterate_file_paths(directory)
         # splitext() splits into a tuple of (root, extension)
-        if os.path.splitext(filename)[1] == extension
+        if os.path.splitext(file_path)[1] == extension
     ]
 
     return sorted(file_paths)
@@ -87,7 +135,9 @@ def remove_experiment_directory(experiment_directory):
     """
 
     directory = os.path.join(get_base_output_path(), experiment_directory)
-    os.rmdir(directory)
+    # Any (empty) shard directories go first
+    for directory_path, _, _ in os.walk(directory, topdown=False):
+        os.rmdir(directory_path)
 
 
 # COPY-PASTA from cosmobot-process-experiment
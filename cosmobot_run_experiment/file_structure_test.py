@@ -1,3 +1,4 @@
+import os
 from datetime import datetime
 
 import pytest
@@ -68,6 +69,75 @@ class TestGetImageFilename:
         )
 
 
+class TestGetImageRelativePath:
+    example_variant = ExperimentVariant(
+        additional_capture_params="", exposure_time=1, iso=123, camera_warm_up=5
+    )
+    datetime_ = datetime(2019, 4, 8, 9, 52, 12)
+
+    def test_unsharded_is_filename(self):
+        assert module.get_image_relative_path(
+            self.datetime_, self.example_variant
+        ) == module.get_image_filename(self.datetime_, self.example_variant)
+
+    def test_sharded_is_in_directory_for_hour(self):
+        filename = module.get_image_filename(self.datetime_, self.example_variant)
+
+        assert module.get_image_relative_path(
+            self.datetime_, self.example_variant, sharded=True
+        ) == os.path.join("2019-04-08", "09", filename)
+
+
+class TestUnshardRelativePath:
+    @pytest.mark.parametrize(
+        "name,relative_path,expected",
+        [
+            ("sharded", "2019-04-08/09/image.jpeg", "image.jpeg"),
+            ("unsharded", "image.jpeg", "image.jpeg"),
+            (
+                "other subdirectory",
+                "subdirectory/image.jpeg",
+                "subdirectory/image.jpeg",
+            ),
+        ],
+    )
+    def test_strips_only_shard_directories(self, name, relative_path, expected):
+        assert module.unshard_relative_path(relative_path) == expected
+
+
+class TestGetFilesWithExtension:
+    def test_includes_files_in_shard_directories_sorted(self, tmp_path):
+        for hour in ["10", "09"]:
+            (tmp_path / "2019-04-08" / hour).mkdir(parents=True)
+            (
+                tmp_path / "2019-04-08" / hour / f"2019-04-08--{hour}-00-00.jpeg"
+            ).write_text("")
+        (tmp_path / "experiment.log").write_text("")
+
+        assert module.get_files_with_extension(str(tmp_path), ".jpeg") == [
+            str(tmp_path / "2019-04-08" / "09" / "2019-04-08--09-00-00.jpeg"),
+            str(tmp_path / "2019-04-08" / "10" / "2019-04-08--10-00-00.jpeg"),
+        ]
+
+
+class TestRemoveExperimentDirectory:
+    def test_removes_empty_shard_directories(self, mocker, tmp_path):
+        mocker.patch.object(module, "get_base_output_path").return_value = str(tmp_path)
+        (tmp_path / "experiment" / "2019-04-08" / "09").mkdir(parents=True)
+
+        module.remove_experiment_directory("experiment")
+
+        assert not (tmp_path / "experiment").exists()
+
+    def test_blows_up_if_files_remain(self, mocker, tmp_path):
+        mocker.patch.object(module, "get_base_output_path").return_value = str(tmp_path)
+        (tmp_path / "experiment" / "2019-04-08" / "09").mkdir(parents=True)
+        (tmp_path / "experiment" / "2019-04-08" / "09" / "image.jpeg").write_text("")
+
+        with pytest.raises(OSError):
+            module.remove_experiment_directory("experiment")
+
+
 # COPY-PASTA from cosmobot-process-experiment
 class TestIsoDatetimeAndRestFromFilename:
     def test_returns_datetime(self):
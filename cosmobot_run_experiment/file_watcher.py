@@ -0,0 +1,175 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+_INOTIFY_READ_SIZE = 64 * 1024
+
+
+def list_relative_file_paths(directory):
+    """ All files under a directory (including in subdirectories, e.g. shard directories), as "/"-separated paths
+    relative to it (like s3 key names), sorted
+    """
+    return sorted(
+        os.path.relpath(os.path.join(directory_path, filename), directory).replace(
+            os.sep, "/"
+        )
+        for directory_path, _, filenames in os.walk(directory)
+        for filename in filenames
+    )
+
+
+class InotifyClosedFileWatcher:
+    """ Reports files in a directory (or its subdirectories) as soon as they have been completely written, using
+    Linux inotify.
+
+    A file counts as complete when a writer closes it (IN_CLOSE_WRITE) or when it is renamed into the directory
+    (IN_MOVED_TO) - raspistill writes each image to a "~" temp file and renames it once done.
+
+    New subdirectories are watched as soon as they are created. Any files that were completed in one before it was
+    watched are reported then.
+    """
+
+    def __init__(self, directory):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._directory = directory
+        # Relative path of the (sub)directory each inotify watch descriptor is watching
+        self._watched_directories = {}
+
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        try:
+            self._watch_directory("")
+            for relative_directory, _ in self._list_subdirectories(""):
+                self._watch_directory(relative_directory)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _watch_directory(self, relative_directory):
+        path = os.path.join(self._directory, relative_directory)
+        watch_descriptor = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        )
+        if watch_descriptor < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+        self._watched_directories[watch_descriptor] = relative_directory
+
+    def _list_subdirectories(self, relative_directory):
+        """ (relative path, files in it) for each subdirectory under a watched directory, parents first """
+        path = os.path.join(self._directory, relative_directory)
+        for directory_path, _, filenames in os.walk(path):
+            if directory_path != path:
+                yield os.path.relpath(directory_path, self._directory), filenames
+
+    def _watch_new_directory(self, relative_directory):
+        """ Watch a newly created subdirectory (and any subdirectories already in it)
+
+        Returns:
+            relative paths of files already in them, which may have been completed before they were watched
+        """
+        self._watch_directory(relative_directory)
+        relative_paths = [
+            os.path.join(relative_directory, filename)
+            for filename in sorted(
+                os.listdir(os.path.join(self._directory, relative_directory))
+            )
+            if os.path.isfile(
+                os.path.join(self._directory, relative_directory, filename)
+            )
+        ]
+        for subdirectory, filenames in self._list_subdirectories(relative_directory):
+            self._watch_directory(subdirectory)
+            relative_paths.extend(
+                os.path.join(subdirectory, filename) for filename in sorted(filenames)
+            )
+        return relative_paths
+
+    def read_closed_filenames(self, timeout):
+        """ Wait up to `timeout` seconds for files to be completed
+
+        Returns:
+            list of paths, relative to the watched directory, of files completed since the last call, in the order
+            they were completed. For files directly in the watched directory, that's just their filename
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buffer = os.read(self._fd, _INOTIFY_READ_SIZE)
+        filenames = []
+        offset = 0
+        while offset < len(buffer):
+            watch_descriptor, mask, _, name_length = _INOTIFY_EVENT_HEADER.unpack_from(
+                buffer, offset
+            )
+            offset += _INOTIFY_EVENT_HEADER.size
+            # The name is padded with null bytes to an alignment boundary
+            name_end = offset + name_length
+            name = buffer[offset:name_end].rstrip(b"\0")
+            offset = name_end
+            if not name or watch_descriptor not in self._watched_directories:
+                continue
+
+            relative_path = os.path.join(
+                self._watched_directories[watch_descriptor], os.fsdecode(name)
+            )
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        filenames.extend(self._watch_new_directory(relative_path))
+                    except OSError:
+                        # Already removed again
+                        continue
+            elif not mask & IN_CREATE:
+                filenames.append(relative_path)
+        return filenames
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingClosedFileWatcher:
+    """ Fallback for systems without inotify (e.g. development laptops): reports files as they appear in a
+    directory listing (see list_relative_file_paths()). Only reliable for writers that rename completed files into
+    place, as raspistill does.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._seen_filenames = set(list_relative_file_paths(directory))
+
+    def read_closed_filenames(self, timeout):
+        time.sleep(timeout)
+        filenames = set(list_relative_file_paths(self._directory))
+        new_filenames = sorted(filenames - self._seen_filenames)
+        self._seen_filenames = filenames
+        return new_filenames
+
+    def close(self):
+        pass
+
+
+def get_closed_file_watcher(directory):
+    """ Get a watcher for files completed in `directory`: inotify-based where available, otherwise polling-based.
+    Both have a `read_closed_filenames(timeout)` method and a `close()` method.
+    """
+    try:
+        return InotifyClosedFileWatcher(directory)
+    except (AttributeError, OSError) as error:
+        # AttributeError: libc has no inotify functions on this OS
+        logging.warning(f"inotify unavailable ({error}); polling {directory} instead")
+        return PollingClosedFileWatcher(directory)
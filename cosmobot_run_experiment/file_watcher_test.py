@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from . import file_watcher as module
+
+
+def _write_then_rename(directory, filename):
+    temp_path = os.path.join(directory, f"{filename}~")
+    with open(temp_path, "w") as temp_file:
+        temp_file.write("image data")
+    os.rename(temp_path, os.path.join(directory, filename))
+
+
+class TestInotifyClosedFileWatcher:
+    def test_reports_closed_and_renamed_files(self, tmp_path):
+        watcher = module.InotifyClosedFileWatcher(str(tmp_path))
+
+        (tmp_path / "written.yml").write_text("metadata")
+        _write_then_rename(str(tmp_path), "renamed.jpeg")
+
+        filenames = watcher.read_closed_filenames(timeout=1)
+        watcher.close()
+
+        assert filenames == ["written.yml", "renamed.jpeg~", "renamed.jpeg"]
+
+    def test_reports_files_in_new_subdirectories(self, tmp_path):
+        watcher = module.InotifyClosedFileWatcher(str(tmp_path))
+
+        shard_directory = tmp_path / "2019-01-01" / "12"
+        shard_directory.mkdir(parents=True)
+        _write_then_rename(str(shard_directory), "first.jpeg")
+
+        filenames = []
+        while "2019-01-01/12/first.jpeg" not in filenames:
+            new_filenames = watcher.read_closed_filenames(timeout=1)
+            assert new_filenames, "timed out"
+            filenames.extend(new_filenames)
+
+        _write_then_rename(str(shard_directory), "second.jpeg")
+        filenames.extend(watcher.read_closed_filenames(timeout=1))
+        watcher.close()
+
+        assert "2019-01-01/12/second.jpeg" in filenames
+
+    def test_times_out_with_no_files(self, tmp_path):
+        watcher = module.InotifyClosedFileWatcher(str(tmp_path))
+
+        assert watcher.read_closed_filenames(timeout=0.01) == []
+        watcher.close()
+
+    def test_blows_up_on_missing_directory(self, tmp_path):
+        with pytest.raises(OSError):
+            module.InotifyClosedFileWatcher(str(tmp_path / "nope"))
+
+
+class TestPollingClosedFileWatcher:
+    def test_reports_only_new_files(self, tmp_path):
+        (tmp_path / "existing.yml").write_text("metadata")
+        watcher = module.PollingClosedFileWatcher(str(tmp_path))
+
+        _write_then_rename(str(tmp_path), "renamed.jpeg")
+
+        assert watcher.read_closed_filenames(timeout=0) == ["renamed.jpeg"]
+        assert watcher.read_closed_filenames(timeout=0) == []
+
+    def test_reports_files_in_subdirectories(self, tmp_path):
+        watcher = module.PollingClosedFileWatcher(str(tmp_path))
+
+        (tmp_path / "2019-01-01" / "12").mkdir(parents=True)
+        _write_then_rename(str(tmp_path / "2019-01-01" / "12"), "sharded.jpeg")
+
+        assert watcher.read_closed_filenames(timeout=0) == [
+            os.path.join("2019-01-01", "12", "sharded.jpeg")
+        ]
+
+
+class TestGetClosedFileWatcher:
+    def test_falls_back_to_polling_without_inotify(self, mocker, tmp_path):
+        mocker.patch.object(
+            module, "InotifyClosedFileWatcher", side_effect=AttributeError
+        )
+
+        watcher = module.get_closed_file_watcher(str(tmp_path))
+
+        assert isinstance(watcher, module.PollingClosedFileWatcher)
@@ -1,9 +1,228 @@
+import argparse
+import ctypes
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
 from picamraw import PiRawBayer, PiCameraVersion
+from picamraw.constants import BAYER_ORDER_TO_RGB_CHANNEL_COORDINATES
+from picamraw.main import (
+    BROADCOM_BAYER_ORDER_TO_ENUM,
+    HEADER_BYTE_OFFSET,
+    PIXEL_BYTE_OFFSET,
+    RAW_BLOCK_SIZE_BY_VERSION_AND_MODE,
+    BroadcomRawHeader,
+    bayer_array_to_rgb,
+)
+from picamraw.resolution import PiResolution
+
+from .file_structure import get_files_with_extension
 
 RAW_BIT_DEPTH = 2 ** 10
+JPEG_BIT_DEPTH = 2 ** 8
+
+# libjpeg can decode at 1/2, 1/4 or 1/8 scale, skipping most of the work of a full decode
+DEFAULT_JPEG_PREVIEW_SCALE = 8
+
+# raspistill is always run with the V2 camera's full-resolution sensor mode
+RAW_BLOCK_SIZE = RAW_BLOCK_SIZE_BY_VERSION_AND_MODE[PiCameraVersion.V2][0]
+
+# Default ceiling on the working memory used to process one band of rows of a raw image
+DEFAULT_BAND_MEMORY_LIMIT = 16 * 1024 * 1024
+# Bytes of working memory per bayer value in a band: the unpacked uint16 value, unpacking scratch space, and the
+# copies analysis makes of it (e.g. per-channel ravels and sums)
+_BAND_BYTES_PER_VALUE = 8
+
+
+def unpack_10bit_values(packed_rows):
+    """ Unpack rows of packed 10-bit values, where every 5 bytes hold the high 8 bits of 4 values followed by the low
+    2 bits of all 4 (see https://linuxtv.org/downloads/v4l-dvb-apis-new/uapi/v4l/pixfmt-srggb10p.html)
+
+    Args:
+        packed_rows: 2D uint8 numpy array with a multiple of 5 bytes per row
+    Returns:
+        2D uint16 numpy array with 4 values for every 5 bytes in each row
+    """
+    height, packed_width = packed_rows.shape
+    unpacked = np.empty((height, packed_width // 5 * 4), dtype=np.uint16)
+
+    # Work through the 5-byte groups one "column" at a time, all in place: the 4 high bytes become every 4th value,
+    # and the low bits are shifted down through a single copy of the 5th bytes
+    low_bytes = packed_rows[:, 4::5].copy()
+    low_bits = np.empty_like(low_bytes)
+    for index in range(4):
+        values = unpacked[:, index::4]
+        np.left_shift(packed_rows[:, index::5], 2, out=values, dtype=np.uint16)
+        np.bitwise_and(low_bytes, 0b11, out=low_bits)
+        values |= low_bits
+        low_bytes >>= 2
+    return unpacked
+
+
+class MappedRawBayer:
+    """ The raw bayer data from a JPEG+RAW file, memory-mapped rather than read into memory.
+
+    A drop-in for picamraw's `PiRawBayer` (`bayer_array`, `bayer_order`, `to_rgb()`), except that nothing is read from
+    the file until pixel data is asked for: `packed_rows` is a zero-copy view of the packed 10-bit data, cropped to
+    the image, so unpacking some of its rows only pages in those rows.
+    """
+
+    def __init__(self, raw_image_path):
+        """
+        Args:
+            raw_image_path: The full path to the JPEG+RAW file
+        """
+        # The raw block is at the end of the file, after the JPEG
+        self._raw_block = np.memmap(raw_image_path, dtype=np.uint8, mode="r")[
+            -RAW_BLOCK_SIZE:
+        ]
+        if self._raw_block[:4].tobytes() != b"BRCM":
+            raise ValueError(f"Unable to locate Bayer data at end of {raw_image_path}")
+
+        header_end = HEADER_BYTE_OFFSET + ctypes.sizeof(BroadcomRawHeader)
+        header = BroadcomRawHeader.from_buffer_copy(
+            self._raw_block[HEADER_BYTE_OFFSET:header_end]
+        )
+        self.bayer_order = BROADCOM_BAYER_ORDER_TO_ENUM[header.bayer_order]
+
+        # Rows are padded on the right and bottom; see picamraw's _pixel_bytes_to_array()
+        padded_shape = PiResolution(
+            ((header.width + header.padding_right) * 5 + 3) // 4,
+            header.height + header.padding_down,
+        ).pad()
+        self.packed_rows = self._raw_block[PIXEL_BYTE_OFFSET:].reshape(
+            padded_shape.height, padded_shape.width
+        )[: header.height, : header.width * 5 // 4]
+
+    @property
+    def shape(self):
+        """ (height, width) of the unpacked bayer array """
+        height, packed_width = self.packed_rows.shape
+        return height, packed_width // 5 * 4
+
+    def unpack_rows(self, start, stop):
+        """ Unpack rows [start, stop) of the bayer array, touching only those rows of the file """
+        return unpack_10bit_values(self.packed_rows[start:stop])
+
+    @property
+    def bayer_array(self):
+        """ The whole image as a 2D uint16 array of 10-bit values. Unpacked afresh on every access """
+        return unpack_10bit_values(self.packed_rows)
+
+    def to_rgb(self):
+        return bayer_array_to_rgb(self.bayer_array, self.bayer_order)
+
+
+def as_raw_bayer(raw_image_path):
+    """ Extracts the raw bayer data from a JPEG+RAW file, without converting it
+
+    Args:
+        raw_image_path: The full path to the JPEG+RAW file
+
+    Returns:
+        A `MappedRawBayer`: 10-bit values in a 2D uint16 `bayer_array`, and its `bayer_order`
+    """
+    return MappedRawBayer(raw_image_path)
+
+
+def get_bayer_shape(raw_bayer):
+    """ (height, width) of a raw image's bayer array, without unpacking it if it's a MappedRawBayer """
+    if isinstance(raw_bayer, MappedRawBayer):
+        return raw_bayer.shape
+    return raw_bayer.bayer_array.shape
+
+
+def iterate_bayer_bands(raw_bayer, memory_limit=DEFAULT_BAND_MEMORY_LIMIT):
+    """ Yield a raw image's bayer array in bands of whole 2x2 bayer cells, each small enough to process within the
+        memory limit, so that peak memory doesn't grow with the resolution of the image. Each band starts on an even
+        row, so has the same bayer order as the whole image.
+
+    Args:
+        raw_bayer: a `MappedRawBayer` or picamraw `PiRawBayer`, e.g. from as_raw_bayer(). Bands of a MappedRawBayer
+            are unpacked one at a time; a `PiRawBayer` is already unpacked, so its bands are views
+        memory_limit: Optional. Approximate ceiling, in bytes, on the working memory used for each band
+    Yields:
+        (start row, 2D uint16 array of 10-bit values for the rows of the band)
+    """
+    height, width = get_bayer_shape(raw_bayer)
+    band_height = max(2, memory_limit // (width * _BAND_BYTES_PER_VALUE) // 2 * 2)
+
+    for start in range(0, height, band_height):
+        stop = min(start + band_height, height)
+        if isinstance(raw_bayer, MappedRawBayer):
+            yield start, raw_bayer.unpack_rows(start, stop)
+        else:
+            yield start, raw_bayer.bayer_array[start:stop]
+
+
+def sample_bayer_cell_rows(raw_bayer, cell_row_step):
+    """ Every `cell_row_step`th row of 2x2 bayer cells of a raw image, e.g. for quick statistics of a whole image. Of
+        a MappedRawBayer, only those rows are read from the file and unpacked.
+
+    Args:
+        raw_bayer: a `MappedRawBayer` or picamraw `PiRawBayer`, e.g. from as_raw_bayer()
+        cell_row_step: take one row of cells out of this many
+    Returns:
+        2D uint16 array of 10-bit values, with the same bayer order as the whole image
+    """
+    height, _ = get_bayer_shape(raw_bayer)
+    cell_starts = np.arange(0, height - 1, 2 * cell_row_step)
+    rows = np.stack([cell_starts, cell_starts + 1], axis=1).ravel()
+
+    if isinstance(raw_bayer, MappedRawBayer):
+        return unpack_10bit_values(raw_bayer.packed_rows[rows])
+    return raw_bayer.bayer_array[rows]
 
 
-def as_rgb(raw_image_path):
+def bayer_channels(bayer_array, bayer_order):
+    """ Views (not copies) of the red, both green, and blue sites of a bayer array, each 1/4 of its size """
+    ((ry, rx), (gy, gx), (Gy, Gx), (by, bx)) = BAYER_ORDER_TO_RGB_CHANNEL_COORDINATES[
+        bayer_order
+    ]
+    return (
+        bayer_array[ry::2, rx::2],
+        bayer_array[gy::2, gx::2],
+        bayer_array[Gy::2, Gx::2],
+        bayer_array[by::2, bx::2],
+    )
+
+
+def superpixel_rgb(
+    raw_bayer, dtype=np.float32, band_memory_limit=DEFAULT_BAND_MEMORY_LIMIT
+):
+    """ Combine each 2x2 R, G1, G2, B cell of a raw image into one [R, (G1 + G2) / 2, B] pixel, normalized into the
+        (0,1) range: the same `RGB Image` as picamraw's to_rgb() / RAW_BIT_DEPTH, built from strided views of the bayer
+        array straight into a single output array, with no intermediate full-size float arrays.
+
+    Args:
+        raw_bayer: a `MappedRawBayer` or picamraw `PiRawBayer`, e.g. from as_raw_bayer()
+        dtype: Optional. Float dtype of the result. float32 (the default) holds every value exactly, in half the
+            memory of float64
+        band_memory_limit: Optional. The bayer array is unpacked in bands (see iterate_bayer_bands()), so apart from
+            the result, memory use stays within this many bytes
+    Returns:
+        An `RGB Image` of half the width and height of the bayer array
+    """
+    height, width = get_bayer_shape(raw_bayer)
+    rgb_image = np.empty((height // 2, width // 2, 3), dtype=dtype)
+
+    for start, band in iterate_bayer_bands(raw_bayer, band_memory_limit):
+        red, green_1, green_2, blue = bayer_channels(band, raw_bayer.bayer_order)
+        # Each band starts on an even row, so its cells are rows start / 2 onwards of the RGB image
+        rgb_start, rgb_stop = start // 2, (start + len(band)) // 2
+        rgb_band = rgb_image[rgb_start:rgb_stop]
+        rgb_band[:, :, 0] = red
+        np.add(green_1, green_2, out=rgb_band[:, :, 1])
+        rgb_band[:, :, 1] /= 2
+        rgb_band[:, :, 2] = blue
+
+    rgb_image /= RAW_BIT_DEPTH
+    return rgb_image
+
+
+def as_rgb(raw_image_path, superpixel=False):
     """ Extracts the raw bayer data from a JPEG+RAW file and converts it to an
         `RGB Image` (see definition in README).
 
@@ -11,15 +230,117 @@ def as_rgb(raw_image_path):
 
     Args:
         raw_image_path: The full path to the JPEG+RAW file
+        superpixel: Optional. If True, build the image with superpixel_rgb(): identical values, as float32, in
+            about half the peak memory. Otherwise (the default) convert with picamraw, as process_experiment does
 
     Returns:
         An `RGB Image`
     """
-    raw_bayer = PiRawBayer(
-        filepath=raw_image_path, camera_version=PiCameraVersion.V2, sensor_mode=0
-    )
+    raw_bayer = as_raw_bayer(raw_image_path)
+
+    if superpixel:
+        return superpixel_rgb(raw_bayer)
 
     # Divide by the bit-depth of the raw data to normalize into the (0,1) range
     rgb_image = raw_bayer.to_rgb() / RAW_BIT_DEPTH
 
     return rgb_image
+
+
+def as_jpeg_preview_rgb(image_path, scale=DEFAULT_JPEG_PREVIEW_SCALE):
+    """ Decode the JPEG at the front of a JPEG+RAW file at reduced scale, into an RGB image normalized into the (0,1)
+        range. Much faster than reading the raw data, but the JPEG has been through the camera's processing (gamma,
+        color correction, compression), so it only approximates the `RGB Image`.
+
+    Args:
+        image_path: The full path to the JPEG+RAW file
+        scale: Optional. Decode at 1/scale of the full width and height; libjpeg supports 1, 2, 4 and 8
+    Returns:
+        3D float32 numpy array of shape (height, width, 3)
+    """
+    with Image.open(image_path) as image:
+        # draft() picks the smallest DCT scaling that is at least the requested size
+        image.draft("RGB", (image.width // scale, image.height // scale))
+        preview = np.asarray(image.convert("RGB"), dtype=np.float32)
+
+    # 8-bit values, each exact in float32
+    preview /= JPEG_BIT_DEPTH - 1
+    return preview
+
+
+def _read_with_picamraw(raw_image_path):
+    return PiRawBayer(
+        filepath=raw_image_path, camera_version=PiCameraVersion.V2, sensor_mode=0
+    ).bayer_array
+
+
+def _read_with_mmap(raw_image_path):
+    return as_raw_bayer(raw_image_path).bayer_array
+
+
+RAW_READERS = {"picamraw": _read_with_picamraw, "mmap": _read_with_mmap}
+
+
+def benchmark_raw_readers(image_paths, repeat=1):
+    """ Time extracting the bayer array from each image with each raw reader, and measure the peak memory allocated
+    while doing so
+
+    Args:
+        image_paths: full paths of JPEG+RAW files
+        repeat: number of times to read each image with each reader
+    Returns:
+        dict of {reader name: {"seconds_per_image": mean seconds, "peak_bytes": peak bytes allocated}}
+    """
+    results = {}
+    for reader_name, read in RAW_READERS.items():
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            for image_path in image_paths:
+                read(image_path)
+        elapsed_seconds = time.perf_counter() - start_time
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[reader_name] = {
+            "seconds_per_image": elapsed_seconds / (repeat * len(image_paths)),
+            "peak_bytes": peak_bytes,
+        }
+    return results
+
+
+def benchmark_raw_bayer(cli_args=None):
+    """ Compare raw readers on the JPEG+RAW images in a directory
+     Args:
+        cli_args: list of command-line-like argument strings such as sys.argv. if not provided, sys.argv[1:] is used
+     Returns:
+        None
+    """
+    if cli_args is None:
+        # First argument is the name of the command itself, not an "argument" we want to parse
+        cli_args = sys.argv[1:]
+
+    arg_parser = argparse.ArgumentParser(
+        description="Compare the speed and memory use of raw bayer readers"
+    )
+    arg_parser.add_argument(
+        "--directory", required=True, type=str, help="directory of JPEG+RAW images"
+    )
+    arg_parser.add_argument(
+        "--repeat",
+        required=False,
+        type=int,
+        default=3,
+        help="number of times to read each image with each reader",
+    )
+    args = arg_parser.parse_args(cli_args)
+
+    image_paths = get_files_with_extension(args.directory, ".jpeg")
+    results = benchmark_raw_readers(image_paths, args.repeat)
+
+    print(f"{'reader':<12}{'ms/image':>12}{'peak MB':>12}")
+    for reader_name, result in results.items():
+        print(
+            f"{reader_name:<12}{result['seconds_per_image'] * 1000:>12.1f}"
+            f"{result['peak_bytes'] / 1e6:>12.1f}"
+        )
@@ -0,0 +1,187 @@
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+from picamraw import PiRawBayer, PiCameraVersion
+from picamraw.constants import BayerOrder
+from picamraw.main import HEADER_BYTE_OFFSET, PIXEL_BYTE_OFFSET, BroadcomRawHeader
+
+from . import open as module
+
+# Full-resolution V2 images are 3280x2464, in rows padded to 4128 bytes, with 16 rows of padding at the bottom
+WIDTH, HEIGHT, PADDING_DOWN = 3280, 2464, 16
+PADDED_ROW_BYTES = 4128
+
+
+def _write_jpeg_plus_raw(
+    path,
+    bayer_order=BayerOrder.RGGB,
+    seed=0,
+    jpeg=b"\xff\xd8 not really a JPEG \xff\xd9",
+):
+    header = BroadcomRawHeader(
+        name=b"BRCM test",
+        width=WIDTH,
+        height=HEIGHT,
+        padding_right=0,
+        padding_down=PADDING_DOWN,
+        bayer_order={
+            order: index for index, order in module.BROADCOM_BAYER_ORDER_TO_ENUM.items()
+        }[bayer_order],
+    )
+    raw_block = bytearray(module.RAW_BLOCK_SIZE)
+    raw_block[:4] = b"BRCM"
+    header_end = HEADER_BYTE_OFFSET + len(bytes(header))
+    raw_block[HEADER_BYTE_OFFSET:header_end] = bytes(header)
+    pixel_byte_count = PADDED_ROW_BYTES * (HEIGHT + PADDING_DOWN)
+    raw_block[PIXEL_BYTE_OFFSET:] = (
+        np.random.default_rng(seed)
+        .integers(0, 256, pixel_byte_count, dtype=np.uint8)
+        .tobytes()
+    )
+
+    path.write_bytes(jpeg + raw_block)
+    return str(path)
+
+
+class TestUnpack10BitValues:
+    def test_unpacks_high_bits_then_low_bits(self):
+        packed_rows = np.array([[0b00000001, 0, 0, 0b11111111, 0b11100100]], np.uint8)
+
+        np.testing.assert_array_equal(
+            module.unpack_10bit_values(packed_rows), [[0b100, 0b01, 0b10, 0b1111111111]]
+        )
+
+
+class TestMappedRawBayer:
+    @pytest.mark.parametrize("bayer_order", list(BayerOrder))
+    def test_matches_picamraw(self, tmp_path, bayer_order):
+        image_path = _write_jpeg_plus_raw(tmp_path / "image.jpeg", bayer_order)
+
+        raw_bayer = module.as_raw_bayer(image_path)
+        expected = PiRawBayer(image_path, PiCameraVersion.V2, sensor_mode=0)
+
+        assert raw_bayer.bayer_order == expected.bayer_order
+        assert raw_bayer.shape == (HEIGHT, WIDTH)
+        np.testing.assert_array_equal(raw_bayer.bayer_array, expected.bayer_array)
+
+    def test_unpack_rows(self, tmp_path):
+        raw_bayer = module.as_raw_bayer(_write_jpeg_plus_raw(tmp_path / "image.jpeg"))
+
+        np.testing.assert_array_equal(
+            raw_bayer.unpack_rows(100, 116), raw_bayer.bayer_array[100:116]
+        )
+
+    def test_packed_rows_is_a_view_of_the_file(self, tmp_path):
+        raw_bayer = module.as_raw_bayer(_write_jpeg_plus_raw(tmp_path / "image.jpeg"))
+
+        assert isinstance(raw_bayer.packed_rows.base, np.memmap)
+        assert not raw_bayer.packed_rows.flags.owndata
+
+    def test_raises_if_no_raw_data(self, tmp_path):
+        image_path = tmp_path / "image.jpeg"
+        image_path.write_bytes(bytes(module.RAW_BLOCK_SIZE))
+
+        with pytest.raises(ValueError):
+            module.as_raw_bayer(str(image_path))
+
+
+class TestIterateBayerBands:
+    def test_bands_cover_image_in_whole_cells(self, tmp_path):
+        raw_bayer = module.as_raw_bayer(_write_jpeg_plus_raw(tmp_path / "image.jpeg"))
+
+        bands = list(module.iterate_bayer_bands(raw_bayer, memory_limit=1024 * 1024))
+
+        assert len(bands) > 1
+        assert all(start % 2 == 0 and len(band) % 2 == 0 for start, band in bands)
+        np.testing.assert_array_equal(
+            np.concatenate([band for _, band in bands]), raw_bayer.bayer_array
+        )
+
+    def test_memory_stays_within_limit(self, tmp_path):
+        raw_bayer = module.as_raw_bayer(_write_jpeg_plus_raw(tmp_path / "image.jpeg"))
+        memory_limit = 1024 * 1024
+
+        tracemalloc.start()
+        for _, band in module.iterate_bayer_bands(raw_bayer, memory_limit):
+            band.sum()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert peak_bytes < memory_limit
+
+    def test_bands_of_unpacked_bayer_array_are_views(self):
+        raw_bayer = SimpleNamespace(
+            bayer_array=np.zeros((8, 4), dtype=np.uint16), bayer_order=BayerOrder.RGGB
+        )
+
+        bands = list(module.iterate_bayer_bands(raw_bayer, memory_limit=1))
+
+        assert [start for start, _ in bands] == [0, 2, 4, 6]
+        assert all(band.base is raw_bayer.bayer_array for _, band in bands)
+
+
+class TestSampleBayerCellRows:
+    def test_mapped_raw_matches_unpacked_rows(self, tmp_path):
+        raw_bayer = module.as_raw_bayer(_write_jpeg_plus_raw(tmp_path / "image.jpeg"))
+        sampled_rows = [row for row in range(HEIGHT) if row % 16 < 2]
+        expected = raw_bayer.bayer_array[sampled_rows]
+
+        np.testing.assert_array_equal(
+            module.sample_bayer_cell_rows(raw_bayer, cell_row_step=8), expected
+        )
+
+    def test_unpacked_bayer_array(self):
+        raw_bayer = SimpleNamespace(
+            bayer_array=np.arange(12 * 2).reshape(12, 2), bayer_order=BayerOrder.RGGB
+        )
+
+        sample = module.sample_bayer_cell_rows(raw_bayer, cell_row_step=2)
+
+        np.testing.assert_array_equal(sample, raw_bayer.bayer_array[[0, 1, 4, 5, 8, 9]])
+
+
+class TestSuperpixelRgb:
+    @pytest.mark.parametrize("bayer_order", list(BayerOrder))
+    def test_matches_picamraw_rgb_image(self, tmp_path, bayer_order):
+        image_path = _write_jpeg_plus_raw(tmp_path / "image.jpeg", bayer_order)
+
+        rgb_image = module.as_rgb(image_path, superpixel=True)
+
+        assert rgb_image.dtype == np.float32
+        assert rgb_image.shape == (HEIGHT // 2, WIDTH // 2, 3)
+        np.testing.assert_array_equal(rgb_image, module.as_rgb(image_path))
+
+    def test_bands_match_whole_image(self, tmp_path):
+        raw_bayer = module.as_raw_bayer(_write_jpeg_plus_raw(tmp_path / "image.jpeg"))
+
+        np.testing.assert_array_equal(
+            module.superpixel_rgb(raw_bayer, band_memory_limit=1024 * 1024),
+            module.superpixel_rgb(raw_bayer, band_memory_limit=1024 * 1024 * 1024),
+        )
+
+
+def test_as_jpeg_preview_rgb(tmp_path):
+    jpeg_path = tmp_path / "preview.jpeg"
+    Image.new("RGB", (256, 128), (255, 128, 0)).save(jpeg_path, quality=100)
+    image_path = _write_jpeg_plus_raw(
+        tmp_path / "image.jpeg", jpeg=jpeg_path.read_bytes()
+    )
+
+    preview = module.as_jpeg_preview_rgb(image_path)
+
+    assert preview.shape == (16, 32, 3)
+    np.testing.assert_allclose(
+        preview, np.full((16, 32, 3), [1, 128 / 255, 0]), atol=0.01
+    )
+
+
+def test_benchmark_raw_readers(tmp_path):
+    image_path = _write_jpeg_plus_raw(tmp_path / "image.jpeg")
+
+    results = module.benchmark_raw_readers([image_path])
+
+    assert set(results) == {"picamraw", "mmap"}
+    assert all(result["seconds_per_image"] > 0 for result in results.values())
@@ -15,8 +15,19 @@ from cosmobot_run_experiment.camera import (
     DEFAULT_ISO,
     DEFAULT_WARM_UP_TIME,
 )
+from .auto_exposure import DEFAULT_AUTO_EXPOSURE_BOUNDS, AutoExposureBounds
 from .file_structure import iso_datetime_for_filename, get_base_output_path
-from .s3 import list_experiments
+from .scheduler import CATCH_UP, OVERRUN_POLICIES
+from .staging import get_staging_directory_path
+from .sync_manager import PERIODIC_SYNC, SYNC_MODES
+from .s3 import (
+    get_indexed_experiment_directory_name,
+    list_experiments_cached,
+    record_experiment_directory_name,
+)
+
+# Local copy of the s3 experiment listing, kept in the base output directory (see list_experiments_cached())
+EXPERIMENT_LISTING_CACHE_FILENAME = ".s3_experiment_listing.json"
 
 ExperimentConfiguration = namedtuple(
     "ExperimentConfiguration",
@@ -34,8 +45,17 @@ ExperimentConfiguration = namedtuple(
         "hostname",  # hostname of the device the experient was executed on
         "mac",  # mac address
         "skip_sync",  # whether to skip syncing to s3
-        "erase_synced_files",  # whether to erase the local experiment folder after synced to s3
+        "erase_synced_files",  # whether to erase each local file once its upload to s3 has been verified
         "review_exposure",  # review exposure statistics after experiment finishes and do not sync to s3)
+        "persistent_camera",  # keep one raspistill process open between captures instead of one per image
+        "overrun_policy",  # what to do when a capture cycle takes longer than the interval
+        "sync_mode",  # how files are synced to s3 during the experiment
+        "upload_bandwidth_limit",  # maximum upload rate during the experiment in bytes per second, or None
+        "pause_uploads_during_capture",  # whether uploads pause while each image is being captured
+        "auto_exposure",  # AutoExposureBounds to auto-expose each variant within, or None to keep variants as given
+        "staging_directory_path",  # directory to capture images into before they're moved to the experiment directory
+        "evict_synced_files",  # whether to erase the oldest files already on s3 when space runs low instead of stopping
+        "shard_by_hour",  # whether to save images in a directory per hour (<YYYY-MM-DD>/<HH>/) of the experiment dir
     ],
 )
 
@@ -145,7 +165,8 @@ def _parse_args(args):
     arg_parser.add_argument(
         "--erase-synced-files",
         action="store_true",
-        help="If provided, uses s3 mv to erase files after sync is completed.",
+        help="If provided, erases each file as soon as its upload to s3 has been verified by size and checksum,"
+        " and removes the experiment directory at the end.",
     )
 
     arg_parser.add_argument(
@@ -154,6 +175,103 @@ def _parse_args(args):
         help="optionally review exposure at the end of the experiment",
     )
 
+    arg_parser.add_argument(
+        "--persistent-camera",
+        action="store_true",
+        help="If provided, keeps a single raspistill process open between captures instead of starting one per image."
+        " Camera warm-up is then only paid when the session starts or when camera settings change between variants.",
+    )
+
+    arg_parser.add_argument(
+        "--overrun-policy",
+        choices=OVERRUN_POLICIES,
+        default=CATCH_UP,
+        help="What to do when capturing all variants takes longer than --interval:\n"
+        "  catch-up: run missed captures back-to-back until back on schedule (default)\n"
+        "  skip: drop missed captures and wait for the next scheduled time\n"
+        "  stretch: capture again immediately and shift the rest of the schedule later",
+    )
+
+    arg_parser.add_argument(
+        "--sync-mode",
+        choices=SYNC_MODES,
+        default=PERIODIC_SYNC,
+        help="How to sync files to s3 while the experiment is running:\n"
+        "  periodic: sync the whole experiment directory after each capture (default)\n"
+        "  watch: upload each file exactly once, as soon as it has been written",
+    )
+
+    arg_parser.add_argument(
+        "--upload-bandwidth-limit",
+        type=float,
+        default=None,
+        help="Maximum rate, in kilobytes per second, to upload to s3 at while the experiment is running."
+        " The final sync at the end of the experiment is not limited. Defaults to unlimited.",
+    )
+
+    arg_parser.add_argument(
+        "--pause-uploads-during-capture",
+        action="store_true",
+        help="If provided, uploads to s3 pause while each image is being captured and resume in between,"
+        " so that they don't compete with raspistill for CPU, SD card and bus bandwidth.",
+    )
+
+    arg_parser.add_argument(
+        "--auto-exposure",
+        action="store_true",
+        help="If provided, adjusts the exposure time (and, once that reaches its maximum, the ISO) of each variant"
+        " after every interval, based on the exposure of the variant's latest image. Every adjustment is logged to"
+        " an *_auto_exposure.log file in the experiment directory. With --persistent-camera, the camera restarts"
+        " (and warms up again) whenever a variant's settings change.",
+    )
+    arg_parser.add_argument(
+        "--auto-exposure-exposure-time-range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=[
+            DEFAULT_AUTO_EXPOSURE_BOUNDS.min_exposure_time,
+            DEFAULT_AUTO_EXPOSURE_BOUNDS.max_exposure_time,
+        ],
+        help="Range of exposure times, in seconds, that --auto-exposure may use. Default: %(default)s",
+    )
+    arg_parser.add_argument(
+        "--auto-exposure-iso-range",
+        type=int,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=[
+            DEFAULT_AUTO_EXPOSURE_BOUNDS.min_iso,
+            DEFAULT_AUTO_EXPOSURE_BOUNDS.max_iso,
+        ],
+        help="Range of ISOs that --auto-exposure may use. Default: %(default)s",
+    )
+
+    arg_parser.add_argument(
+        "--staging-directory",
+        default=None,
+        help="If provided, images are captured into a directory (named after the experiment directory) under this"
+        " path, and moved to the experiment directory in large batches by a background process. Use a fast volume,"
+        " e.g. a tmpfs mount, to cut capture write latency and wear on the SD card. Files are synced from whichever"
+        " directory they are in with --sync-mode watch; periodic syncs only pick them up once moved.",
+    )
+
+    arg_parser.add_argument(
+        "--evict-synced-files",
+        action="store_true",
+        help="If provided, whenever free space runs low, a background process erases the oldest files in the"
+        " experiment directory that are confirmed to be on s3, to make room instead of ending the experiment. Files"
+        " that haven't been synced are never erased: the experiment still ends if they fill the disk.",
+    )
+
+    arg_parser.add_argument(
+        "--shard-by-hour",
+        action="store_true",
+        help="If provided, images are saved in a directory per hour (<YYYY-MM-DD>/<HH>/) within the experiment"
+        " directory, so that long experiments don't end up with tens of thousands of files in one directory."
+        " Images are still synced to the top level of the experiment directory on s3.",
+    )
+
     # There could be arguments passed in that we want to ignore (e.g. led color, intensity)
     # parse_known_args and arg namespace is used to only utilize args that we care about in the prepare module.
     experiment_arg_namespace, _ = arg_parser.parse_known_args(args)
@@ -263,6 +381,21 @@ def get_experiment_variants(args):
     return variants or [DEFAULT_VARIANT]
 
 
+def get_auto_exposure_bounds(args):
+    """ AutoExposureBounds from parsed arguments, or None if --auto-exposure wasn't provided """
+    if not args["auto_exposure"]:
+        return None
+
+    min_exposure_time, max_exposure_time = args["auto_exposure_exposure_time_range"]
+    min_iso, max_iso = args["auto_exposure_iso_range"]
+    return AutoExposureBounds(
+        min_exposure_time=min_exposure_time,
+        max_exposure_time=max_exposure_time,
+        min_iso=min_iso,
+        max_iso=max_iso,
+    )
+
+
 def _get_mac_address():
     integer_mac_address = get_mac()  # Returns as an integer
     hex_mac_address = hex(integer_mac_address).upper()
@@ -273,14 +406,26 @@ def _get_mac_last_4():
     return _get_mac_address()[-4:]
 
 
+def _get_pi_experiment_name(name):
+    return f"Pi{_get_mac_last_4()}-{name}"
+
+
 def _get_most_recent_experiment_directory_name(pi_experiment_name):
     """Get most recent experiment directory name from S3 matching the given pi_experiment_name
 
+    Looks in the experiment index first. Experiments from before the index existed are found in the (locally cached)
+    listing of the whole bucket.
+
     Returns the first matching experiment directory if one exists, otherwise returns None.
     """
+    indexed_directory = get_indexed_experiment_directory_name(pi_experiment_name)
+    if indexed_directory:
+        return indexed_directory
 
-    # list_experiments() returns the directory names sorted by descending date
-    sorted_directories = list_experiments()
+    # list_experiments_cached() returns the directory names sorted by descending date
+    sorted_directories = list_experiments_cached(
+        os.path.join(get_base_output_path(), EXPERIMENT_LISTING_CACHE_FILENAME)
+    )
 
     matching_directories = [
         directory
@@ -322,12 +467,11 @@ def get_experiment_configuration(cli_args):
     duration = args["duration"]
     start_date = datetime.now()
     mac_address = _get_mac_address()
-    mac_last_4 = _get_mac_last_4()
 
     name = args["name"]
     group_results = args["group_results"]
 
-    pi_experiment_name = f"Pi{mac_last_4}-{name}"
+    pi_experiment_name = _get_pi_experiment_name(name)
 
     experiment_directory_path = _get_experiment_directory_path(
         group_results, pi_experiment_name, start_date
@@ -351,6 +495,25 @@ def get_experiment_configuration(cli_args):
         skip_sync=args["skip_sync"],
         erase_synced_files=args["erase_synced_files"],
         review_exposure=args["review_exposure"],
+        persistent_camera=args["persistent_camera"],
+        overrun_policy=args["overrun_policy"],
+        sync_mode=args["sync_mode"],
+        upload_bandwidth_limit=(
+            None
+            if args["upload_bandwidth_limit"] is None
+            else args["upload_bandwidth_limit"] * 1000
+        ),
+        pause_uploads_during_capture=args["pause_uploads_during_capture"],
+        auto_exposure=get_auto_exposure_bounds(args),
+        staging_directory_path=(
+            None
+            if args["staging_directory"] is None
+            else get_staging_directory_path(
+                args["staging_directory"], experiment_directory_path
+            )
+        ),
+        evict_synced_files=args["evict_synced_files"],
+        shard_by_hour=args["shard_by_hour"],
     )
 
     return experiment_configuration
@@ -363,6 +526,8 @@ def create_file_structure_for_experiment(configuration):
         )
     )
     os.makedirs(configuration.experiment_directory_path, exist_ok=True)
+    if configuration.staging_directory_path:
+        os.makedirs(configuration.staging_directory_path, exist_ok=True)
 
     metadata_filename = "{iso_ish_datetime}_experiment_metadata.yml".format(
         iso_ish_datetime=iso_datetime_for_filename(configuration.start_date)
@@ -375,6 +540,16 @@ def create_file_structure_for_experiment(configuration):
         yaml.dump(configuration._asdict(), metadata_file, default_flow_style=False)
 
 
+def record_experiment_directory(configuration):
+    """Record the experiment directory in the s3 experiment index, so that later runs of the same experiment on this
+    device can find it quickly with --group-results
+    """
+    record_experiment_directory_name(
+        _get_pi_experiment_name(configuration.name),
+        os.path.basename(configuration.experiment_directory_path),
+    )
+
+
 def hostname_is_correct(hostname):
     """Does hostname follow the pattern we expect pi-cam-[last four of MAC]
      Args:
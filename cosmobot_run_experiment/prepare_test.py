@@ -44,6 +44,17 @@ class TestParseArgs:
             "review_exposure": False,
             "erase_synced_files": False,
             "group_results": False,
+            "persistent_camera": False,
+            "overrun_policy": "catch-up",
+            "sync_mode": "periodic",
+            "upload_bandwidth_limit": None,
+            "pause_uploads_during_capture": False,
+            "auto_exposure": False,
+            "auto_exposure_exposure_time_range": [0.0001, 6],
+            "auto_exposure_iso_range": [100, 800],
+            "staging_directory": None,
+            "evict_synced_files": False,
+            "shard_by_hour": False,
         }
         assert module._parse_args(args_in) == expected_args_out
 
@@ -69,6 +80,31 @@ class TestParseArgs:
             module._parse_args(args_in)
 
 
+class TestGetAutoExposureBounds:
+    def test_none_unless_auto_exposure(self):
+        args = module._parse_args(["--name", "thebest", "--interval", "500"])
+
+        assert module.get_auto_exposure_bounds(args) is None
+
+    def test_bounds_from_ranges(self):
+        args = module._parse_args(
+            [
+                "--name",
+                "thebest",
+                "--interval",
+                "500",
+                "--auto-exposure",
+                "--auto-exposure-iso-range",
+                "100",
+                "400",
+            ]
+        )
+
+        assert module.get_auto_exposure_bounds(args) == module.AutoExposureBounds(
+            min_exposure_time=0.0001, max_exposure_time=6, min_iso=100, max_iso=400
+        )
+
+
 def test_get_mac_address(mocker):
     mocker.patch.object(module, "get_mac").return_value = 141726673902100
 
@@ -190,7 +226,9 @@ class TestGetExperimentVariants:
 
 class TestCreateFileStructureForExperiment:
     MockExperimentConfiguration = namedtuple(
-        "MockExperimentConfiguration", ["experiment_directory_path", "start_date"]
+        "MockExperimentConfiguration",
+        ["experiment_directory_path", "start_date", "staging_directory_path"],
+        defaults=[None],
     )
 
     subdir_name = "subdirectory"
@@ -233,6 +271,15 @@ class TestCreateFileStructureForExperiment:
             "1988-09-01--00-00-00_experiment_metadata.yml"
         ]
 
+    def test_creates_staging_directory_if_provided(self, mocker, tmp_path):
+        mock_config = self._create_mock_configuration(mocker, tmp_path)._replace(
+            staging_directory_path=os.path.join(tmp_path, "staging", self.subdir_name)
+        )
+
+        module.create_file_structure_for_experiment(mock_config)
+
+        assert os.path.isdir(mock_config.staging_directory_path)
+
 
 class TestParseVariant:
     def test_doesnt_explode_on_deprecated_parameters(self):
@@ -269,7 +316,14 @@ class TestParseVariant:
 
 @pytest.fixture
 def mock_list_experiments(mocker):
-    return mocker.patch.object(module, "list_experiments")
+    return mocker.patch.object(module, "list_experiments_cached")
+
+
+@pytest.fixture
+def mock_get_indexed_experiment_directory_name(mocker):
+    return mocker.patch.object(
+        module, "get_indexed_experiment_directory_name", return_value=None
+    )
 
 
 @pytest.fixture
@@ -280,6 +334,26 @@ def mock_get_base_output_path(mocker):
 
 
 class TestGetExperimentDirectoryPath:
+    @pytest.fixture(autouse=True)
+    def mock_index(self, mock_get_indexed_experiment_directory_name):
+        return mock_get_indexed_experiment_directory_name
+
+    def test_uses_indexed_dir_name_for_group_results(
+        self, mock_get_base_output_path, mock_list_experiments, mock_index
+    ):
+        pi_experiment_name = "Pi1234-cool_experiment"
+        mock_index.return_value = f"date3-{pi_experiment_name}"
+
+        actual_path = module._get_experiment_directory_path(
+            True, pi_experiment_name, sentinel.start_date
+        )
+
+        assert actual_path == os.path.join(
+            "base-output-path", f"date3-{pi_experiment_name}"
+        )
+        mock_index.assert_called_once_with(pi_experiment_name)
+        mock_list_experiments.assert_not_called()
+
     def test_uses_matching_dir_name_for_group_results(
         self, mock_get_base_output_path, mock_list_experiments
     ):
@@ -298,6 +372,9 @@ class TestGetExperimentDirectoryPath:
         )
         expected_path = os.path.join("base-output-path", f"date2-{pi_experiment_name}")
         assert actual_path == expected_path
+        mock_list_experiments.assert_called_once_with(
+            os.path.join("base-output-path", module.EXPERIMENT_LISTING_CACHE_FILENAME)
+        )
 
     def test_generates_dir_name_when_no_matching_directory_for_group_results(
         self, mock_get_base_output_path, mock_list_experiments
@@ -385,6 +462,15 @@ class TestGetExperimentConfiguration:
             group_results=False,
             review_exposure=False,
             skip_sync=False,
+            persistent_camera=False,
+            overrun_policy="catch-up",
+            sync_mode="periodic",
+            upload_bandwidth_limit=None,
+            pause_uploads_during_capture=False,
+            auto_exposure=None,
+            staging_directory_path=None,
+            evict_synced_files=False,
+            shard_by_hour=False,
         )
 
         assert actual == expected
@@ -1,46 +1,149 @@
+import datetime
+import fnmatch
+import json
 import os
 import logging
-from subprocess import check_call
+import time
+from concurrent.futures import as_completed
 from typing import List
 
 import boto
+import boto.utils
 
 from . import file_structure
+from .exposure_cache import EXPOSURE_CACHE_PATTERNS
+from .file_watcher import list_relative_file_paths
+from .s3_uploader import S3Uploader, connect_to_s3
+from .sync_manifest import SYNC_MANIFEST_PATTERNS, SyncManifest, is_confirmed_synced
+from .upload_queue import UploadQueue
 
 
 CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME = "camera-sensor-experiments"
 
+# Bookkeeping files kept in experiment directories, which are never synced
+LOCAL_ONLY_PATTERNS = SYNC_MANIFEST_PATTERNS + EXPOSURE_CACHE_PATTERNS
 
-def sync_to_s3(local_sync_dir, additional_sync_params="", erase_synced_files=False):
+# One small object per Pi experiment name (e.g. "Pi1234-cool_experiment") containing the name of the most recent
+# experiment directory for it. Doesn't start with a date, so list_experiments() never mistakes it for an experiment
+EXPERIMENT_INDEX_PREFIX = "experiment-index/"
+
+# How long a local copy of list_experiments() is reused for (see list_experiments_cached())
+EXPERIMENT_LISTING_CACHE_MAX_AGE = 60 * 60
+
+
+def is_excluded(relative_path, exclude_patterns):
+    """ Does a relative path match any of these fnmatch-style patterns? """
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in exclude_patterns)
+
+
+def _needs_upload(local_file_path, remote_key):
+    """ Match `aws s3 sync`: upload if the remote file is missing, a different size, or older than the local one """
+    if remote_key is None:
+        return True
+
+    local_stat = os.stat(local_file_path)
+    # s3 only tracks modified time to the second
+    local_modified = datetime.datetime.utcfromtimestamp(int(local_stat.st_mtime))
+    remote_modified = boto.utils.parse_ts(remote_key.last_modified)
+    return local_stat.st_size != remote_key.size or local_modified > remote_modified
+
+
+def sync_to_s3(
+    local_sync_dir, exclude_patterns=(), erase_synced_files=False, governor=None
+):
     """ Syncs raw images from a local directory to the s3://camera-sensor-experiments bucket
 
+    Uploads happen in-process on a pool of reused connections (see S3Uploader) rather than through the aws cli.
+    What has already been uploaded is tracked in a SyncManifest in the directory, so s3 is only listed the first time
+    a directory is synced (to seed the manifest). Files that fail to upload are added to the directory's UploadQueue
+    so that they are retried even if this is the last sync of the experiment.
+
     Args:
         local_sync_dir: The full path of the directory to sync locally
-        additional_sync_params: Additional parameters to send to aws s3 cli command
-        erase_synced_files: If True, use aws s3 mv command to erase files after sync
+        exclude_patterns: fnmatch-style patterns of paths (relative to local_sync_dir) not to sync, like aws cli's
+            --exclude
+        erase_synced_files: If True, erase each file as soon as its upload has been verified by size and checksum
+            against the object on s3 (files synced earlier are verified too, and uploaded again if they don't match).
+            The manifest and other local-only files are removed once nothing else is left in the directory.
+        governor: Optional. UploadGovernor to pace uploads with
 
     Returns:
        None
     """
-
-    # Using CLI vs boto: https://github.com/boto/boto3/issues/358
-    # It looks like sync is not a supported function of the python boto library
-    # Work around is to use cli sync for now (requires aws cli to be installed)
     logging.info(f"Performing sync of experiments directory: {local_sync_dir}")
     experiment_dir_name = os.path.basename(os.path.normpath(local_sync_dir))
-    s3_subcommand = "mv --recursive" if erase_synced_files else "sync"
+    prefix = f"{experiment_dir_name}/"
+    exclude_patterns = list(exclude_patterns) + LOCAL_ONLY_PATTERNS
 
-    # This argument pattern issues a uni-directional sync to S3 bucket
-    # https://docs.aws.amazon.com/cli/latest/reference/s3/sync.html or
-    # https://docs.aws.amazon.com/cli/latest/reference/s3/mv.html
-    s3_sync_dir = f"s3://camera-sensor-experiments/{experiment_dir_name}"
+    failed_paths = []
+    with SyncManifest(local_sync_dir) as manifest, UploadQueue(
+        local_sync_dir
+    ) as upload_queue, S3Uploader(
+        CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME, governor=governor
+    ) as uploader:
+        remote_keys = uploader.list_keys(prefix) if manifest.is_new else {}
 
-    command = (
-        f"/home/pi/.local/bin/aws s3 {s3_subcommand} {local_sync_dir} "
-        f"{s3_sync_dir} {additional_sync_params}"
-    )
-    logging.info(command)
-    check_call(command, shell=True)
+        uploads = {}
+        for relative_path in list_relative_file_paths(local_sync_dir):
+            if is_excluded(relative_path, exclude_patterns):
+                continue
+
+            local_file_path = os.path.join(local_sync_dir, relative_path)
+            # Sharded experiments are flat on s3 (see file_structure.unshard_relative_path())
+            remote_relative_path = file_structure.unshard_relative_path(relative_path)
+            key_name = f"{prefix}{remote_relative_path}"
+            if not manifest.is_synced(relative_path, os.stat(local_file_path)):
+                # Maybe uploaded before the manifest existed
+                if not _needs_upload(
+                    local_file_path, remote_keys.get(remote_relative_path)
+                ):
+                    manifest.record_uploaded(relative_path, local_file_path)
+
+            is_synced = is_confirmed_synced(
+                manifest,
+                uploader,
+                relative_path,
+                local_file_path,
+                key_name,
+                verify=erase_synced_files,
+            )
+            if not is_synced:
+                upload = uploader.submit(
+                    local_file_path, key_name, verify=erase_synced_files
+                )
+                uploads[upload] = relative_path
+                continue
+
+            if erase_synced_files:
+                os.remove(local_file_path)
+
+        for upload in as_completed(uploads):
+            relative_path = uploads[upload]
+            local_file_path = os.path.join(local_sync_dir, relative_path)
+            try:
+                upload.result()
+            except Exception as exception:
+                logging.error(f"Failed to upload {local_file_path}: {exception}")
+                failed_paths.append(local_file_path)
+                upload_queue.add(relative_path)
+                continue
+
+            manifest.record_uploaded(relative_path, local_file_path)
+            upload_queue.remove(relative_path)
+            if erase_synced_files:
+                os.remove(local_file_path)
+
+    if failed_paths:
+        raise RuntimeError(f"{len(failed_paths)} file(s) failed to sync to s3")
+
+    if erase_synced_files:
+        remaining_paths = list_relative_file_paths(local_sync_dir)
+        if all(
+            is_excluded(relative_path, LOCAL_ONLY_PATTERNS)
+            for relative_path in remaining_paths
+        ):
+            for relative_path in remaining_paths:
+                os.remove(os.path.join(local_sync_dir, relative_path))
 
 
 # COPY-PASTA: from cosmobot-process-experiment
@@ -57,7 +160,7 @@ def list_camera_sensor_experiments_s3_bucket_contents(
         list of key names under the prefix provided.
     """
     try:
-        s3 = boto.connect_s3()
+        s3 = connect_to_s3()
     except boto.exception.NoAuthHandlerFound:  # type: ignore
         print(
             "You must have aws credentials already saved, e.g. via `aws configure`. \n"
@@ -94,3 +197,62 @@ def list_experiments():
     experiment_names = [directory.rstrip("/") for directory in experiment_directories]
 
     return _experiment_list_by_isodate_format_date_desc(experiment_names)
+
+
+def get_indexed_experiment_directory_name(pi_experiment_name):
+    """ Look up the most recent experiment directory for a Pi experiment name in the experiment index, with a single
+    request no matter how big the bucket is.
+
+    Returns:
+        the experiment directory name, or None if there is no index entry (e.g. for experiments from before the index
+        existed)
+    """
+    bucket = connect_to_s3().get_bucket(
+        CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME, validate=False
+    )
+    key = bucket.get_key(f"{EXPERIMENT_INDEX_PREFIX}{pi_experiment_name}")
+    return None if key is None else key.get_contents_as_string().decode().strip()
+
+
+def record_experiment_directory_name(pi_experiment_name, experiment_directory_name):
+    """ Point the experiment index entry for a Pi experiment name at an experiment directory """
+    bucket = connect_to_s3().get_bucket(
+        CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME, validate=False
+    )
+    key = bucket.new_key(f"{EXPERIMENT_INDEX_PREFIX}{pi_experiment_name}")
+    key.set_contents_from_string(experiment_directory_name)
+
+
+def list_experiments_cached(cache_path, max_age=EXPERIMENT_LISTING_CACHE_MAX_AGE):
+    """ list_experiments(), reusing the result saved in a local cache file if it is less than max_age seconds old
+
+    Args:
+        cache_path: path of the local cache file. Created (or refreshed) when it is missing or too old
+        max_age: Optional. Maximum age of the cache file, in seconds
+    Returns:
+        list of experiment names, as list_experiments()
+    """
+    try:
+        if time.time() - os.path.getmtime(cache_path) < max_age:
+            with open(cache_path) as cache_file:
+                return json.load(cache_file)
+    except (OSError, ValueError):
+        # Missing or unreadable: just list again
+        pass
+
+    experiment_names = list_experiments()
+
+    # Write to a temporary file and rename, so an interrupted write never leaves a truncated cache behind
+    temporary_cache_path = f"{cache_path}~"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(temporary_cache_path, "w") as cache_file:
+            json.dump(experiment_names, cache_file)
+        os.replace(temporary_cache_path, cache_path)
+    except OSError as exception:
+        # The cache only saves listing s3 again next time
+        logging.warning(
+            f"Couldn't cache experiment listing at {cache_path}: {exception}"
+        )
+
+    return experiment_names
@@ -1,80 +1,277 @@
+import os
+
 import pytest
 
+from .exposure_cache import EXPOSURE_CACHE_FILENAME
+from .sync_manifest import SYNC_MANIFEST_FILENAME
 from . import s3 as module
 
 
 @pytest.fixture
-def mock_check_call(mocker):
-    mock_check_call = mocker.patch.object(module, "check_call")
-    mock_check_call.return_value = None
-
-    return mock_check_call
+def experiment_directory(tmp_path):
+    experiment_directory = tmp_path / "experiment_name"
+    experiment_directory.mkdir()
+    (experiment_directory / "image.jpeg").write_bytes(b"image data")
+    (experiment_directory / "experiment.log").write_text("log data")
+    return experiment_directory
 
 
-@pytest.fixture
-def mock_path_basename(mocker):
-    mock_path_basename = mocker.patch("os.path.basename")
-    mock_path_basename.return_value = "experiment_name"
-    return mock_path_basename
+def _key_names(bucket):
+    return sorted(key.name for key in bucket.list())
 
 
 class TestSyncToS3:
     def test_syncs_to_subdirectory_in_s3_bucket(
-        self, mocker, mock_check_call, mock_path_basename
+        self, s3_stand_in, experiment_directory
+    ):
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+
+        assert _key_names(s3_stand_in) == [
+            "experiment_name/experiment.log",
+            "experiment_name/image.jpeg",
+        ]
+
+    def test_syncs_nested_directories(self, s3_stand_in, experiment_directory):
+        (experiment_directory / "subdirectory").mkdir()
+        (experiment_directory / "subdirectory" / "nested.jpeg").write_text("hi")
+
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+
+        assert "experiment_name/subdirectory/nested.jpeg" in _key_names(s3_stand_in)
+
+    def test_syncs_shard_directories_flat(self, s3_stand_in, experiment_directory):
+        (experiment_directory / "2019-01-01" / "12").mkdir(parents=True)
+        (experiment_directory / "2019-01-01" / "12" / "sharded.jpeg").write_text("hi")
+
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+
+        assert "experiment_name/sharded.jpeg" in _key_names(s3_stand_in)
+
+    def test_excludes_patterns(self, s3_stand_in, experiment_directory):
+        module.sync_to_s3(
+            local_sync_dir=str(experiment_directory), exclude_patterns=["*.log*"]
+        )
+
+        assert _key_names(s3_stand_in) == ["experiment_name/image.jpeg"]
+
+    def test_never_syncs_exposure_cache(self, s3_stand_in, experiment_directory):
+        (experiment_directory / EXPOSURE_CACHE_FILENAME).write_bytes(b"cache")
+
+        module.sync_to_s3(
+            local_sync_dir=str(experiment_directory), erase_synced_files=True
+        )
+
+        assert _key_names(s3_stand_in) == [
+            "experiment_name/experiment.log",
+            "experiment_name/image.jpeg",
+        ]
+        assert list(experiment_directory.iterdir()) == []
+
+    def test_skips_files_already_synced(
+        self, mocker, s3_stand_in, experiment_directory
+    ):
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+        (experiment_directory / "new.jpeg").write_bytes(b"new image")
+        upload_spy = mocker.spy(module.S3Uploader, "upload_file")
+
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+
+        uploaded_paths = [call[0][1] for call in upload_spy.call_args_list]
+        assert uploaded_paths == [str(experiment_directory / "new.jpeg")]
+
+    def test_erase_synced_files_moves_files(self, s3_stand_in, experiment_directory):
+        module.sync_to_s3(
+            local_sync_dir=str(experiment_directory), erase_synced_files=True
+        )
+
+        assert _key_names(s3_stand_in) == [
+            "experiment_name/experiment.log",
+            "experiment_name/image.jpeg",
+        ]
+        assert list(experiment_directory.iterdir()) == []
+
+    def test_erase_doesnt_reupload_files_in_manifest(
+        self, mocker, s3_stand_in, experiment_directory
+    ):
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+        upload_spy = mocker.spy(module.S3Uploader, "upload_file")
+
+        module.sync_to_s3(
+            local_sync_dir=str(experiment_directory), erase_synced_files=True
+        )
+
+        assert upload_spy.call_count == 0
+        assert list(experiment_directory.iterdir()) == []
+
+    def test_erase_reuploads_files_in_manifest_that_dont_match_s3(
+        self, mocker, s3_stand_in, experiment_directory
     ):
-        module.sync_to_s3(local_sync_dir="/output_dir/experiment_name")
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+        s3_stand_in.new_key("experiment_name/image.jpeg").set_contents_from_string(
+            b"corrupted"
+        )
+        upload_spy = mocker.spy(module.S3Uploader, "upload_file")
 
-        expected_command = (
-            "/home/pi/.local/bin/aws s3 sync /output_dir/experiment_name "
-            "s3://camera-sensor-experiments/experiment_name "
+        module.sync_to_s3(
+            local_sync_dir=str(experiment_directory), erase_synced_files=True
+        )
+
+        uploaded_paths = [call[0][1] for call in upload_spy.call_args_list]
+        assert uploaded_paths == [str(experiment_directory / "image.jpeg")]
+        assert (
+            s3_stand_in.get_key("experiment_name/image.jpeg").get_contents_as_string()
+            == b"image data"
         )
-        mock_check_call.assert_called_with(expected_command, shell=True)
+        assert list(experiment_directory.iterdir()) == []
 
-    def test_syncs_to_subdirectory_in_s3_bucket_with_additional_sync_params(
-        self, mocker, mock_check_call, mock_path_basename
+    def test_erase_keeps_manifest_while_excluded_files_remain(
+        self, s3_stand_in, experiment_directory
     ):
         module.sync_to_s3(
-            local_sync_dir="/output_dir/experiment_name",
-            additional_sync_params="--exclude *.log*",
+            local_sync_dir=str(experiment_directory),
+            exclude_patterns=["*.log*"],
+            erase_synced_files=True,
+        )
+
+        assert sorted(path.name for path in experiment_directory.iterdir()) == [
+            SYNC_MANIFEST_FILENAME,
+            "experiment.log",
+        ]
+
+        module.sync_to_s3(
+            local_sync_dir=str(experiment_directory), erase_synced_files=True
+        )
+
+        assert list(experiment_directory.iterdir()) == []
+
+    def test_only_lists_s3_to_seed_new_manifest(
+        self, mocker, s3_stand_in, experiment_directory
+    ):
+        list_keys_spy = mocker.spy(module.S3Uploader, "list_keys")
+
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+
+        assert list_keys_spy.call_count == 1
+
+    def test_seeds_manifest_from_files_already_on_s3(
+        self, mocker, s3_stand_in, experiment_directory
+    ):
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+        os.remove(experiment_directory / SYNC_MANIFEST_FILENAME)
+        upload_spy = mocker.spy(module.S3Uploader, "upload_file")
+
+        module.sync_to_s3(local_sync_dir=str(experiment_directory))
+
+        assert upload_spy.call_count == 0
+        with module.SyncManifest(str(experiment_directory)) as manifest:
+            assert manifest.get_entry("image.jpeg")["status"] == "uploaded"
+
+    def test_failed_uploads_blow_up_and_arent_erased(
+        self, mocker, s3_stand_in, experiment_directory
+    ):
+        mocker.patch.object(module.S3Uploader, "upload_file").side_effect = Exception(
+            "no network"
+        )
+
+        with pytest.raises(RuntimeError):
+            module.sync_to_s3(
+                local_sync_dir=str(experiment_directory), erase_synced_files=True
+            )
+
+        assert (experiment_directory / "image.jpeg").exists()
+        assert (experiment_directory / "experiment.log").exists()
+
+
+class TestExperimentIndex:
+    def test_missing_entry(self, s3_stand_in):
+        assert module.get_indexed_experiment_directory_name("Pi1234-cool") is None
+
+    def test_recorded_entry(self, s3_stand_in):
+        module.record_experiment_directory_name(
+            "Pi1234-cool", "2019-01-01--00-00-00-Pi1234-cool"
+        )
+        module.record_experiment_directory_name(
+            "Pi1234-cool", "2019-01-02--00-00-00-Pi1234-cool"
         )
 
-        expected_command = (
-            "/home/pi/.local/bin/aws s3 sync /output_dir/experiment_name "
-            "s3://camera-sensor-experiments/experiment_name --exclude *.log*"
+        assert (
+            module.get_indexed_experiment_directory_name("Pi1234-cool")
+            == "2019-01-02--00-00-00-Pi1234-cool"
         )
-        mock_check_call.assert_called_with(expected_command, shell=True)
+
+    def test_index_isnt_listed_as_an_experiment(self, s3_stand_in):
+        module.record_experiment_directory_name(
+            "Pi1234-cool", "2019-01-01--00-00-00-Pi1234-cool"
+        )
+
+        assert module.list_experiments() == []
+
+
+class TestListExperimentsCached:
+    def test_reuses_fresh_cache(self, mocker, tmp_path):
+        mock_list_experiments = mocker.patch.object(
+            module, "list_experiments", return_value=["2019-01-01--00-00-00-Pi1234-a"]
+        )
+        cache_path = str(tmp_path / "cache.json")
+
+        first = module.list_experiments_cached(cache_path)
+        second = module.list_experiments_cached(cache_path)
+
+        assert first == second == ["2019-01-01--00-00-00-Pi1234-a"]
+        assert mock_list_experiments.call_count == 1
+
+    def test_refreshes_stale_cache(self, mocker, tmp_path):
+        mock_list_experiments = mocker.patch.object(
+            module, "list_experiments", side_effect=[["old"], ["new"]]
+        )
+        cache_path = str(tmp_path / "cache.json")
+        module.list_experiments_cached(cache_path)
+
+        assert module.list_experiments_cached(cache_path, max_age=0) == ["new"]
+        assert mock_list_experiments.call_count == 2
+
+    def test_ignores_corrupt_cache(self, mocker, tmp_path):
+        mocker.patch.object(module, "list_experiments", return_value=["listed"])
+        cache_path = tmp_path / "cache.json"
+        cache_path.write_text("not json")
+
+        assert module.list_experiments_cached(str(cache_path)) == ["listed"]
+
+    def test_base_path_doesnt_exist(self, mocker, tmp_path):
+        mocker.patch.object(module, "list_experiments", return_value=["listed"])
+        cache_path = tmp_path / "not_created_yet" / "cache.json"
+
+        assert module.list_experiments_cached(str(cache_path)) == ["listed"]
+
+    def test_cache_cant_be_written(self, mocker, tmp_path):
+        mocker.patch.object(module, "list_experiments", return_value=["listed"])
+        (tmp_path / "a_file").write_text("not a directory")
+        cache_path = tmp_path / "a_file" / "cache.json"
+
+        assert module.list_experiments_cached(str(cache_path)) == ["listed"]
+
+
+class TestNeedsUpload:
+    def test_missing_remote_file(self, tmp_path):
+        assert module._needs_upload(str(tmp_path), None)
 
     @pytest.mark.parametrize(
-        "test_name, erase_synced_files, expected_command",
+        "test_name, remote_size, remote_last_modified, expected",
         [
-            (
-                "mv",
-                True,
-                "/home/pi/.local/bin/aws s3 mv --recursive /output_dir/experiment_name "
-                "s3://camera-sensor-experiments/experiment_name ",
-            ),
-            (
-                "sync",
-                False,
-                "/home/pi/.local/bin/aws s3 sync /output_dir/experiment_name "
-                "s3://camera-sensor-experiments/experiment_name ",
-            ),
+            ("same size, remote newer", 10, "2100-01-01T00:00:00.000Z", False),
+            ("different size", 11, "2100-01-01T00:00:00.000Z", True),
+            ("remote older", 10, "2000-01-01T00:00:00.000Z", True),
         ],
     )
-    def test_s3_subcommand(
-        self,
-        test_name,
-        erase_synced_files,
-        expected_command,
-        mocker,
-        mock_check_call,
-        mock_path_basename,
+    def test_compares_size_and_modified_time(
+        self, mocker, tmp_path, test_name, remote_size, remote_last_modified, expected
     ):
-        module.sync_to_s3(
-            local_sync_dir="/output_dir/experiment_name",
-            erase_synced_files=erase_synced_files,
-        )
-        mock_check_call.assert_called_with(expected_command, shell=True)
+        local_file_path = tmp_path / "image.jpeg"
+        local_file_path.write_bytes(b"0123456789")
+        remote_key = mocker.Mock(size=remote_size, last_modified=remote_last_modified)
+
+        assert module._needs_upload(str(local_file_path), remote_key) == expected
 
 
 # COPY-PASTA from cosmobot-process-experiment
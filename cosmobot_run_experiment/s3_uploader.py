@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+import boto
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.utils import compute_md5
+
+from .upload_governor import GovernedFile
+
+# Set to e.g. "http://localhost:5000" to talk to a local S3 stand-in server instead of AWS
+S3_ENDPOINT_ENVIRONMENT_VARIABLE = "COSMOBOT_S3_ENDPOINT"
+
+DEFAULT_UPLOAD_WORKERS = 4
+
+# S3 requires every part of a multipart upload except the last to be at least 5MB
+MULTIPART_THRESHOLD_BYTES = 8 * 1024 * 1024
+MULTIPART_CHUNK_BYTES = 8 * 1024 * 1024
+
+_READ_CHUNK_BYTES = 1024 * 1024
+
+
+def connect_to_s3():
+    """ Open a boto S3 connection, to AWS or to the endpoint in the COSMOBOT_S3_ENDPOINT environment variable
+    """
+    endpoint = os.environ.get(S3_ENDPOINT_ENVIRONMENT_VARIABLE)
+    if not endpoint:
+        return boto.connect_s3()
+
+    parsed_endpoint = urlparse(endpoint)
+    return boto.connect_s3(
+        host=parsed_endpoint.hostname,
+        port=parsed_endpoint.port,
+        is_secure=parsed_endpoint.scheme == "https",
+        calling_format=OrdinaryCallingFormat(),
+    )
+
+
+def _md5_digest(local_file, size):
+    md5 = hashlib.md5()
+    while size > 0:
+        chunk = local_file.read(min(_READ_CHUNK_BYTES, size))
+        if not chunk:
+            break
+        md5.update(chunk)
+        size -= len(chunk)
+    return md5.digest()
+
+
+def compute_expected_etag(local_file_path):
+    """ The ETag s3 gives an object uploaded from this file by S3Uploader: the md5 of the file for single-part
+    uploads; for multipart uploads, the md5 of the concatenated md5s of each part followed by "-<part count>"
+    """
+    file_size = os.path.getsize(local_file_path)
+    with open(local_file_path, "rb") as local_file:
+        if file_size < MULTIPART_THRESHOLD_BYTES:
+            return _md5_digest(local_file, file_size).hex()
+
+        part_digests = [
+            _md5_digest(local_file, MULTIPART_CHUNK_BYTES)
+            for _ in range(0, file_size, MULTIPART_CHUNK_BYTES)
+        ]
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+class S3Uploader:
+    """ Uploads files to an S3 bucket from a bounded pool of threads.
+
+    boto connections aren't thread-safe, so each worker thread opens one connection the first time it uploads and
+    keeps reusing it (along with its open HTTPS connection) for every later upload. Large files are sent as
+    multipart uploads so that a dropped connection only costs one part. If given an UploadGovernor, every chunk read
+    from a file passes through it, so uploads can be paused and rate-limited mid-file.
+
+    Use as a context manager so the pool is shut down (after waiting for queued uploads) when done:
+        with S3Uploader("bucket-name") as uploader:
+            future = uploader.submit("/local/file.jpeg", "prefix/file.jpeg")
+    """
+
+    def __init__(self, bucket_name, max_workers=DEFAULT_UPLOAD_WORKERS, governor=None):
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.governor = governor
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread_local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _get_bucket(self):
+        """ Get this thread's bucket object, connecting on first use """
+        if not hasattr(self._thread_local, "bucket"):
+            connection = connect_to_s3()
+            # validate=False skips a request to check that the bucket exists
+            self._thread_local.bucket = connection.get_bucket(
+                self.bucket_name, validate=False
+            )
+        return self._thread_local.bucket
+
+    def list_keys(self, prefix):
+        """ List keys under a prefix
+
+        Returns:
+            dict of {key name with the prefix removed: boto Key}
+        """
+        prefix_length = len(prefix)
+        return {
+            key.name[prefix_length:]: key for key in self._get_bucket().list(prefix)
+        }
+
+    def is_uploaded(self, local_file_path, key_name):
+        """ Does the object at key_name match the local file, by size and ETag (checksum)?
+        """
+        key = self._get_bucket().get_key(key_name)
+        return (
+            key is not None
+            and key.size == os.path.getsize(local_file_path)
+            and key.etag.strip('"') == compute_expected_etag(local_file_path)
+        )
+
+    def upload_file(self, local_file_path, key_name, verify=False):
+        """ Upload a file in the calling thread, using multipart upload for large files
+
+        Args:
+            local_file_path: full path of the file to upload
+            key_name: key to upload to within the bucket
+            verify: If True, check that the uploaded object matches the local file (see is_uploaded()) afterwards
+        Returns:
+            None
+        """
+        self._upload_file(local_file_path, key_name)
+
+        if verify and not self.is_uploaded(local_file_path, key_name):
+            raise RuntimeError(
+                f"s3://{self.bucket_name}/{key_name} doesn't match {local_file_path} after upload"
+            )
+
+    def _upload_file(self, local_file_path, key_name):
+        file_size = os.path.getsize(local_file_path)
+        logging.info(
+            f"Uploading {local_file_path} to s3://{self.bucket_name}/{key_name}"
+        )
+
+        bucket = self._get_bucket()
+        with open(local_file_path, "rb") as local_file:
+            if file_size < MULTIPART_THRESHOLD_BYTES:
+                self._send(
+                    bucket.new_key(key_name).set_contents_from_file,
+                    local_file,
+                    file_size,
+                )
+                return
+
+            multipart_upload = bucket.initiate_multipart_upload(key_name)
+            try:
+                for part_index, offset in enumerate(
+                    range(0, file_size, MULTIPART_CHUNK_BYTES)
+                ):
+                    self._send(
+                        partial(
+                            multipart_upload.upload_part_from_file,
+                            part_num=part_index + 1,
+                        ),
+                        local_file,
+                        min(MULTIPART_CHUNK_BYTES, file_size - offset),
+                    )
+                multipart_upload.complete_upload()
+            except Exception:
+                multipart_upload.cancel_upload()
+                raise
+
+    def _send(self, send_function, local_file, size):
+        """ Send `size` bytes from the current position of `local_file` with a boto set_contents_from_file()-like
+        function, through the governor if there is one
+        """
+        if self.governor is None:
+            send_function(local_file, size=size)
+            return
+
+        # boto would otherwise read through the governed file once just to compute the checksum
+        md5_hex, md5_base64, _ = compute_md5(local_file, size=size)
+        send_function(
+            GovernedFile(local_file, self.governor),
+            md5=(md5_hex, md5_base64),
+            size=size,
+        )
+
+    def submit(self, local_file_path, key_name, verify=False):
+        """ Queue a file to be uploaded (and optionally verified, see upload_file()) by the thread pool
+
+        Returns:
+            concurrent.futures.Future that resolves once the upload completes (or raises if it fails)
+        """
+        return self._executor.submit(
+            self.upload_file, local_file_path, key_name, verify
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
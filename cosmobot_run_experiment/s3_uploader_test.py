@@ -0,0 +1,146 @@
+import pytest
+
+from . import s3_uploader as module
+
+
+@pytest.fixture
+def uploader(s3_stand_in):
+    with module.S3Uploader(s3_stand_in.name, max_workers=2) as uploader:
+        yield uploader
+
+
+class TestConnectToS3:
+    def test_uses_endpoint_from_environment(self, monkeypatch):
+        monkeypatch.setenv(
+            module.S3_ENDPOINT_ENVIRONMENT_VARIABLE, "http://localhost:5000"
+        )
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "stand-in")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "stand-in")
+
+        connection = module.connect_to_s3()
+
+        assert connection.host == "localhost"
+        assert connection.port == 5000
+        assert not connection.is_secure
+
+
+class TestS3Uploader:
+    def test_uploads_small_file(self, uploader, s3_stand_in, tmp_path):
+        local_file_path = tmp_path / "image.jpeg"
+        local_file_path.write_bytes(b"image data")
+
+        uploader.submit(str(local_file_path), "experiment/image.jpeg").result()
+
+        key = s3_stand_in.get_key("experiment/image.jpeg")
+        assert key.get_contents_as_string() == b"image data"
+
+    def test_uploads_large_file_in_parts(self, mocker, uploader, s3_stand_in, tmp_path):
+        # S3 requires parts (other than the last) to be at least 5MB
+        part_size = 5 * 1024 * 1024
+        mocker.patch.object(module, "MULTIPART_THRESHOLD_BYTES", part_size)
+        mocker.patch.object(module, "MULTIPART_CHUNK_BYTES", part_size)
+        contents = b"a" * part_size + b"the end"
+        local_file_path = tmp_path / "big.jpeg"
+        local_file_path.write_bytes(contents)
+
+        uploader.submit(str(local_file_path), "experiment/big.jpeg").result()
+
+        key = s3_stand_in.get_key("experiment/big.jpeg")
+        assert key.etag.endswith('-2"')  # Multipart ETags end with the part count
+        assert key.get_contents_as_string() == contents
+
+    def test_reuses_connection_per_thread(self, mocker, s3_stand_in, tmp_path):
+        connect_spy = mocker.spy(module, "connect_to_s3")
+        local_file_path = tmp_path / "image.jpeg"
+        local_file_path.write_bytes(b"image data")
+
+        with module.S3Uploader(s3_stand_in.name, max_workers=1) as uploader:
+            for index in range(3):
+                uploader.submit(str(local_file_path), f"experiment/{index}.jpeg")
+
+        assert connect_spy.call_count == 1
+        assert len(list(s3_stand_in.list("experiment/"))) == 3
+
+    def test_failed_upload_raises_from_future(self, uploader, tmp_path):
+        upload = uploader.submit(str(tmp_path / "missing.jpeg"), "experiment/x.jpeg")
+
+        with pytest.raises(OSError):
+            upload.result()
+
+    def test_lists_keys_relative_to_prefix(self, uploader, s3_stand_in):
+        s3_stand_in.new_key("experiment/image.jpeg").set_contents_from_string("hi")
+        s3_stand_in.new_key("other/image.jpeg").set_contents_from_string("hi")
+
+        assert list(uploader.list_keys("experiment/")) == ["image.jpeg"]
+
+    @pytest.mark.parametrize(
+        "threshold", [module.MULTIPART_THRESHOLD_BYTES, 5 * 1024 * 1024]
+    )
+    def test_governed_upload_reads_through_governor(
+        self, mocker, s3_stand_in, tmp_path, threshold
+    ):
+        part_size = 5 * 1024 * 1024
+        mocker.patch.object(module, "MULTIPART_THRESHOLD_BYTES", threshold)
+        mocker.patch.object(module, "MULTIPART_CHUNK_BYTES", part_size)
+        contents = b"a" * part_size + b"the end"
+        local_file_path = tmp_path / "big.jpeg"
+        local_file_path.write_bytes(contents)
+        governor = mocker.Mock()
+
+        with module.S3Uploader(s3_stand_in.name, governor=governor) as uploader:
+            uploader.submit(str(local_file_path), "experiment/big.jpeg").result()
+
+        assert (
+            s3_stand_in.get_key("experiment/big.jpeg").get_contents_as_string()
+            == contents
+        )
+        # Every byte is read through the governor exactly once
+        assert sum(
+            call_args[0][0] for call_args in governor.throttle.call_args_list
+        ) == len(contents)
+
+
+class TestVerification:
+    @pytest.mark.parametrize("size", [10, 5 * 1024 * 1024 + 7])
+    def test_expected_etag_matches_s3(
+        self, mocker, uploader, s3_stand_in, tmp_path, size
+    ):
+        part_size = 5 * 1024 * 1024
+        mocker.patch.object(module, "MULTIPART_THRESHOLD_BYTES", part_size)
+        mocker.patch.object(module, "MULTIPART_CHUNK_BYTES", part_size)
+        local_file_path = tmp_path / "image.jpeg"
+        local_file_path.write_bytes(
+            bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+        )
+
+        uploader.submit(
+            str(local_file_path), "experiment/image.jpeg", verify=True
+        ).result()
+
+        assert s3_stand_in.get_key("experiment/image.jpeg").etag.strip(
+            '"'
+        ) == module.compute_expected_etag(str(local_file_path))
+
+    def test_is_uploaded__missing_or_different(self, uploader, s3_stand_in, tmp_path):
+        local_file_path = tmp_path / "image.jpeg"
+        local_file_path.write_bytes(b"image data")
+
+        assert not uploader.is_uploaded(str(local_file_path), "experiment/image.jpeg")
+
+        s3_stand_in.new_key("experiment/image.jpeg").set_contents_from_string(
+            b"other data"
+        )
+        assert not uploader.is_uploaded(str(local_file_path), "experiment/image.jpeg")
+
+        uploader.upload_file(str(local_file_path), "experiment/image.jpeg")
+        assert uploader.is_uploaded(str(local_file_path), "experiment/image.jpeg")
+
+    def test_verify_failure_raises(self, mocker, uploader, tmp_path):
+        mocker.patch.object(module.S3Uploader, "is_uploaded", return_value=False)
+        local_file_path = tmp_path / "image.jpeg"
+        local_file_path.write_bytes(b"image data")
+
+        with pytest.raises(RuntimeError):
+            uploader.upload_file(
+                str(local_file_path), "experiment/image.jpeg", verify=True
+            )
@@ -0,0 +1,136 @@
+import logging
+import math
+import time
+from collections import namedtuple
+
+
+# What to do when a capture cycle takes longer than the interval and the next cycle's start time has already passed:
+# CATCH_UP runs every missed cycle back-to-back until the schedule is caught up
+# SKIP drops missed cycles and waits for the next cycle start time still in the future
+# STRETCH starts the next cycle immediately and shifts all later cycle start times by the overrun
+CATCH_UP = "catch-up"
+SKIP = "skip"
+STRETCH = "stretch"
+OVERRUN_POLICIES = [CATCH_UP, SKIP, STRETCH]
+
+CycleTiming = namedtuple(
+    "CycleTiming",
+    [
+        "index",  # 0-based count of cycles run so far
+        "lateness",  # seconds between when the cycle was scheduled to start and when it actually started
+        "duration",  # seconds the cycle took to run
+        "skipped_cycles",  # number of scheduled cycles dropped after this one (only with the SKIP policy)
+    ],
+)
+
+
+class CaptureScheduler:
+    """ Schedules capture cycles every `interval` seconds against `time.monotonic`, which (unlike `datetime.now()`)
+    doesn't jump when NTP adjusts the wall clock.
+
+    Iterate over a scheduler to run cycles: each iteration sleeps until the next cycle start time and yields the
+    cycle index. Timing of each cycle is recorded once the loop body for that cycle completes.
+
+    Example:
+        for cycle_index in CaptureScheduler(interval=10, duration=60):
+            capture_all_variants()
+    """
+
+    def __init__(self, interval, duration=None, overrun_policy=CATCH_UP):
+        """
+        Args:
+            interval: seconds between the start of each cycle
+            duration: Optional. seconds after which no new cycles are started. If None, run indefinitely
+            overrun_policy: one of OVERRUN_POLICIES
+        """
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(
+                f"Unknown overrun policy {overrun_policy}. Expected one of {OVERRUN_POLICIES}"
+            )
+
+        self.interval = interval
+        self.duration = duration
+        self.overrun_policy = overrun_policy
+
+        self.cycle_count = 0
+        self.overrun_count = 0
+        self.skipped_cycle_count = 0
+        self.total_lateness = 0
+        self.max_lateness = 0
+        self.last_cycle_timing = None
+
+    def _next_start_time(self, start_time, now):
+        """ Determine when the cycle after the one scheduled at `start_time` should begin, per the overrun policy.
+
+        Returns:
+            tuple of (next start time, number of skipped cycles)
+        """
+        next_start_time = start_time + self.interval
+        if now <= next_start_time or self.overrun_policy == CATCH_UP:
+            return next_start_time, 0
+
+        if self.overrun_policy == STRETCH:
+            return now, 0
+
+        skipped_cycles = math.ceil((now - next_start_time) / self.interval)
+        return next_start_time + skipped_cycles * self.interval, skipped_cycles
+
+    def _record_cycle(self, cycle_timing):
+        self.last_cycle_timing = cycle_timing
+        self.cycle_count += 1
+        self.total_lateness += cycle_timing.lateness
+        self.max_lateness = max(self.max_lateness, cycle_timing.lateness)
+        self.skipped_cycle_count += cycle_timing.skipped_cycles
+
+        logging.info(
+            f"Capture cycle {cycle_timing.index} started {cycle_timing.lateness:.3f}s late"
+            f" and took {cycle_timing.duration:.3f}s"
+        )
+        if cycle_timing.duration > self.interval:
+            self.overrun_count += 1
+            logging.warning(
+                f"Capture cycle {cycle_timing.index} overran the {self.interval}s interval"
+                f" ({self.overrun_policy}: {cycle_timing.skipped_cycles} cycle(s) skipped)"
+            )
+
+    def __iter__(self):
+        scheduler_start_time = time.monotonic()
+        end_time = (
+            None if self.duration is None else scheduler_start_time + self.duration
+        )
+        next_start_time = scheduler_start_time
+
+        while end_time is None or next_start_time < end_time:
+            time.sleep(max(0, next_start_time - time.monotonic()))
+
+            cycle_start_time = time.monotonic()
+            if end_time is not None and cycle_start_time >= end_time:
+                return
+
+            yield self.cycle_count
+
+            cycle_end_time = time.monotonic()
+            following_start_time, skipped_cycles = self._next_start_time(
+                next_start_time, cycle_end_time
+            )
+            self._record_cycle(
+                CycleTiming(
+                    index=self.cycle_count,
+                    lateness=cycle_start_time - next_start_time,
+                    duration=cycle_end_time - cycle_start_time,
+                    skipped_cycles=skipped_cycles,
+                )
+            )
+            next_start_time = following_start_time
+
+    def log_summary(self):
+        """ Log how far behind schedule the cycles so far have run
+        """
+        mean_lateness = (
+            self.total_lateness / self.cycle_count if self.cycle_count else 0
+        )
+        logging.info(
+            f"Ran {self.cycle_count} capture cycle(s): mean lateness {mean_lateness:.3f}s,"
+            f" max lateness {self.max_lateness:.3f}s, {self.overrun_count} overrun(s),"
+            f" {self.skipped_cycle_count} skipped cycle(s)"
+        )
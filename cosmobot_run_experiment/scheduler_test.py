@@ -0,0 +1,92 @@
+import pytest
+
+from . import scheduler as module
+
+
+class FakeTime:
+    """ Stands in for the time module: sleep() advances monotonic() instantly """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(mocker):
+    fake_time = FakeTime()
+    mocker.patch.object(module, "time", fake_time)
+    return fake_time
+
+
+def _run_cycles(fake_time, scheduler, cycle_durations):
+    """ Run the scheduler, with each cycle taking the next duration from cycle_durations (the last duration repeats).
+    Returns the (relative) start time of each cycle """
+    start_time = fake_time.now
+    cycle_start_times = []
+    for cycle_index in scheduler:
+        cycle_start_times.append(round(fake_time.now - start_time, 6))
+        fake_time.now += cycle_durations[min(cycle_index, len(cycle_durations) - 1)]
+    return cycle_start_times
+
+
+class TestCaptureScheduler:
+    def test_blows_up_on_unknown_overrun_policy(self):
+        with pytest.raises(ValueError):
+            module.CaptureScheduler(interval=1, overrun_policy="panic")
+
+    def test_runs_on_interval_for_duration(self, fake_time):
+        scheduler = module.CaptureScheduler(interval=2, duration=7)
+
+        assert _run_cycles(fake_time, scheduler, [0.5]) == [0, 2, 4, 6]
+
+    def test_catch_up_runs_missed_cycles_back_to_back(self, fake_time):
+        scheduler = module.CaptureScheduler(
+            interval=2, duration=9, overrun_policy=module.CATCH_UP
+        )
+
+        assert _run_cycles(fake_time, scheduler, [5, 0.5, 0.5, 0.5]) == [
+            0,
+            5,
+            5.5,
+            6,
+            8,
+        ]
+
+    def test_skip_drops_missed_cycles(self, fake_time):
+        scheduler = module.CaptureScheduler(
+            interval=2, duration=9, overrun_policy=module.SKIP
+        )
+
+        assert _run_cycles(fake_time, scheduler, [5, 0.5]) == [0, 6, 8]
+        assert scheduler.skipped_cycle_count == 2
+
+    def test_stretch_shifts_schedule(self, fake_time):
+        scheduler = module.CaptureScheduler(
+            interval=2, duration=9, overrun_policy=module.STRETCH
+        )
+
+        assert _run_cycles(fake_time, scheduler, [5, 0.5]) == [0, 5, 7]
+
+    def test_records_lateness_and_duration(self, fake_time):
+        scheduler = module.CaptureScheduler(interval=2, duration=5)
+
+        _run_cycles(fake_time, scheduler, [3, 0.5])
+
+        assert scheduler.cycle_count == 3
+        assert scheduler.overrun_count == 1
+        assert scheduler.max_lateness == 1
+        assert scheduler.last_cycle_timing == module.CycleTiming(
+            index=2, lateness=0, duration=0.5, skipped_cycles=0
+        )
+
+    def test_unaffected_by_wall_clock(self, fake_time, mocker):
+        mock_datetime = mocker.patch("datetime.datetime")
+        mock_datetime.now.side_effect = Exception("Should not be using the wall clock")
+        scheduler = module.CaptureScheduler(interval=1, duration=2)
+
+        assert _run_cycles(fake_time, scheduler, [0.1]) == [0, 1]
@@ -0,0 +1,30 @@
+import sqlite3
+import threading
+
+
+class SqliteDatabase:
+    """ Base class for the small SQLite databases kept inside an experiment directory (e.g. the sync manifest).
+
+    Subclasses set SCHEMA to the statement that creates their table if it doesn't exist yet, and wrap each query in
+    `with self._lock:` (plus `self._connection` for writes) so that one instance is safe to share between threads.
+
+    Use as a context manager to close the database when done.
+    """
+
+    SCHEMA = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
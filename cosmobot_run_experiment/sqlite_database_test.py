@@ -0,0 +1,19 @@
+from . import sqlite_database as module
+
+
+class _Things(module.SqliteDatabase):
+    SCHEMA = "CREATE TABLE IF NOT EXISTS things (name TEXT PRIMARY KEY)"
+
+
+class TestSqliteDatabase:
+    def test_creates_table_once(self, tmp_path):
+        path = str(tmp_path / "things.sqlite3")
+
+        with _Things(path) as things:
+            with things._connection:
+                things._connection.execute("INSERT INTO things VALUES ('a')")
+
+        with _Things(path) as things:
+            rows = things._connection.execute("SELECT name FROM things").fetchall()
+
+        assert rows == [("a",)]
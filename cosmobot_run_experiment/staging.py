@@ -0,0 +1,302 @@
+import fnmatch
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+
+from .sync_manifest import SyncManifest
+
+# Move staged images to the bulk volume once this many bytes are waiting, so that the bulk volume (typically the SD
+# card) sees a few large sequential writes instead of one small write per image
+STAGING_BATCH_BYTES = 64 * 1024 * 1024
+# ...or once the oldest staged image has waited this long, so that slow experiments don't sit in the staging volume
+STAGING_MAX_BATCH_AGE = 60
+# Leave images in the staging volume for at least this long, so that whatever reads the latest images during the
+# experiment (auto-exposure, live exposure analysis) finds them there
+STAGED_FILE_MIN_AGE = 5
+# How often the mover checks the staging directory
+STAGING_POLL_INTERVAL = 1
+# Buffer size for copying images to the bulk volume
+STAGING_COPY_BUFFER_SIZE = 4 * 1024 * 1024
+# Once stopping, how many times in all to try moving whatever is left when it fails to move (e.g. bulk volume full)
+STAGING_FINAL_MOVE_ATTEMPTS = 3
+
+# Files still being written by raspistill (see sync_manager.TEMP_FILE_PATTERNS)
+_TEMP_FILE_PATTERNS = ["*~"]
+
+_MOVER_PROCESS = None
+_MOVER_STOP_EVENT = None
+_MOVER_DIRECTORIES = None
+
+
+def get_staging_directory_path(staging_base_path, experiment_directory_path):
+    """ Staging directory for an experiment: a directory named after the experiment directory, in the staging volume
+    """
+    experiment_directory_name = os.path.basename(
+        os.path.normpath(experiment_directory_path)
+    )
+    return os.path.join(staging_base_path, experiment_directory_name)
+
+
+def find_tiered_file(relative_path, directories):
+    """ Find a file that may be in any of several directories, e.g. an image that may or may not have been moved from
+    the staging directory to the experiment directory yet.
+
+    Args:
+        relative_path: path of the file relative to each directory
+        directories: directories to look in, in order
+    Returns:
+        path of the file in the first directory it's in. If it isn't in any, its path in the last directory
+    """
+    for directory in directories:
+        file_path = os.path.join(directory, relative_path)
+        if os.path.exists(file_path):
+            return file_path
+    return file_path
+
+
+def _list_staged_files(staging_directory):
+    """ Completed files in the staging directory (including in shard directories), oldest first
+
+    Returns:
+        list of (relative path, os.stat() result) tuples
+    """
+    staged_files = []
+    for directory_path, _, filenames in os.walk(staging_directory):
+        for filename in filenames:
+            if any(
+                fnmatch.fnmatch(filename, pattern) for pattern in _TEMP_FILE_PATTERNS
+            ):
+                continue
+            staged_path = os.path.join(directory_path, filename)
+            try:
+                file_stat = os.stat(staged_path)
+            except FileNotFoundError:
+                # e.g. erased after uploading straight from the staging directory
+                continue
+            staged_files.append(
+                (os.path.relpath(staged_path, staging_directory), file_stat)
+            )
+    return sorted(staged_files, key=lambda staged_file: staged_file[1].st_mtime)
+
+
+def _remove_empty_directories(directory):
+    """ Remove a directory and its subdirectories, leaving any that aren't empty """
+    for directory_path, _, _ in os.walk(directory, topdown=False):
+        try:
+            os.rmdir(directory_path)
+        except OSError:
+            # Not empty: e.g. raspistill was killed mid-capture and left a temp file
+            pass
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def move_staged_files(staging_directory, bulk_directory, filenames):
+    """ Move a batch of files from the staging directory to the bulk directory.
+
+    All files are copied (to "~" temp files, which syncing ignores) before a single flush to disk, and only then
+    renamed into place and erased from the staging directory. So every file is always in at least one of the two
+    directories, and is only ever complete in the bulk directory. If copying fails (e.g. the bulk volume is full), the
+    batch's temp files are removed and the error is raised, leaving every file in the staging directory.
+
+    Args:
+        staging_directory: directory to move files from
+        bulk_directory: directory to move files to
+        filenames: paths of the files to move, relative to the staging directory. They are moved to the same path
+            relative to the bulk directory
+    Returns:
+        number of bytes moved
+    """
+    copied_filenames = []
+    moved_bytes = 0
+    try:
+        for filename in filenames:
+            staged_path = os.path.join(staging_directory, filename)
+            temp_path = os.path.join(bulk_directory, f"{filename}~")
+            os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+            try:
+                with open(staged_path, "rb") as staged_file, open(
+                    temp_path, "wb"
+                ) as temp_file:
+                    shutil.copyfileobj(staged_file, temp_file, STAGING_COPY_BUFFER_SIZE)
+                # Keep the modified time, which the sync manifest and exposure cache use to recognize the file
+                shutil.copystat(staged_path, temp_path)
+            except FileNotFoundError:
+                # Erased from the staging directory after uploading straight from it: nothing left to move
+                _remove_if_exists(temp_path)
+                continue
+            except OSError:
+                _remove_if_exists(temp_path)
+                raise
+            copied_filenames.append(filename)
+            moved_bytes += os.path.getsize(temp_path)
+
+        os.sync()
+    except OSError:
+        # Don't leave partial copies taking up space on the bulk volume: the whole batch is retried later
+        for filename in copied_filenames:
+            _remove_if_exists(os.path.join(bulk_directory, f"{filename}~"))
+        raise
+
+    for filename in copied_filenames:
+        bulk_path = os.path.join(bulk_directory, filename)
+        os.replace(os.path.join(bulk_directory, f"{filename}~"), bulk_path)
+        try:
+            os.remove(os.path.join(staging_directory, filename))
+        except FileNotFoundError:
+            # Uploaded and erased from the staging directory while being moved. The copy has already been queued for
+            # upload under the same path, so nothing would erase it
+            moved_bytes -= _remove_copy_of_erased_file(bulk_directory, filename)
+
+    return moved_bytes
+
+
+def _remove_copy_of_erased_file(bulk_directory, filename):
+    """ Remove the bulk copy of a file that was erased from the staging directory mid-move, if the sync manifest
+    shows that it was uploaded as it is
+
+    Returns:
+        number of bytes removed
+    """
+    bulk_path = os.path.join(bulk_directory, filename)
+    file_stat = os.stat(bulk_path)
+    with SyncManifest(bulk_directory) as manifest:
+        if not manifest.is_synced(filename, file_stat):
+            logging.warning(
+                f"{filename} left the staging directory while being moved, but isn't synced: keeping it"
+            )
+            return 0
+    os.remove(bulk_path)
+    return file_stat.st_size
+
+
+def move_staged_files_until_stopped(
+    staging_directory,
+    bulk_directory,
+    stop_event,
+    batch_bytes=STAGING_BATCH_BYTES,
+    max_batch_age=STAGING_MAX_BATCH_AGE,
+):
+    """ Move completed files from the staging directory to the bulk directory in batches (see move_staged_files()),
+    until `stop_event` is set. Once it's set, every file left in the staging directory is moved before returning.
+    A batch that fails to move is logged and retried on the next poll (or, once stopping, up to
+    STAGING_FINAL_MOVE_ATTEMPTS times in all).
+
+    Args:
+        staging_directory: directory to move files from
+        bulk_directory: directory to move files to
+        stop_event: threading.Event or multiprocessing.Event
+        batch_bytes: Optional. Move files once at least this many bytes are waiting
+        max_batch_age: Optional. Move files once the oldest has waited at least this many seconds
+    Returns:
+        None
+    """
+    final_move_attempts = 0
+    while True:
+        stopping = stop_event.is_set()
+        now = time.time()
+        movable_files = [
+            (filename, file_stat)
+            for filename, file_stat in _list_staged_files(staging_directory)
+            if stopping or now - file_stat.st_mtime >= STAGED_FILE_MIN_AGE
+        ]
+        waiting_bytes = sum(file_stat.st_size for _, file_stat in movable_files)
+
+        if movable_files and (
+            stopping
+            or waiting_bytes >= batch_bytes
+            or now - movable_files[0][1].st_mtime >= max_batch_age
+        ):
+            start_time = time.monotonic()
+            try:
+                moved_bytes = move_staged_files(
+                    staging_directory,
+                    bulk_directory,
+                    [filename for filename, _ in movable_files],
+                )
+            except OSError as e:
+                logging.warning(
+                    f"Failed to move {len(movable_files)} staged files to {bulk_directory}: {e}"
+                )
+                if stopping:
+                    final_move_attempts += 1
+                    if final_move_attempts < STAGING_FINAL_MOVE_ATTEMPTS:
+                        time.sleep(STAGING_POLL_INTERVAL)
+                        continue
+                    logging.error(
+                        f"Giving up on moving staged files: they are left in {staging_directory}"
+                    )
+            else:
+                logging.info(
+                    f"Moved {moved_bytes / 1e6:.1f} MB of staged files to {bulk_directory} in "
+                    f"{time.monotonic() - start_time:.1f}s"
+                )
+
+        if stopping:
+            _remove_empty_directories(staging_directory)
+            return
+        stop_event.wait(STAGING_POLL_INTERVAL)
+
+
+def _is_mover_process_running():
+    return _MOVER_PROCESS and _MOVER_PROCESS.is_alive()
+
+
+def start_staging_mover_in_separate_process(staging_directory, bulk_directory):
+    """ Instantiates a separate process that moves files from a staging directory to a bulk directory in batches.
+    If one is already running, this is a no-op.
+
+     Args:
+        staging_directory: directory that images are captured into, e.g. on tmpfs
+        bulk_directory: experiment directory to move them to
+     Returns:
+        None.
+    """
+    global _MOVER_PROCESS, _MOVER_STOP_EVENT, _MOVER_DIRECTORIES
+    if _is_mover_process_running():
+        return
+
+    _MOVER_DIRECTORIES = (staging_directory, bulk_directory)
+    _MOVER_STOP_EVENT = multiprocessing.Event()
+    _MOVER_PROCESS = multiprocessing.Process(
+        target=move_staged_files_until_stopped,
+        args=(staging_directory, bulk_directory, _MOVER_STOP_EVENT),
+    )
+    _MOVER_PROCESS.start()
+
+
+def end_staging_mover_process():
+    """ Stops the mover process once it has moved every file left in the staging directory. If the process died
+    along the way, whatever is left is moved in this process instead.
+     Args:
+        None
+     Returns:
+        None
+    """
+    global _MOVER_PROCESS
+
+    if _MOVER_PROCESS is None:
+        return
+
+    if _MOVER_PROCESS.is_alive():
+        _MOVER_STOP_EVENT.set()
+        # Not killed after a timeout like other processes: the staging volume may not survive a reboot
+        _MOVER_PROCESS.join()
+
+    if _MOVER_PROCESS.exitcode != 0:
+        logging.warning(
+            f"Staging mover process exited with code {_MOVER_PROCESS.exitcode}: moving the rest of the staged files"
+        )
+        stop_event = threading.Event()
+        stop_event.set()
+        move_staged_files_until_stopped(*_MOVER_DIRECTORIES, stop_event)
+
+    _MOVER_PROCESS = None
@@ -0,0 +1,280 @@
+import errno
+import os
+import threading
+
+import pytest
+
+from . import staging as module
+from .sync_manifest import SyncManifest
+
+
+@pytest.fixture
+def directories(tmp_path):
+    staging_directory = tmp_path / "staging"
+    staging_directory.mkdir()
+    bulk_directory = tmp_path / "bulk"
+    bulk_directory.mkdir()
+    return staging_directory, bulk_directory
+
+
+def _age_file(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - int(seconds * 1e9)))
+
+
+class TestGetStagingDirectoryPath:
+    def test_named_after_experiment_directory(self):
+        actual = module.get_staging_directory_path(
+            "/mnt/ramdisk",
+            "/home/pi/camera-sensor-output/2019-01-01--12-00-00-Pi1A2B-name/",
+        )
+        assert actual == "/mnt/ramdisk/2019-01-01--12-00-00-Pi1A2B-name"
+
+
+class TestFindTieredFile:
+    def test_finds_file_in_first_directory_it_is_in(self, directories):
+        staging_directory, bulk_directory = directories
+        (bulk_directory / "image.jpeg").write_text("moved")
+
+        actual = module.find_tiered_file(
+            "image.jpeg", [str(staging_directory), str(bulk_directory)]
+        )
+
+        assert actual == str(bulk_directory / "image.jpeg")
+
+    def test_prefers_earlier_directory(self, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "image.jpeg").write_text("staged")
+        (bulk_directory / "image.jpeg").write_text("moved")
+
+        actual = module.find_tiered_file(
+            "image.jpeg", [str(staging_directory), str(bulk_directory)]
+        )
+
+        assert actual == str(staging_directory / "image.jpeg")
+
+    def test_missing_file__path_in_last_directory(self, directories):
+        staging_directory, bulk_directory = directories
+
+        actual = module.find_tiered_file(
+            "image.jpeg", [str(staging_directory), str(bulk_directory)]
+        )
+
+        assert actual == str(bulk_directory / "image.jpeg")
+
+
+class TestMoveStagedFiles:
+    def test_moves_files_keeping_modified_time(self, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "image.jpeg").write_bytes(b"image data")
+        _age_file(staging_directory / "image.jpeg", 100)
+        staged_mtime_ns = os.stat(staging_directory / "image.jpeg").st_mtime_ns
+
+        moved_bytes = module.move_staged_files(
+            str(staging_directory), str(bulk_directory), ["image.jpeg"]
+        )
+
+        assert moved_bytes == len(b"image data")
+        assert os.listdir(staging_directory) == []
+        assert os.listdir(bulk_directory) == ["image.jpeg"]
+        assert (bulk_directory / "image.jpeg").read_bytes() == b"image data"
+        assert os.stat(bulk_directory / "image.jpeg").st_mtime_ns == staged_mtime_ns
+
+    def test_moves_files_to_same_shard_directory(self, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "2019-01-01" / "12").mkdir(parents=True)
+        (staging_directory / "2019-01-01" / "12" / "image.jpeg").write_text("hi")
+
+        module.move_staged_files(
+            str(staging_directory),
+            str(bulk_directory),
+            [os.path.join("2019-01-01", "12", "image.jpeg")],
+        )
+
+        assert (bulk_directory / "2019-01-01" / "12" / "image.jpeg").exists()
+
+    def test_skips_files_erased_in_the_meantime(self, directories):
+        staging_directory, bulk_directory = directories
+
+        moved_bytes = module.move_staged_files(
+            str(staging_directory), str(bulk_directory), ["uploaded_and_erased.jpeg"]
+        )
+
+        assert moved_bytes == 0
+        assert os.listdir(bulk_directory) == []
+
+    @pytest.mark.parametrize(
+        "name,synced,expected_bulk_files",
+        [("synced", True, []), ("not synced", False, ["image.jpeg"])],
+    )
+    def test_erased_while_moving(
+        self, mocker, directories, name, synced, expected_bulk_files
+    ):
+        staging_directory, bulk_directory = directories
+        staged_path = staging_directory / "image.jpeg"
+        staged_path.write_bytes(b"image data")
+        if synced:
+            with SyncManifest(str(bulk_directory)) as manifest:
+                manifest.record_uploaded("image.jpeg", str(staged_path))
+        # Uploaded and erased from the staging directory after it was copied, but before it was moved into place
+        mocker.patch.object(module.os, "sync").side_effect = lambda: os.remove(
+            staged_path
+        )
+
+        module.move_staged_files(
+            str(staging_directory), str(bulk_directory), ["image.jpeg"]
+        )
+
+        assert [
+            filename
+            for filename in os.listdir(bulk_directory)
+            if filename.endswith(".jpeg")
+        ] == expected_bulk_files
+
+    def test_failed_copy__leaves_batch_in_staging_directory(self, mocker, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "first.jpeg").write_text("copied")
+        (staging_directory / "second.jpeg").write_text("doesn't fit")
+        mocker.patch.object(module.shutil, "copyfileobj").side_effect = [
+            None,
+            OSError(errno.ENOSPC, "No space left on device"),
+        ]
+
+        with pytest.raises(OSError):
+            module.move_staged_files(
+                str(staging_directory),
+                str(bulk_directory),
+                ["first.jpeg", "second.jpeg"],
+            )
+
+        assert os.listdir(bulk_directory) == []
+        assert sorted(os.listdir(staging_directory)) == ["first.jpeg", "second.jpeg"]
+
+
+class TestMoveStagedFilesUntilStopped:
+    def test_stopping__moves_everything_but_temp_files(self, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "new.jpeg").write_text("just captured")
+        (staging_directory / "capturing.jpeg~").write_text("in progress")
+
+        stop_event = threading.Event()
+        stop_event.set()
+        module.move_staged_files_until_stopped(
+            str(staging_directory), str(bulk_directory), stop_event
+        )
+
+        assert os.listdir(bulk_directory) == ["new.jpeg"]
+        assert os.listdir(staging_directory) == ["capturing.jpeg~"]
+
+    def test_stopping__removes_empty_staging_directory(self, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "new.jpeg").write_text("just captured")
+        (staging_directory / "2019-01-01" / "12").mkdir(parents=True)
+        (staging_directory / "2019-01-01" / "12" / "sharded.jpeg").write_text("hi")
+
+        stop_event = threading.Event()
+        stop_event.set()
+        module.move_staged_files_until_stopped(
+            str(staging_directory), str(bulk_directory), stop_event
+        )
+
+        assert not os.path.exists(staging_directory)
+
+    @pytest.mark.parametrize(
+        "name,age,batch_bytes,max_batch_age,expected_moved",
+        [
+            ("too new to move", 1, 1, 60, False),
+            ("small batch, not waited long", 10, 1000, 60, False),
+            ("batch big enough", 10, 5, 60, True),
+            ("batch waited long enough", 100, 1000, 60, True),
+        ],
+    )
+    def test_batches(
+        self, mocker, directories, name, age, batch_bytes, max_batch_age, expected_moved
+    ):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "image.jpeg").write_text("123456")
+        _age_file(staging_directory / "image.jpeg", age)
+
+        # Run once without stopping, then stop without running again
+        mock_stop_event = mocker.Mock()
+        mock_stop_event.is_set.return_value = False
+        mock_stop_event.wait.side_effect = StopIteration
+
+        with pytest.raises(StopIteration):
+            module.move_staged_files_until_stopped(
+                str(staging_directory),
+                str(bulk_directory),
+                mock_stop_event,
+                batch_bytes=batch_bytes,
+                max_batch_age=max_batch_age,
+            )
+
+        assert (os.listdir(bulk_directory) == ["image.jpeg"]) == expected_moved
+
+    def test_failed_batch__retried_on_next_poll(self, mocker, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "image.jpeg").write_text("123456")
+        _age_file(staging_directory / "image.jpeg", 100)
+        mocker.patch.object(module, "move_staged_files").side_effect = OSError(
+            errno.EIO, "Input/output error"
+        )
+
+        mock_stop_event = mocker.Mock()
+        mock_stop_event.is_set.return_value = False
+        mock_stop_event.wait.side_effect = [None, StopIteration]
+
+        with pytest.raises(StopIteration):
+            module.move_staged_files_until_stopped(
+                str(staging_directory), str(bulk_directory), mock_stop_event
+            )
+
+        assert module.move_staged_files.call_count == 2
+
+    def test_stopping__gives_up_after_final_attempts(self, mocker, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "image.jpeg").write_text("123456")
+        mocker.patch.object(module.time, "sleep")
+        mocker.patch.object(module, "move_staged_files").side_effect = OSError(
+            errno.ENOSPC, "No space left on device"
+        )
+
+        stop_event = threading.Event()
+        stop_event.set()
+        module.move_staged_files_until_stopped(
+            str(staging_directory), str(bulk_directory), stop_event
+        )
+
+        assert module.move_staged_files.call_count == module.STAGING_FINAL_MOVE_ATTEMPTS
+        assert os.listdir(staging_directory) == ["image.jpeg"]
+
+
+class TestEndStagingMoverProcess:
+    def test_process_died__moves_staged_files(self, mocker, directories):
+        staging_directory, bulk_directory = directories
+        (staging_directory / "image.jpeg").write_text("123456")
+        mock_process = mocker.Mock()
+        mock_process.is_alive.return_value = False
+        mock_process.exitcode = 1
+        mocker.patch.object(module, "_MOVER_PROCESS", mock_process)
+        mocker.patch.object(
+            module, "_MOVER_DIRECTORIES", (str(staging_directory), str(bulk_directory))
+        )
+
+        module.end_staging_mover_process()
+
+        assert os.listdir(bulk_directory) == ["image.jpeg"]
+        assert module._MOVER_PROCESS is None
+
+    def test_process_finished__doesnt_move_again(self, mocker):
+        mock_process = mocker.Mock()
+        mock_process.is_alive.return_value = True
+        mock_process.exitcode = 0
+        mocker.patch.object(module, "_MOVER_PROCESS", mock_process)
+        mocker.patch.object(module, "_MOVER_STOP_EVENT")
+        mock_move = mocker.patch.object(module, "move_staged_files_until_stopped")
+
+        module.end_staging_mover_process()
+
+        mock_process.join.assert_called_once_with()
+        mock_move.assert_not_called()
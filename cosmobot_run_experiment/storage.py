@@ -1,44 +1,332 @@
-import math
+import logging
+import multiprocessing
+import os
+import time
 from shutil import disk_usage
 
+from .file_structure import unshard_relative_path
+from .s3_uploader import S3Uploader
+from .sync_manifest import SyncManifest, is_confirmed_synced
+
 
 # Experimental evidence shows the raw image size on the Sony IMX Camera module
-# to max out at 1600000 bytes in size
+# to max out at 1600000 bytes in size. Only the starting estimate: an ImageSizeModel learns actual sizes
 IMAGE_SIZE_IN_BYTES = 1600000
+# Weight of each new image's size in an ImageSizeModel's running estimate. Sizes change with the scene, so older
+# images count for progressively less
+IMAGE_SIZE_SMOOTHING = 0.2
+
+# The eviction process erases synced files whenever free space drops below this...
+EVICTION_FREE_SPACE_TARGET_BYTES = 512 * 1024 * 1024
+# ...freeing up this much more than the target, so that eviction (which checks each file against s3) happens in
+# occasional batches
+EVICTION_HEADROOM_BYTES = 256 * 1024 * 1024
+# How often the eviction process checks free space
+EVICTION_POLL_INTERVAL = 10
+# Longest a single round of eviction may take, so free space is checked again (and stopping is noticed) regularly
+EVICTION_TIME_LIMIT = 60
+# How long to give the eviction process to finish checking a file when stopping it
+EVICTION_STOP_TIMEOUT = 10
+
+_EVICTION_PROCESS = None
+_EVICTION_STOP_EVENT = None
+
+# How often a StorageBudget re-reads free space from the filesystem. In between, it accounts for the bytes written
+# and deleted itself
+DEFAULT_POLL_INTERVAL = 60
+
+
+def get_volume_path(path):
+    """ The nearest existing directory at or above path: it is on the same filesystem that path will be created on
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
 
 
-def _get_free_disk_space_bytes():
-    _, _, free = disk_usage("/")
+def _get_free_disk_space_bytes(path):
+    _, _, free = disk_usage(get_volume_path(path))
     return free
 
 
-def _is_there_free_space_for_image_count(image_count):
-    """Check if there is enough space with the storage device
-     Args:
-        image_count: how many images will be stored
-     Returns:
-        Boolean of whether there is space to store the experiment
+def has_free_space_for(path, byte_count):
+    """ Whether the volume that holds a path has at least `byte_count` bytes free, read straight from the filesystem.
+    For volumes that others free space on too quickly to keep track of with a StorageBudget, such as a staging
+    directory that a mover process is emptying
     """
-    free = _get_free_disk_space_bytes()
-    return free >= IMAGE_SIZE_IN_BYTES * image_count
+    return _get_free_disk_space_bytes(path) >= byte_count
 
 
-def how_many_images_with_free_space():
-    """Estimate how many images can be stored on the storage device
-     Args:
+class StorageBudget:
+    """ Keeps track of the free space on the volume that holds a directory, without asking the filesystem before
+    every capture.
+
+    Free space is read from the filesystem at most once per poll interval. In between, the bytes that the experiment
+    writes (and deletes) are added up and taken off (or put back on) the last reading. Each new reading also shows
+    how much space was freed by others in the meantime, such as a sync process erasing uploaded files, so that the
+    rates of writing and freeing space - and when the volume will be full at those rates - can be projected.
+    """
+
+    def __init__(self, path, poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        Args:
+            path: a path on the volume to track, e.g. the experiment directory. Need not exist yet
+            poll_interval: Optional. Seconds between readings of free space from the filesystem
+        """
+        self.volume_path = get_volume_path(path)
+        self.poll_interval = poll_interval
+
+        self.written_bytes = 0
+        self.freed_bytes = 0
+        self._start_time = time.monotonic()
+        self._polled_free_bytes = None
+        self._poll()
+
+    def _poll(self):
+        measured_free_bytes = _get_free_disk_space_bytes(self.volume_path)
+        if self._polled_free_bytes is not None:
+            # Anything not accounted for was freed (or used) by someone else since the last reading
+            self.freed_bytes += measured_free_bytes - self._accounted_free_bytes()
+
+        self._polled_free_bytes = measured_free_bytes
+        self._polled_at = time.monotonic()
+        self._bytes_written_since_poll = 0
+        self._bytes_deleted_since_poll = 0
+
+    def _accounted_free_bytes(self):
+        return (
+            self._polled_free_bytes
+            - self._bytes_written_since_poll
+            + self._bytes_deleted_since_poll
+        )
+
+    def record_written(self, byte_count):
+        """ Account for bytes written to the volume, e.g. a captured image """
+        self.written_bytes += byte_count
+        self._bytes_written_since_poll += byte_count
+
+    def record_deleted(self, byte_count):
+        """ Account for bytes deleted from the volume by this process """
+        self.freed_bytes += byte_count
+        self._bytes_deleted_since_poll += byte_count
+
+    def free_bytes(self):
+        """ Free space on the volume: read from the filesystem if the last reading is more than a poll interval old,
+        otherwise estimated from the last reading
+        """
+        if time.monotonic() - self._polled_at >= self.poll_interval:
+            self._poll()
+            logging.info(self.describe())
+        return self._accounted_free_bytes()
+
+    def refresh(self):
+        """ Read free space from the filesystem now, e.g. because another process may have freed some """
+        self._poll()
+
+    def has_space_for(self, byte_count):
+        return self.free_bytes() >= byte_count
+
+    def get_rates(self):
+        """
+        Returns:
+            (bytes written per second, bytes freed per second), averaged since tracking started
+        """
+        elapsed_seconds = max(time.monotonic() - self._start_time, 1e-9)
+        return self.written_bytes / elapsed_seconds, self.freed_bytes / elapsed_seconds
+
+    def seconds_until_full(self):
+        """ Projected seconds until the volume is full at the current rates, or None if it isn't filling up """
+        write_rate, free_rate = self.get_rates()
+        net_rate = write_rate - free_rate
+        if net_rate <= 0:
+            return None
+        return self._accounted_free_bytes() / net_rate
+
+    def describe(self):
+        write_rate, free_rate = self.get_rates()
+        seconds_until_full = self.seconds_until_full()
+        projection = (
+            "not filling up"
+            if seconds_until_full is None
+            else f"full in {seconds_until_full / 3600:.1f} hours"
+        )
+        return (
+            f"{self._accounted_free_bytes() / 1e9:.2f} GB free on {self.volume_path}; writing "
+            f"{write_rate / 1000:.1f} kB/s, freeing {free_rate / 1000:.1f} kB/s: {projection}"
+        )
+
+
+class ImageSizeModel:
+    """ A running estimate of the size of the images captured with each ExperimentVariant, learned from real captures:
+    file sizes change with ISO, exposure time and additional capture parameters (and with the scene). Variants that
+    haven't captured an image yet are estimated at IMAGE_SIZE_IN_BYTES.
+
+    Variants are identified by their index in the experiment's list of variants rather than by value, so that an
+    estimate carries over when auto-exposure adjusts a variant's settings.
+    """
+
+    def __init__(self, smoothing=IMAGE_SIZE_SMOOTHING):
+        """
+        Args:
+            smoothing: Optional. Weight, between 0 and 1, of each new image's size in the running estimate
+        """
+        self.smoothing = smoothing
+        self._estimates = {}
+
+    def record(self, variant_index, image_size_in_bytes):
+        """ Update the estimate for a variant with the size of an image it just captured """
+        estimate = self._estimates.get(variant_index)
+        self._estimates[variant_index] = (
+            image_size_in_bytes
+            if estimate is None
+            else estimate + self.smoothing * (image_size_in_bytes - estimate)
+        )
+
+    def get_size(self, variant_index):
+        """ Estimated size in bytes of the next image captured with a variant """
+        return self._estimates.get(variant_index, IMAGE_SIZE_IN_BYTES)
+
+    def get_cycle_size(self, variant_count):
+        """ Estimated size in bytes of the images from one capture of each of `variant_count` variants """
+        return sum(
+            self.get_size(variant_index) for variant_index in range(variant_count)
+        )
+
+
+def evict_synced_files(
+    directory, byte_count, bucket_name, time_limit=EVICTION_TIME_LIMIT, stop_event=None
+):
+    """ Erase the oldest files in an experiment directory that are confirmed to be on s3, until `byte_count` bytes
+    have been freed. Only files that the directory's SyncManifest records as uploaded, that haven't changed since, and
+    that match their object on s3 (by size and checksum) are erased, so data that hasn't been synced is never lost.
+
+    Confirming each file takes a request to s3, so this gives up early: after `time_limit` seconds, or as soon as s3
+    can't be reached (rather than trying every file in turn while the network is down).
+
+    Args:
+        directory: experiment directory to evict files from
+        byte_count: number of bytes to free
+        bucket_name: s3 bucket that the directory is synced to
+        time_limit: Optional. Seconds after which to stop, whether or not byte_count bytes have been freed
+        stop_event: Optional threading.Event or multiprocessing.Event. Stop as soon as it's set
+    Returns:
+        number of bytes freed. Less than byte_count if there weren't enough confirmed files to erase
+    """
+    key_prefix = f"{os.path.basename(os.path.normpath(directory))}/"
+    freed_bytes = 0
+    deadline = time.monotonic() + time_limit
+
+    with SyncManifest(directory) as manifest, S3Uploader(bucket_name) as uploader:
+        for relative_path in manifest.get_uploaded_paths():
+            if freed_bytes >= byte_count:
+                break
+            if time.monotonic() > deadline:
+                logging.warning(f"Eviction took over {time_limit}s; stopping for now")
+                break
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            local_file_path = os.path.join(directory, relative_path)
+            try:
+                file_stat = os.stat(local_file_path)
+            except FileNotFoundError:
+                # Already erased
+                continue
+            try:
+                is_confirmed = is_confirmed_synced(
+                    manifest,
+                    uploader,
+                    relative_path,
+                    local_file_path,
+                    f"{key_prefix}{unshard_relative_path(relative_path)}",
+                )
+            except FileNotFoundError:
+                continue
+            except Exception as exception:
+                # Most likely the network is down: every other file would fail the same way
+                logging.warning(
+                    f"Couldn't confirm {relative_path} is on s3 ({exception}); stopping eviction for now"
+                )
+                break
+            if not is_confirmed:
+                continue
+
+            os.remove(local_file_path)
+            freed_bytes += file_stat.st_size
+
+    logging.info(
+        f"Evicted {freed_bytes / 1e6:.1f} MB of files already synced to s3 from {directory}"
+    )
+    return freed_bytes
+
+
+def evict_synced_files_until_stopped(
+    directory,
+    bucket_name,
+    stop_event,
+    free_space_target=EVICTION_FREE_SPACE_TARGET_BYTES,
+    poll_interval=EVICTION_POLL_INTERVAL,
+):
+    """ Keep at least `free_space_target` bytes free on the volume of an experiment directory by evicting synced files
+    (see evict_synced_files()) whenever it drops below, until `stop_event` is set.
+
+    Args:
+        directory: experiment directory to evict files from
+        bucket_name: s3 bucket that the directory is synced to
+        stop_event: threading.Event or multiprocessing.Event
+        free_space_target: Optional. Bytes to keep free
+        poll_interval: Optional. Seconds between checks of free space
+    Returns:
         None
+    """
+    while not stop_event.is_set():
+        free_bytes = _get_free_disk_space_bytes(directory)
+        if free_bytes < free_space_target:
+            evict_synced_files(
+                directory,
+                free_space_target + EVICTION_HEADROOM_BYTES - free_bytes,
+                bucket_name,
+                stop_event=stop_event,
+            )
+        stop_event.wait(poll_interval)
+
+
+def start_evicting_synced_files_in_separate_process(directory, bucket_name):
+    """ Instantiates a separate process that evicts synced files from an experiment directory when free space runs
+    low, so that the experiment itself never waits on s3 to make room. If one is already running, this is a no-op.
+
+     Args:
+        directory: experiment directory
+        bucket_name: s3 bucket that the directory is synced to
      Returns:
-        an integer of how many images can be stored
+        None.
     """
-    free = _get_free_disk_space_bytes()
-    return math.floor(free / IMAGE_SIZE_IN_BYTES)
+    global _EVICTION_PROCESS, _EVICTION_STOP_EVENT
+    if _EVICTION_PROCESS and _EVICTION_PROCESS.is_alive():
+        return
+
+    _EVICTION_STOP_EVENT = multiprocessing.Event()
+    _EVICTION_PROCESS = multiprocessing.Process(
+        target=evict_synced_files_until_stopped,
+        args=(directory, bucket_name, _EVICTION_STOP_EVENT),
+    )
+    _EVICTION_PROCESS.start()
 
 
-def free_space_for_one_image():
-    """Is there enough space for one image
+def end_eviction_process():
+    """ Stops the eviction process, giving it a chance to finish checking the file it's on.
      Args:
         None
      Returns:
-        a Boolean: is there space to store one image?
+        None
     """
-    return _is_there_free_space_for_image_count(1)
+    global _EVICTION_PROCESS
+
+    if _EVICTION_PROCESS and _EVICTION_PROCESS.is_alive():
+        _EVICTION_STOP_EVENT.set()
+        _EVICTION_PROCESS.join(EVICTION_STOP_TIMEOUT)
+        if _EVICTION_PROCESS.is_alive():
+            _EVICTION_PROCESS.terminate()
+
+    _EVICTION_PROCESS = None
@@ -1,4 +1,8 @@
+import os
+
 import pytest
+
+from .sync_manifest import SyncManifest
 from . import storage as module
 
 
@@ -7,42 +11,273 @@ def mock_get_free_disk_space(mocker):
     return mocker.patch.object(module, "_get_free_disk_space_bytes")
 
 
-class TestHowManyImagesWithFreeSpace:
+class TestHasFreeSpaceFor:
     @pytest.mark.parametrize(
-        "test_name,free_space,expected",
-        [
-            ("no space!", 0, 0),
-            ("one image", module.IMAGE_SIZE_IN_BYTES, 1),
-            ("one image - should round down", module.IMAGE_SIZE_IN_BYTES * 1.7, 1),
-            ("two images", module.IMAGE_SIZE_IN_BYTES * 2, 2),
-        ],
+        "name,free_bytes,expected", [("enough", 100, True), ("too little", 99, False)]
     )
-    def test_basic_cases(
-        self, mock_get_free_disk_space, test_name, free_space, expected
+    def test_compares_free_space(
+        self, mock_get_free_disk_space, name, free_bytes, expected
     ):
-        mock_get_free_disk_space.return_value = free_space
+        mock_get_free_disk_space.return_value = free_bytes
+
+        assert module.has_free_space_for("/mnt/ramdisk/staging", 100) == expected
+        mock_get_free_disk_space.assert_called_once_with("/mnt/ramdisk/staging")
+
+
+class TestGetVolumePath:
+    def test_returns_existing_path(self, tmp_path):
+        assert module.get_volume_path(str(tmp_path)) == str(tmp_path)
+
+    def test_returns_nearest_existing_ancestor(self, tmp_path):
+        not_yet_created = tmp_path / "experiment" / "images"
+        assert module.get_volume_path(str(not_yet_created)) == str(tmp_path)
+
 
-        assert module.how_many_images_with_free_space() == expected
+@pytest.fixture
+def mock_monotonic(mocker):
+    mock_monotonic = mocker.patch.object(module.time, "monotonic")
+    mock_monotonic.return_value = 0
+    return mock_monotonic
+
+
+class TestStorageBudget:
+    def test_polls_volume_on_creation(
+        self, tmp_path, mock_get_free_disk_space, mock_monotonic
+    ):
+        mock_get_free_disk_space.return_value = 1000
+
+        budget = module.StorageBudget(str(tmp_path / "experiment"))
 
-    def test_lots_of_space(self, mock_get_free_disk_space):
-        mock_get_free_disk_space.return_value = 1e12
-        a_thousand = 1e3
-        assert module.how_many_images_with_free_space() > a_thousand
+        mock_get_free_disk_space.assert_called_once_with(str(tmp_path))
+        assert budget.free_bytes() == 1000
 
+    def test_accounts_for_writes_and_deletes_between_polls(
+        self, tmp_path, mock_get_free_disk_space, mock_monotonic
+    ):
+        mock_get_free_disk_space.return_value = 1000
+        budget = module.StorageBudget(str(tmp_path), poll_interval=60)
+
+        budget.record_written(300)
+        budget.record_deleted(100)
+        mock_monotonic.return_value = 59
+
+        assert budget.free_bytes() == 800
+        assert mock_get_free_disk_space.call_count == 1
+
+    def test_repolls_after_interval_and_infers_freed_bytes(
+        self, tmp_path, mock_get_free_disk_space, mock_monotonic
+    ):
+        mock_get_free_disk_space.return_value = 1000
+        budget = module.StorageBudget(str(tmp_path), poll_interval=60)
+
+        budget.record_written(300)
+        # Meanwhile, something else erased 500 bytes
+        mock_get_free_disk_space.return_value = 1200
+        mock_monotonic.return_value = 60
+
+        assert budget.free_bytes() == 1200
+        assert mock_get_free_disk_space.call_count == 2
+        assert budget.written_bytes == 300
+        assert budget.freed_bytes == 500
 
-class TestFreeSpaceForOneImage:
     @pytest.mark.parametrize(
-        "test_name,free_space,expected",
+        "name,free_space,expected",
         [
-            ("no space!", 0, False),
             ("not quite enough space", module.IMAGE_SIZE_IN_BYTES - 1, False),
             ("exactly enough space", module.IMAGE_SIZE_IN_BYTES, True),
-            ("some extra space", module.IMAGE_SIZE_IN_BYTES + 2, True),
         ],
     )
-    def test_basic_cases(
-        self, mock_get_free_disk_space, test_name, free_space, expected
+    def test_has_space_for(
+        self,
+        tmp_path,
+        mock_get_free_disk_space,
+        mock_monotonic,
+        name,
+        free_space,
+        expected,
     ):
         mock_get_free_disk_space.return_value = free_space
+        budget = module.StorageBudget(str(tmp_path))
+
+        assert budget.has_space_for(module.IMAGE_SIZE_IN_BYTES) == expected
+
+    def test_projects_time_until_full_from_rates(
+        self, tmp_path, mock_get_free_disk_space, mock_monotonic
+    ):
+        mock_get_free_disk_space.return_value = 10000
+        budget = module.StorageBudget(str(tmp_path))
+
+        budget.record_written(3000)
+        budget.record_deleted(1000)
+        mock_monotonic.return_value = 10
+
+        assert budget.get_rates() == (300, 100)
+        # 8000 bytes left, filling at a net 200 bytes/s
+        assert budget.seconds_until_full() == 40
+
+    def test_not_filling_up_if_freeing_as_fast_as_writing(
+        self, tmp_path, mock_get_free_disk_space, mock_monotonic
+    ):
+        mock_get_free_disk_space.return_value = 10000
+        budget = module.StorageBudget(str(tmp_path))
+
+        budget.record_written(1000)
+        budget.record_deleted(1000)
+        mock_monotonic.return_value = 10
+
+        assert budget.seconds_until_full() is None
+        assert "not filling up" in budget.describe()
+
+
+class TestImageSizeModel:
+    def test_starts_with_default_size(self):
+        assert module.ImageSizeModel().get_size(0) == module.IMAGE_SIZE_IN_BYTES
+
+    def test_first_image_sets_estimate(self):
+        model = module.ImageSizeModel()
+        model.record(0, 1000)
+
+        assert model.get_size(0) == 1000
+        assert model.get_size(1) == module.IMAGE_SIZE_IN_BYTES
+
+    def test_later_images_move_estimate(self):
+        model = module.ImageSizeModel(smoothing=0.25)
+        model.record(0, 1000)
+        model.record(0, 2000)
+
+        assert model.get_size(0) == 1250
+
+    def test_cycle_size_sums_variants(self):
+        model = module.ImageSizeModel()
+        model.record(0, 1000)
+
+        assert model.get_cycle_size(2) == 1000 + module.IMAGE_SIZE_IN_BYTES
+
+
+@pytest.fixture
+def mock_is_uploaded(mocker):
+    mock_s3_uploader = mocker.patch.object(module, "S3Uploader")
+    mock_is_uploaded = mock_s3_uploader.return_value.__enter__.return_value.is_uploaded
+    mock_is_uploaded.return_value = True
+    return mock_is_uploaded
+
+
+def _write_synced_file(directory, filename, age, synced=True):
+    file_path = directory / filename
+    file_path.write_bytes(b"x" * 100)
+    os.utime(file_path, (1000 - age, 1000 - age))
+    if synced:
+        with SyncManifest(str(directory)) as manifest:
+            manifest.record_uploaded(filename, str(file_path))
+    return file_path
+
+
+class TestEvictSyncedFiles:
+    def test_erases_oldest_synced_files_first(self, tmp_path, mock_is_uploaded):
+        oldest = _write_synced_file(tmp_path, "oldest.jpeg", age=3)
+        older = _write_synced_file(tmp_path, "older.jpeg", age=2)
+        newest = _write_synced_file(tmp_path, "newest.jpeg", age=1)
+
+        freed_bytes = module.evict_synced_files(str(tmp_path), 150, "bucket")
+
+        assert freed_bytes == 200
+        assert not oldest.exists()
+        assert not older.exists()
+        assert newest.exists()
+        mock_is_uploaded.assert_any_call(str(oldest), f"{tmp_path.name}/oldest.jpeg")
+
+    def test_keeps_unsynced_and_changed_files(self, tmp_path, mock_is_uploaded):
+        unsynced = _write_synced_file(tmp_path, "unsynced.jpeg", age=3, synced=False)
+        changed = _write_synced_file(tmp_path, "changed.jpeg", age=2)
+        changed.write_bytes(b"rewritten since upload")
+
+        freed_bytes = module.evict_synced_files(str(tmp_path), 1000, "bucket")
+
+        assert freed_bytes == 0
+        assert unsynced.exists()
+        assert changed.exists()
+
+    @pytest.mark.parametrize(
+        "name,is_uploaded_kwargs",
+        [
+            ("doesn't match s3", {"return_value": False}),
+            ("can't reach s3", {"side_effect": Exception("no network")}),
+        ],
+    )
+    def test_keeps_files_not_confirmed_on_s3(
+        self, tmp_path, mock_is_uploaded, name, is_uploaded_kwargs
+    ):
+        mock_is_uploaded.configure_mock(**is_uploaded_kwargs)
+        synced = _write_synced_file(tmp_path, "synced.jpeg", age=1)
+
+        freed_bytes = module.evict_synced_files(str(tmp_path), 1000, "bucket")
+
+        assert freed_bytes == 0
+        assert synced.exists()
+
+    def test_stops_at_first_network_error(self, tmp_path, mock_is_uploaded):
+        mock_is_uploaded.side_effect = Exception("no network")
+        _write_synced_file(tmp_path, "older.jpeg", age=2)
+        _write_synced_file(tmp_path, "newer.jpeg", age=1)
+
+        module.evict_synced_files(str(tmp_path), 1000, "bucket")
+
+        assert mock_is_uploaded.call_count == 1
+
+    def test_stops_after_time_limit(self, mocker, tmp_path, mock_is_uploaded):
+        mocker.patch.object(module.time, "monotonic").side_effect = [0, 0, 61]
+        oldest = _write_synced_file(tmp_path, "oldest.jpeg", age=2)
+        newest = _write_synced_file(tmp_path, "newest.jpeg", age=1)
+
+        freed_bytes = module.evict_synced_files(
+            str(tmp_path), 1000, "bucket", time_limit=60
+        )
+
+        assert freed_bytes == 100
+        assert not oldest.exists()
+        assert newest.exists()
+
+
+class TestEvictSyncedFilesUntilStopped:
+    @pytest.mark.parametrize(
+        "name,free_bytes,expected_byte_count",
+        [
+            ("enough space", 1000, None),
+            ("space low", 600, 400 + module.EVICTION_HEADROOM_BYTES),
+        ],
+    )
+    def test_evicts_when_space_is_low(
+        self, mocker, mock_get_free_disk_space, name, free_bytes, expected_byte_count
+    ):
+        mock_get_free_disk_space.return_value = free_bytes
+        mock_evict = mocker.patch.object(module, "evict_synced_files")
+        # Check once, then stop
+        mock_stop_event = mocker.Mock()
+        mock_stop_event.is_set.side_effect = [False, True]
+
+        module.evict_synced_files_until_stopped(
+            "/mock/experiment", "bucket", mock_stop_event, free_space_target=1000
+        )
+
+        if expected_byte_count is None:
+            mock_evict.assert_not_called()
+        else:
+            assert mock_evict.call_args[0] == (
+                "/mock/experiment",
+                expected_byte_count,
+                "bucket",
+            )
+
+
+class TestEndEvictionProcess:
+    def test_process_doesnt_stop__terminates_it(self, mocker):
+        mock_process = mocker.patch.object(module, "_EVICTION_PROCESS")
+        mock_process.is_alive.return_value = True
+        mock_stop_event = mocker.patch.object(module, "_EVICTION_STOP_EVENT")
+
+        module.end_eviction_process()
 
-        assert module.free_space_for_one_image() == expected
+        mock_stop_event.set.assert_called_once_with()
+        mock_process.join.assert_called_once_with(module.EVICTION_STOP_TIMEOUT)
+        mock_process.terminate.assert_called_once_with()
+        assert module._EVICTION_PROCESS is None
@@ -1,9 +1,101 @@
+import logging
 import multiprocessing
+import os
+import threading
+from contextlib import contextmanager
+
 import psutil
-from .s3 import sync_to_s3
+from .file_watcher import get_closed_file_watcher, list_relative_file_paths
+from .s3 import (
+    CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME,
+    LOCAL_ONLY_PATTERNS,
+    is_excluded,
+    sync_to_s3,
+)
+from .s3_uploader import S3Uploader
+from .sync_manifest import SyncManifest
+from .upload_governor import UploadGovernor
+from .upload_queue import (
+    UploadQueue,
+    drain_directory_upload_queue,
+    drain_upload_queue,
+    find_directories_with_queued_uploads,
+)
+
+# Sync modes
+# PERIODIC_SYNC runs a full directory sync after each capture (unless one is already running)
+# WATCH_SYNC uploads each file once, as soon as it has been written
+PERIODIC_SYNC = "periodic"
+WATCH_SYNC = "watch"
+SYNC_MODES = [PERIODIC_SYNC, WATCH_SYNC]
+
+# Files that are still being written to during the experiment, and so are only synced by the final sync
+LOG_FILE_PATTERNS = ["*.log*"]
+# Files still being written by raspistill
+TEMP_FILE_PATTERNS = ["*~"]
+WATCH_EXCLUDE_PATTERNS = LOG_FILE_PATTERNS + TEMP_FILE_PATTERNS + LOCAL_ONLY_PATTERNS
 
+# How often the watch process checks whether it has been asked to stop
+WATCH_POLL_TIMEOUT = 0.5
+# How long to let the watch process finish uploading its queue when asked to stop
+WATCH_STOP_TIMEOUT = 60
 
 _SYNC_PROCESS = None
+_WATCH_PROCESS = None
+_WATCH_STOP_EVENT = None
+_RESUME_PROCESS = None
+
+# Upload governor settings, shared with the upload processes when they are started (see configure_upload_governor())
+_UPLOAD_BANDWIDTH_LIMIT = None
+_CAPTURE_IN_PROGRESS = None
+
+
+def configure_upload_governor(bandwidth_limit=None, pause_during_capture=False):
+    """ Set how upload processes started from now on are paced (see UploadGovernor). Call with no arguments to let
+    them upload at full speed.
+
+     Args:
+        bandwidth_limit: Optional. Maximum upload rate, in bytes per second
+        pause_during_capture: If True, uploads pause whenever a capture is in progress (see uploads_paused())
+     Returns:
+        None
+    """
+    global _UPLOAD_BANDWIDTH_LIMIT, _CAPTURE_IN_PROGRESS
+
+    _UPLOAD_BANDWIDTH_LIMIT = bandwidth_limit
+    _CAPTURE_IN_PROGRESS = multiprocessing.Event() if pause_during_capture else None
+
+
+def _get_upload_governor():
+    if _UPLOAD_BANDWIDTH_LIMIT is None and _CAPTURE_IN_PROGRESS is None:
+        return None
+    return UploadGovernor(_UPLOAD_BANDWIDTH_LIMIT, _CAPTURE_IN_PROGRESS)
+
+
+@contextmanager
+def uploads_paused():
+    """ Context manager marking a capture in progress, during which uploads pause if the governor is configured to
+    pause during capture. Otherwise a no-op.
+    """
+    capture_in_progress = _CAPTURE_IN_PROGRESS
+    if capture_in_progress is None:
+        yield
+        return
+
+    capture_in_progress.set()
+    try:
+        yield
+    finally:
+        capture_in_progress.clear()
+
+
+def _kill_process(process):
+    """ Kill a multiprocessing.Process (multiprocessing.Process.kill() is only in Python 3.7+) """
+    try:
+        psutil.Process(process.pid).kill()
+    except psutil.NoSuchProcess:
+        # Exited in the meantime
+        pass
 
 
 def _is_sync_process_running():
@@ -45,6 +137,7 @@ def sync_directory_in_separate_process(
      Args:
         directory: directory to sync
         exclude_log_files (optional, default=True): If True, don't sync log files (*.log*)
+        erase_synced_files (optional): If True, erase each file once its upload has been verified against s3
         wait_for_finish (optional): If True, wait for new process to complete before returning from the function.
      Returns:
         None.
@@ -53,15 +146,203 @@ def sync_directory_in_separate_process(
     if _is_sync_process_running():
         return
 
-    additional_sync_params = (
-        "--exclude *.log*" if exclude_log_files else ""
-    ) + " --exclude *~"
+    exclude_patterns = (
+        LOG_FILE_PATTERNS if exclude_log_files else []
+    ) + TEMP_FILE_PATTERNS
 
     _SYNC_PROCESS = multiprocessing.Process(
-        target=sync_to_s3, args=(directory, additional_sync_params, erase_synced_files)
+        target=sync_to_s3,
+        args=(directory, exclude_patterns, erase_synced_files, _get_upload_governor()),
     )
     _SYNC_PROCESS.start()
 
     if wait_for_finish:
         # .join() means "wait for a thread to complete"
         _SYNC_PROCESS.join()
+
+
+def upload_files_as_they_close(
+    directory,
+    stop_event,
+    exclude_patterns=WATCH_EXCLUDE_PATTERNS,
+    governor=None,
+    erase_uploaded_files=False,
+    staging_directory=None,
+):
+    """ Upload each file in `directory` to s3 exactly once, as soon as it has been completely written, until
+    `stop_event` is set. Files already in the directory when this starts are uploaded first.
+
+    If there is a staging directory that files are written to before being moved to `directory` (see staging.py), it
+    is watched too, and each file is uploaded from whichever directory it is in at the time.
+
+    Files are added to the directory's durable UploadQueue and uploaded from it in order on an S3Uploader thread pool,
+    so a slow upload doesn't hold up noticing new files. Failed uploads are retried with backoff; anything still
+    queued when this stops is picked up by the next run (see resume_queued_uploads_in_separate_process()).
+
+    Args:
+        directory: directory to watch
+        stop_event: threading.Event or multiprocessing.Event. Once set, any due queued files are uploaded and this
+            returns
+        exclude_patterns: fnmatch-style filename patterns to never upload
+        governor: Optional. UploadGovernor to pace uploads with
+        erase_uploaded_files: If True, erase each file once its upload has been verified against s3
+        staging_directory: Optional. Staging directory to also watch
+    Returns:
+        None
+    """
+    watched_directories = [directory]
+    if staging_directory is not None:
+        watched_directories.append(staging_directory)
+
+    experiment_dir_name = os.path.basename(os.path.normpath(directory))
+    queued_filenames = set()
+
+    with SyncManifest(directory) as manifest, UploadQueue(
+        directory
+    ) as upload_queue, S3Uploader(
+        CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME, governor=governor
+    ) as uploader:
+        watching_done = threading.Event()
+        drain_thread = threading.Thread(
+            target=drain_upload_queue,
+            args=(
+                upload_queue,
+                manifest,
+                uploader,
+                f"{experiment_dir_name}/",
+                watching_done,
+                erase_uploaded_files,
+                staging_directory,
+            ),
+        )
+        drain_thread.start()
+
+        def enqueue(filename):
+            if filename in queued_filenames or is_excluded(filename, exclude_patterns):
+                return
+            queued_filenames.add(filename)
+            upload_queue.add(filename)
+
+        # Start watching before listing existing files so that nothing slips through the gap
+        watchers = [
+            get_closed_file_watcher(watched_directory)
+            for watched_directory in watched_directories
+        ]
+        try:
+            for watched_directory in watched_directories:
+                for filename in list_relative_file_paths(watched_directory):
+                    enqueue(filename)
+
+            while not stop_event.is_set():
+                for watcher in watchers:
+                    for filename in watcher.read_closed_filenames(
+                        timeout=WATCH_POLL_TIMEOUT / len(watchers)
+                    ):
+                        enqueue(filename)
+        finally:
+            for watcher in watchers:
+                watcher.close()
+            watching_done.set()
+            drain_thread.join()
+            if governor is not None:
+                governor.log_summary()
+
+
+def _is_watch_process_running():
+    return _WATCH_PROCESS and _WATCH_PROCESS.is_alive()
+
+
+def start_watching_directory_in_separate_process(
+    directory, erase_uploaded_files=False, staging_directory=None
+):
+    """ Instantiates a separate process that uploads each file in a directory to s3 as soon as it is written.
+    If one is already running, this is a no-op.
+
+     Args:
+        directory: directory to watch
+        erase_uploaded_files (optional): If True, erase each file once its upload has been verified against s3
+        staging_directory (optional): staging directory that files are written to before being moved to `directory`
+     Returns:
+        None.
+    """
+    global _WATCH_PROCESS, _WATCH_STOP_EVENT
+    if _is_watch_process_running():
+        return
+
+    _WATCH_STOP_EVENT = multiprocessing.Event()
+    _WATCH_PROCESS = multiprocessing.Process(
+        target=upload_files_as_they_close,
+        args=(
+            directory,
+            _WATCH_STOP_EVENT,
+            WATCH_EXCLUDE_PATTERNS,
+            _get_upload_governor(),
+            erase_uploaded_files,
+            staging_directory,
+        ),
+    )
+    _WATCH_PROCESS.start()
+
+
+def end_watching_process():
+    """ Stops the watch process, giving it a chance to finish uploading files it has already picked up.
+     Args:
+        None
+     Returns:
+        None
+    """
+    global _WATCH_PROCESS
+
+    if _is_watch_process_running():
+        _WATCH_STOP_EVENT.set()
+        _WATCH_PROCESS.join(WATCH_STOP_TIMEOUT)
+        if _WATCH_PROCESS.is_alive():
+            _kill_process(_WATCH_PROCESS)
+
+    _WATCH_PROCESS = None
+
+
+def _drain_queued_uploads(base_directory, exclude_directory, governor=None):
+    with S3Uploader(
+        CAMERA_SENSOR_EXPERIMENTS_BUCKET_NAME, governor=governor
+    ) as uploader:
+        for directory in find_directories_with_queued_uploads(base_directory):
+            if exclude_directory and os.path.samefile(directory, exclude_directory):
+                continue
+            logging.info(f"Resuming queued uploads for {directory}")
+            drain_directory_upload_queue(directory, uploader)
+
+
+def resume_queued_uploads_in_separate_process(base_directory, exclude_directory=None):
+    """ Instantiates a separate process that drains the upload queues left behind by earlier runs (e.g. because the
+    network or the Pi went down), oldest experiment directory first.
+
+     Args:
+        base_directory: directory containing experiment directories
+        exclude_directory: Optional. An experiment directory to leave alone, e.g. the one the current experiment is
+            syncing itself
+     Returns:
+        None.
+    """
+    global _RESUME_PROCESS
+
+    _RESUME_PROCESS = multiprocessing.Process(
+        target=_drain_queued_uploads,
+        args=(base_directory, exclude_directory, _get_upload_governor()),
+    )
+    _RESUME_PROCESS.start()
+
+
+def end_resume_process():
+    """ Stops the process resuming earlier runs' uploads. Anything it hasn't uploaded yet stays queued.
+     Args:
+        None
+     Returns:
+        None
+    """
+    global _RESUME_PROCESS
+
+    if _RESUME_PROCESS and _RESUME_PROCESS.is_alive():
+        _kill_process(_RESUME_PROCESS)
+
+    _RESUME_PROCESS = None
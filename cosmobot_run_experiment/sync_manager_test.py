@@ -1,8 +1,14 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
 import pytest
 import multiprocessing
 import psutil
 from . import sync_manager as module
 from . import s3
+from .upload_queue import UploadQueue
 
 
 @pytest.fixture
@@ -47,11 +53,17 @@ class TestIsSyncProcessRunning:
         module.sync_directory_in_separate_process(
             "/tmp", wait_for_finish=False, exclude_log_files=True
         )
-        expected_additional_sync_params = "--exclude *.log* --exclude *~"
+        expected_exclude_patterns = ["*.log*", "*~"]
         expected_erase_synced_files = False
+        expected_governor = None
         mock_multiprocess_process.assert_called_with(
             target=s3.sync_to_s3,
-            args=("/tmp", expected_additional_sync_params, expected_erase_synced_files),
+            args=(
+                "/tmp",
+                expected_exclude_patterns,
+                expected_erase_synced_files,
+                expected_governor,
+            ),
         )
 
 
@@ -73,3 +85,224 @@ class TestEndSyncingProcess:
             mock_psutil_process.return_value.children.return_value[0].kill.call_count
             == 1
         )
+
+
+@pytest.fixture
+def mock_submit_upload(mocker):
+    mock_s3_uploader = mocker.patch.object(module, "S3Uploader")
+    mock_uploader = mock_s3_uploader.return_value.__enter__.return_value
+    mock_uploader.max_workers = 4
+
+    def submit(local_file_path, key_name, verify=False):
+        upload = Future()
+        upload.set_result(None)
+        return upload
+
+    mock_uploader.submit.side_effect = submit
+    return mock_uploader.submit
+
+
+class TestUploadFilesAsTheyClose:
+    def test_uploads_each_file_once_skipping_excluded_files(
+        self, mocker, tmp_path, mock_submit_upload
+    ):
+        experiment_directory = tmp_path / "experiment_name"
+        experiment_directory.mkdir()
+        (experiment_directory / "metadata.yml").write_text("already here")
+
+        stop_event = threading.Event()
+        watch_thread = threading.Thread(
+            target=module.upload_files_as_they_close,
+            args=(str(experiment_directory), stop_event),
+        )
+        watch_thread.start()
+
+        (experiment_directory / "image.jpeg~").write_text("in progress")
+        os.rename(
+            experiment_directory / "image.jpeg~", experiment_directory / "image.jpeg"
+        )
+        (experiment_directory / "experiment.log").write_text("still being written")
+        # Rewriting a file that was already picked up should not upload it again
+        (experiment_directory / "image.jpeg").write_text("again")
+
+        time.sleep(0.1)
+        stop_event.set()
+        watch_thread.join()
+
+        mock_submit_upload.assert_has_calls(
+            [
+                mocker.call(
+                    str(experiment_directory / "metadata.yml"),
+                    "experiment_name/metadata.yml",
+                    verify=False,
+                ),
+                mocker.call(
+                    str(experiment_directory / "image.jpeg"),
+                    "experiment_name/image.jpeg",
+                    verify=False,
+                ),
+            ],
+            any_order=True,
+        )
+        assert mock_submit_upload.call_count == 2
+
+    def test_uploads_staged_files_from_whichever_directory_they_are_in(
+        self, mocker, tmp_path, mock_submit_upload
+    ):
+        experiment_directory = tmp_path / "experiment_name"
+        experiment_directory.mkdir()
+        staging_directory = tmp_path / "staging"
+        staging_directory.mkdir()
+        (staging_directory / "staged.jpeg").write_text("not moved yet")
+        (experiment_directory / "moved.jpeg").write_text("already moved")
+
+        stop_event = threading.Event()
+        stop_event.set()
+        module.upload_files_as_they_close(
+            str(experiment_directory),
+            stop_event,
+            staging_directory=str(staging_directory),
+        )
+
+        mock_submit_upload.assert_has_calls(
+            [
+                mocker.call(
+                    str(staging_directory / "staged.jpeg"),
+                    "experiment_name/staged.jpeg",
+                    verify=False,
+                ),
+                mocker.call(
+                    str(experiment_directory / "moved.jpeg"),
+                    "experiment_name/moved.jpeg",
+                    verify=False,
+                ),
+            ],
+            any_order=True,
+        )
+
+    def test_upload_failure__stays_queued_for_retry(
+        self, mocker, tmp_path, mock_submit_upload
+    ):
+        failed_upload = Future()
+        failed_upload.set_exception(Exception("no network"))
+        mock_submit_upload.side_effect = None
+        mock_submit_upload.return_value = failed_upload
+        (tmp_path / "first.jpeg").write_text("image")
+
+        stop_event = threading.Event()
+        stop_event.set()
+        module.upload_files_as_they_close(str(tmp_path), stop_event)
+
+        with UploadQueue(str(tmp_path)) as upload_queue:
+            assert len(upload_queue) == 1
+
+    def test_successful_uploads_leave_queue_empty(
+        self, mocker, tmp_path, mock_submit_upload
+    ):
+        (tmp_path / "first.jpeg").write_text("image")
+
+        stop_event = threading.Event()
+        stop_event.set()
+        module.upload_files_as_they_close(str(tmp_path), stop_event)
+
+        with UploadQueue(str(tmp_path)) as upload_queue:
+            assert len(upload_queue) == 0
+
+
+class TestEndWatchingProcess:
+    def test_process_running__asks_it_to_stop(self, mocker, mock_psutil_process):
+        mock_watch_process = mocker.patch.object(module, "_WATCH_PROCESS")
+        mock_watch_process.is_alive.side_effect = [True, False]
+        mock_stop_event = mocker.patch.object(module, "_WATCH_STOP_EVENT")
+
+        module.end_watching_process()
+
+        mock_stop_event.set.assert_called_once_with()
+        mock_watch_process.join.assert_called_once_with(module.WATCH_STOP_TIMEOUT)
+        mock_psutil_process.return_value.kill.assert_not_called()
+
+    def test_process_doesnt_stop__kills_it(self, mocker, mock_psutil_process):
+        mock_watch_process = mocker.patch.object(module, "_WATCH_PROCESS")
+        mock_watch_process.is_alive.return_value = True
+        mock_watch_process.pid = 10000
+        mocker.patch.object(module, "_WATCH_STOP_EVENT")
+
+        module.end_watching_process()
+
+        mock_psutil_process.assert_called_once_with(10000)
+        mock_psutil_process.return_value.kill.assert_called_once_with()
+        assert module._WATCH_PROCESS is None
+
+
+class TestDrainQueuedUploads:
+    def test_drains_each_queued_directory_except_excluded(self, mocker, tmp_path):
+        mocker.patch.object(module, "S3Uploader")
+        mock_drain = mocker.patch.object(module, "drain_directory_upload_queue")
+        for directory_name in ["current", "earlier", "nothing_queued"]:
+            (tmp_path / directory_name).mkdir()
+            with UploadQueue(str(tmp_path / directory_name)) as upload_queue:
+                if directory_name != "nothing_queued":
+                    upload_queue.add("image.jpeg")
+
+        module._drain_queued_uploads(str(tmp_path), str(tmp_path / "current"))
+
+        assert [call_args[0][0] for call_args in mock_drain.call_args_list] == [
+            str(tmp_path / "earlier")
+        ]
+
+
+class TestEndResumeProcess:
+    def test_process_running__kills_it(self, mocker, mock_psutil_process):
+        mock_resume_process = mocker.patch.object(module, "_RESUME_PROCESS")
+        mock_resume_process.is_alive.return_value = True
+        mock_resume_process.pid = 10000
+
+        module.end_resume_process()
+
+        mock_psutil_process.assert_called_once_with(10000)
+        mock_psutil_process.return_value.kill.assert_called_once_with()
+        assert module._RESUME_PROCESS is None
+
+    def test_process_exits_before_kill__no_error(self, mocker, mock_psutil_process):
+        mock_resume_process = mocker.patch.object(module, "_RESUME_PROCESS")
+        mock_resume_process.is_alive.return_value = True
+        mock_psutil_process.side_effect = psutil.NoSuchProcess(10000)
+
+        module.end_resume_process()
+
+        assert module._RESUME_PROCESS is None
+
+
+class TestUploadGovernorConfiguration:
+    @pytest.fixture(autouse=True)
+    def reset_upload_governor(self):
+        yield
+        module.configure_upload_governor()
+
+    def test_not_configured__no_governor(self):
+        module.configure_upload_governor()
+
+        assert module._get_upload_governor() is None
+        with module.uploads_paused():
+            pass
+
+    def test_uploads_paused__signals_capture_in_progress(self):
+        module.configure_upload_governor(
+            bandwidth_limit=1000, pause_during_capture=True
+        )
+        governor = module._get_upload_governor()
+
+        assert governor.bandwidth_limit == 1000
+        with module.uploads_paused():
+            assert governor.capture_in_progress.is_set()
+        assert not governor.capture_in_progress.is_set()
+
+    def test_uploads_paused__clears_on_error(self):
+        module.configure_upload_governor(pause_during_capture=True)
+        governor = module._get_upload_governor()
+
+        with pytest.raises(ValueError):
+            with module.uploads_paused():
+                raise ValueError()
+
+        assert not governor.capture_in_progress.is_set()
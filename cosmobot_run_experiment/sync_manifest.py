@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import os
+
+from .sqlite_database import SqliteDatabase
+
+# Lives in the experiment directory it describes, but is never synced itself
+SYNC_MANIFEST_FILENAME = ".sync_manifest.sqlite3"
+# Also matches sqlite's temporary journal file
+SYNC_MANIFEST_PATTERNS = [f"{SYNC_MANIFEST_FILENAME}*"]
+
+UPLOADED = "uploaded"
+
+_READ_CHUNK_BYTES = 1024 * 1024
+
+
+def compute_md5_hex(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(_READ_CHUNK_BYTES), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class SyncManifest(SqliteDatabase):
+    """ A persistent record, in an SQLite database inside an experiment directory, of which files in that directory
+    have been uploaded to s3 (along with their size, modified time and md5 checksum at the time of upload).
+
+    Syncs can compare local files against the manifest instead of listing what's already on s3, so the cost of a sync
+    only depends on the local directory.
+
+    Safe to share between threads. Use as a context manager to close the database when done.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            md5 TEXT NOT NULL,
+            status TEXT NOT NULL
+        )
+    """
+
+    def __init__(self, directory):
+        path = os.path.join(directory, SYNC_MANIFEST_FILENAME)
+        # A brand-new manifest knows nothing about uploads made before it existed
+        self.is_new = not os.path.exists(path)
+        super().__init__(path)
+
+    def get_entry(self, relative_path):
+        """
+        Returns:
+            dict of the manifest entry for relative_path (size, mtime_ns, md5, status), or None if there isn't one
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime_ns, md5, status FROM files WHERE path = ?",
+                (relative_path,),
+            ).fetchone()
+        return (
+            None
+            if row is None
+            else dict(zip(["size", "mtime_ns", "md5", "status"], row))
+        )
+
+    def is_synced(self, relative_path, file_stat):
+        """ Has this file been uploaded, and not changed (by size or modified time) since?
+
+        Args:
+            relative_path: "/"-separated path of the file relative to the experiment directory
+            file_stat: os.stat() result for the local file
+        """
+        entry = self.get_entry(relative_path)
+        return (
+            entry is not None
+            and entry["status"] == UPLOADED
+            and entry["size"] == file_stat.st_size
+            and entry["mtime_ns"] == file_stat.st_mtime_ns
+        )
+
+    def record_uploaded(self, relative_path, local_file_path):
+        """ Record that a file has been uploaded, as it currently is on disk """
+        file_stat = os.stat(local_file_path)
+        md5_hex = compute_md5_hex(local_file_path)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, md5, status) VALUES (?, ?, ?, ?, ?)",
+                (
+                    relative_path,
+                    file_stat.st_size,
+                    file_stat.st_mtime_ns,
+                    md5_hex,
+                    UPLOADED,
+                ),
+            )
+
+    def get_uploaded_paths(self):
+        """
+        Returns:
+            list of relative paths of the files recorded as uploaded, oldest (by modified time at upload) first
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path FROM files WHERE status = ? ORDER BY mtime_ns, path",
+                (UPLOADED,),
+            ).fetchall()
+        return [path for (path,) in rows]
+
+
+def is_confirmed_synced(
+    manifest, uploader, relative_path, local_file_path, key_name, verify=True
+):
+    """ Has this file been synced, according to the manifest, and (if `verify`) does its copy on s3 match it?
+
+    Never erase the only copy of a file on the manifest's word alone: only erase files this confirms with verify=True.
+
+    Args:
+        manifest: the experiment directory's `SyncManifest`
+        uploader: an s3_uploader.S3Uploader for the bucket the file was synced to
+        relative_path: "/"-separated path of the file relative to the experiment directory
+        local_file_path: full path of the local file
+        key_name: the file's key on s3
+        verify: Optional. Check the copy on s3 as well as the manifest
+    Returns:
+        True if the file is synced (and confirmed, if `verify`); False if it needs uploading (again)
+    Raises:
+        FileNotFoundError: if the local file doesn't exist
+        anything uploader.is_uploaded() raises, e.g. if s3 can't be reached
+    """
+    if not manifest.is_synced(relative_path, os.stat(local_file_path)):
+        return False
+
+    if verify and not uploader.is_uploaded(local_file_path, key_name):
+        logging.warning(f"{key_name} on s3 doesn't match {local_file_path}")
+        return False
+
+    return True
@@ -0,0 +1,117 @@
+import hashlib
+import os
+
+import pytest
+
+from . import sync_manifest as module
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    image_path = tmp_path / "image.jpeg"
+    image_path.write_bytes(b"image data")
+    return image_path
+
+
+class TestComputeMd5Hex:
+    def test_matches_hashlib(self, image_path):
+        expected = hashlib.md5(b"image data").hexdigest()
+        assert module.compute_md5_hex(str(image_path)) == expected
+
+
+class TestSyncManifest:
+    def test_new_manifest_is_new_and_empty(self, tmp_path):
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            assert manifest.is_new
+            assert manifest.get_entry("image.jpeg") is None
+
+    def test_persists_between_instances(self, tmp_path, image_path):
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            manifest.record_uploaded("image.jpeg", str(image_path))
+
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            assert not manifest.is_new
+            assert manifest.get_entry("image.jpeg") == {
+                "size": 10,
+                "mtime_ns": os.stat(image_path).st_mtime_ns,
+                "md5": hashlib.md5(b"image data").hexdigest(),
+                "status": module.UPLOADED,
+            }
+
+    def test_is_synced_until_file_changes(self, tmp_path, image_path):
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            manifest.record_uploaded("image.jpeg", str(image_path))
+            assert manifest.is_synced("image.jpeg", os.stat(image_path))
+
+            image_path.write_bytes(b"different image data")
+            assert not manifest.is_synced("image.jpeg", os.stat(image_path))
+
+    def test_unknown_file_is_not_synced(self, tmp_path, image_path):
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            assert not manifest.is_synced("image.jpeg", os.stat(image_path))
+
+    def test_uploaded_paths_oldest_first(self, tmp_path, image_path):
+        older_image_path = tmp_path / "older.jpeg"
+        older_image_path.write_bytes(b"older image data")
+        image_stat = os.stat(image_path)
+        os.utime(
+            older_image_path,
+            ns=(image_stat.st_atime_ns, image_stat.st_mtime_ns - 1000000000),
+        )
+
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            manifest.record_uploaded("image.jpeg", str(image_path))
+            manifest.record_uploaded("older.jpeg", str(older_image_path))
+
+            assert manifest.get_uploaded_paths() == ["older.jpeg", "image.jpeg"]
+
+
+class TestIsConfirmedSynced:
+    @pytest.mark.parametrize(
+        "name, recorded, verify, is_uploaded, expected",
+        [
+            ("not in manifest", False, True, True, False),
+            ("manifest only", True, False, False, True),
+            ("confirmed on s3", True, True, True, True),
+            ("doesn't match s3", True, True, False, False),
+        ],
+    )
+    def test_is_confirmed_synced(
+        self,
+        mocker,
+        tmp_path,
+        image_path,
+        name,
+        recorded,
+        verify,
+        is_uploaded,
+        expected,
+    ):
+        mock_uploader = mocker.Mock()
+        mock_uploader.is_uploaded.return_value = is_uploaded
+
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            if recorded:
+                manifest.record_uploaded("image.jpeg", str(image_path))
+
+            actual = module.is_confirmed_synced(
+                manifest,
+                mock_uploader,
+                "image.jpeg",
+                str(image_path),
+                "prefix/image.jpeg",
+                verify=verify,
+            )
+
+        assert actual == expected
+
+    def test_missing_file__raises(self, mocker, tmp_path):
+        with module.SyncManifest(str(tmp_path)) as manifest:
+            with pytest.raises(FileNotFoundError):
+                module.is_confirmed_synced(
+                    manifest,
+                    mocker.Mock(),
+                    "image.jpeg",
+                    str(tmp_path / "image.jpeg"),
+                    "prefix/image.jpeg",
+                )
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+# How often paused uploads check whether the capture has finished
+PAUSE_POLL_INTERVAL = 0.05
+# Never pause an upload for longer than this, in case whatever is capturing dies without saying it's finished
+MAX_PAUSE = 30
+
+
+class UploadGovernor:
+    """ Paces uploads so that they don't compete with image capture for CPU, SD card and bus bandwidth on the Pi.
+
+    Uploads are paused while a capture is in progress and resume at full speed (or up to an optional bandwidth limit)
+    between captures. S3Uploader calls throttle() for every chunk it reads from a file, from any of its threads.
+
+    Captures usually happen in a different process from uploads, so capture progress is signalled with a
+    multiprocessing.Event that the capturing process sets for the duration of each capture.
+    """
+
+    def __init__(self, bandwidth_limit=None, capture_in_progress=None):
+        """
+        Args:
+            bandwidth_limit: Optional. Maximum upload rate, in bytes per second, shared between all upload threads
+            capture_in_progress: Optional. multiprocessing.Event (or threading.Event) that is set while a capture is
+                in progress. Uploads pause while it is set
+        """
+        self.bandwidth_limit = bandwidth_limit
+        self.capture_in_progress = capture_in_progress
+
+        self._lock = threading.Lock()
+        self._next_send_time = 0
+        self._start_time = time.monotonic()
+        self.byte_count = 0
+        self.paused_seconds = 0
+        self.pause_count = 0
+
+    def _wait_for_capture(self):
+        if self.capture_in_progress is None or not self.capture_in_progress.is_set():
+            return
+
+        pause_start = time.monotonic()
+        while (
+            self.capture_in_progress.is_set()
+            and time.monotonic() - pause_start < MAX_PAUSE
+        ):
+            time.sleep(PAUSE_POLL_INTERVAL)
+
+        with self._lock:
+            self.paused_seconds += time.monotonic() - pause_start
+            self.pause_count += 1
+
+    def throttle(self, byte_count):
+        """ Block until `byte_count` bytes can be sent: after any capture in progress has finished, and for long
+        enough to stay under the bandwidth limit
+        """
+        self._wait_for_capture()
+
+        with self._lock:
+            self.byte_count += byte_count
+            if not self.bandwidth_limit:
+                return
+            # Each chunk reserves the next slot of time on the "wire"; sleep until the slot starts
+            now = time.monotonic()
+            send_time = max(self._next_send_time, now)
+            self._next_send_time = send_time + byte_count / self.bandwidth_limit
+
+        if send_time > now:
+            time.sleep(send_time - now)
+
+    def log_summary(self):
+        elapsed_seconds = time.monotonic() - self._start_time
+        throughput = self.byte_count / elapsed_seconds if elapsed_seconds else 0
+        logging.info(
+            f"Uploaded {self.byte_count} bytes in {elapsed_seconds:.1f}s ({throughput / 1000:.1f} kB/s); "
+            f"paused {self.pause_count} times for captures, {self.paused_seconds:.1f}s in total"
+        )
+
+
+class GovernedFile:
+    """ Wraps a file opened for reading so that every read is paced by an UploadGovernor. Everything else (seek,
+    tell, name...) is passed straight through to the wrapped file.
+    """
+
+    def __init__(self, file_, governor):
+        self._file = file_
+        self._governor = governor
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._governor.throttle(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
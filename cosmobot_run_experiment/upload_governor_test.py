@@ -0,0 +1,88 @@
+import io
+import threading
+
+import pytest
+
+from . import upload_governor as module
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(mocker):
+    fake_time = FakeTime()
+    mocker.patch.object(module, "time", fake_time)
+    return fake_time
+
+
+class TestUploadGovernor:
+    def test_no_limit__never_sleeps(self, fake_time):
+        governor = module.UploadGovernor()
+
+        governor.throttle(10 ** 9)
+
+        assert fake_time.sleeps == []
+        assert governor.byte_count == 10 ** 9
+
+    def test_bandwidth_limit__paces_chunks(self, fake_time):
+        governor = module.UploadGovernor(bandwidth_limit=1000)
+
+        for _ in range(3):
+            governor.throttle(500)
+
+        # The first chunk goes straight away, then each waits for the previous one's share of the bandwidth
+        assert fake_time.sleeps == [0.5, 0.5]
+
+    def test_capture_in_progress__pauses_until_finished(self, fake_time):
+        capture_in_progress = threading.Event()
+        capture_in_progress.set()
+
+        def finish_capture(seconds):
+            fake_time.now += seconds
+            if fake_time.now >= 1:
+                capture_in_progress.clear()
+
+        fake_time.sleep = finish_capture
+        governor = module.UploadGovernor(capture_in_progress=capture_in_progress)
+
+        governor.throttle(100)
+
+        assert governor.pause_count == 1
+        assert governor.paused_seconds == pytest.approx(
+            1, abs=module.PAUSE_POLL_INTERVAL
+        )
+
+    def test_capture_never_finishes__gives_up_after_max_pause(self, fake_time):
+        capture_in_progress = threading.Event()
+        capture_in_progress.set()
+        governor = module.UploadGovernor(capture_in_progress=capture_in_progress)
+
+        governor.throttle(100)
+
+        assert fake_time.now == pytest.approx(
+            module.MAX_PAUSE, abs=module.PAUSE_POLL_INTERVAL
+        )
+
+
+class TestGovernedFile:
+    def test_reads_through_governor(self, mocker):
+        governor = mocker.Mock()
+        governed_file = module.GovernedFile(io.BytesIO(b"abcdef"), governor)
+
+        assert governed_file.read(4) == b"abcd"
+        governed_file.seek(1)
+        assert governed_file.tell() == 1
+        assert governed_file.read() == b"bcdef"
+
+        assert governor.throttle.call_args_list == [mocker.call(4), mocker.call(5)]
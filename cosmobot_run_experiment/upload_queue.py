@@ -0,0 +1,298 @@
+import logging
+import os
+import random
+import threading
+import time
+from functools import partial
+
+from .file_structure import unshard_relative_path
+from .sqlite_database import SqliteDatabase
+from .staging import find_tiered_file
+from .sync_manifest import SYNC_MANIFEST_FILENAME, SyncManifest, is_confirmed_synced
+
+# Retry delays grow exponentially from the base delay up to the max, with "full jitter" (a random delay between zero
+# and the exponential delay) so that many failed uploads don't all retry at the same moment
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 300
+
+# How long to wait before checking the queue again when nothing is due
+IDLE_POLL_INTERVAL = 0.5
+
+
+def get_retry_delay(attempts):
+    """ Seconds to wait before the next attempt at an upload that has failed `attempts` times """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts))
+
+
+class UploadQueue(SqliteDatabase):
+    """ A durable, ordered queue of files in an experiment directory waiting to be uploaded to s3.
+
+    Stored as a table in the directory's sync manifest database, so it survives the process (or the Pi) going down
+    and can be picked up again by the next run. Failed uploads stay in the queue with a retry time set by exponential
+    backoff with jitter.
+
+    Safe to share between threads. Use as a context manager to close the database when done.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS upload_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL UNIQUE,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0
+        )
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        super().__init__(os.path.join(directory, SYNC_MANIFEST_FILENAME))
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM upload_queue"
+            ).fetchone()
+        return count
+
+    def add(self, relative_path):
+        """ Queue a file for upload. No-op if it's already queued (it keeps its place in line). """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO upload_queue (path) VALUES (?)", (relative_path,)
+            )
+
+    def get_due(self, limit, exclude_paths=()):
+        """ Get the oldest queued files that are due for an upload attempt, in the order they were queued
+
+        Args:
+            limit: maximum number of paths to return
+            exclude_paths: paths not to return, e.g. because they're already being uploaded
+        Returns:
+            list of relative paths
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path FROM upload_queue WHERE next_attempt_at <= ? ORDER BY id",
+                (time.time(),),
+            )
+            due_paths = []
+            for (path,) in rows:
+                if path in exclude_paths:
+                    continue
+                due_paths.append(path)
+                if len(due_paths) >= limit:
+                    break
+        return due_paths
+
+    def seconds_until_next_due(self):
+        """ Seconds until the next queued file is due (0 if one is due now), or None if the queue is empty """
+        with self._lock:
+            (next_attempt_at,) = self._connection.execute(
+                "SELECT MIN(next_attempt_at) FROM upload_queue"
+            ).fetchone()
+        return (
+            None if next_attempt_at is None else max(0, next_attempt_at - time.time())
+        )
+
+    def remove(self, relative_path):
+        """ Remove a file from the queue, e.g. once it has been uploaded """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM upload_queue WHERE path = ?", (relative_path,)
+            )
+
+    def record_failure(self, relative_path):
+        """ Record a failed upload attempt and push the file's next attempt back
+
+        Returns:
+            seconds until the next attempt
+        """
+        with self._lock, self._connection:
+            (attempts,) = self._connection.execute(
+                "SELECT attempts FROM upload_queue WHERE path = ?", (relative_path,)
+            ).fetchone()
+            retry_delay = get_retry_delay(attempts)
+            self._connection.execute(
+                "UPDATE upload_queue SET attempts = ?, next_attempt_at = ? WHERE path = ?",
+                (attempts + 1, time.time() + retry_delay, relative_path),
+            )
+        return retry_delay
+
+
+def drain_upload_queue(
+    upload_queue,
+    manifest,
+    uploader,
+    key_prefix,
+    stop_event=None,
+    erase_uploaded_files=False,
+    staging_directory=None,
+):
+    """ Upload queued files in order, retrying failures with backoff, recording successes in the manifest.
+
+    Files that the manifest shows have already been uploaded (e.g. by a sync after they were queued) are dropped from
+    the queue without uploading them again. When erasing uploaded files, they are only erased once checked against the
+    object on s3, and uploaded again if they don't match it.
+
+    Args:
+        upload_queue: UploadQueue to drain
+        manifest: SyncManifest for the same directory
+        uploader: S3Uploader to upload with
+        key_prefix: prefix to put before each queued relative path (without any shard directories, see
+            file_structure.unshard_relative_path()) to get its key, e.g. "experiment_name/"
+        stop_event: Optional threading.Event or multiprocessing.Event. If provided, keep waiting for more files to be
+            queued until it is set, then return once nothing more is due. If not provided, return once the queue is
+            empty.
+        erase_uploaded_files: If True, verify each upload against the object on s3 (by size and checksum) and erase
+            the local file once it has been verified
+        staging_directory: Optional. Directory that queued files may still be in, before being moved to the upload
+            queue's directory (see staging.py). Files are uploaded from whichever directory they are in
+    Returns:
+        None
+    """
+    directories = [upload_queue.directory]
+    if staging_directory is not None:
+        directories.insert(0, staging_directory)
+
+    in_flight_paths = set()
+    in_flight_lock = threading.Lock()
+    upload_finished = threading.Event()
+
+    def record_uploaded(relative_path):
+        try:
+            manifest.record_uploaded(
+                relative_path, find_tiered_file(relative_path, directories)
+            )
+        except FileNotFoundError:
+            # Moved out of the staging directory between finding and reading it: the mover only ever moves files
+            # to the upload queue's directory
+            manifest.record_uploaded(
+                relative_path, os.path.join(upload_queue.directory, relative_path)
+            )
+
+    def erase(relative_path):
+        try:
+            os.remove(find_tiered_file(relative_path, directories))
+        except FileNotFoundError:
+            # Moved out of the staging directory between finding and erasing it
+            try:
+                os.remove(os.path.join(upload_queue.directory, relative_path))
+            except FileNotFoundError:
+                pass
+
+    def finish_upload(relative_path, upload):
+        try:
+            if upload.exception() is not None:
+                retry_delay = upload_queue.record_failure(relative_path)
+                logging.warning(
+                    f"Failed to upload {relative_path} ({upload.exception()}); retrying in {retry_delay:.1f}s"
+                )
+                return
+
+            record_uploaded(relative_path)
+            upload_queue.remove(relative_path)
+            if erase_uploaded_files:
+                erase(relative_path)
+        except Exception as e:
+            # Keep the file queued so that it's handled (checked against the manifest, erased or uploaded again) on
+            # a later attempt rather than forgotten
+            upload_queue.add(relative_path)
+            retry_delay = upload_queue.record_failure(relative_path)
+            logging.warning(
+                f"Failed to finish uploading {relative_path} ({e}); retrying in {retry_delay:.1f}s"
+            )
+        finally:
+            # However the upload went, it's no longer in flight: otherwise draining would wait on it forever
+            with in_flight_lock:
+                in_flight_paths.remove(relative_path)
+            upload_finished.set()
+
+    while True:
+        # Keep a couple of uploads queued per upload worker so the pool never sits idle, counting those already in
+        # flight so that a large backlog doesn't pile up in the uploader
+        with in_flight_lock:
+            excluded_paths = set(in_flight_paths)
+            capacity = uploader.max_workers * 2 - len(in_flight_paths)
+        due_paths = (
+            upload_queue.get_due(limit=capacity, exclude_paths=excluded_paths)
+            if capacity > 0
+            else []
+        )
+        for relative_path in due_paths:
+            local_file_path = find_tiered_file(relative_path, directories)
+            key_name = f"{key_prefix}{unshard_relative_path(relative_path)}"
+            try:
+                is_synced = is_confirmed_synced(
+                    manifest,
+                    uploader,
+                    relative_path,
+                    local_file_path,
+                    key_name,
+                    verify=erase_uploaded_files,
+                )
+            except FileNotFoundError:
+                logging.warning(f"Queued file {local_file_path} no longer exists")
+                upload_queue.remove(relative_path)
+                continue
+
+            if is_synced:
+                upload_queue.remove(relative_path)
+                if erase_uploaded_files:
+                    os.remove(local_file_path)
+                continue
+
+            with in_flight_lock:
+                in_flight_paths.add(relative_path)
+            upload = uploader.submit(
+                local_file_path, key_name, verify=erase_uploaded_files
+            )
+            upload.add_done_callback(partial(finish_upload, relative_path))
+
+        with in_flight_lock:
+            uploads_in_flight = bool(in_flight_paths)
+        seconds_until_next_due = upload_queue.seconds_until_next_due()
+
+        if not uploads_in_flight:
+            # Once asked to stop, failed uploads waiting on a retry are left queued for next time
+            if stop_event is not None and stop_event.is_set():
+                return
+            if stop_event is None and seconds_until_next_due is None:
+                return
+
+        # Wake up as soon as an upload finishes, or when the next retry is due
+        upload_finished.wait(
+            IDLE_POLL_INTERVAL
+            if uploads_in_flight or seconds_until_next_due is None
+            else min(seconds_until_next_due, IDLE_POLL_INTERVAL)
+        )
+        upload_finished.clear()
+
+
+def find_directories_with_queued_uploads(base_directory):
+    """ Find experiment directories under base_directory whose upload queue isn't empty
+
+    Returns:
+        sorted list of full paths of experiment directories
+    """
+    if not os.path.isdir(base_directory):
+        return []
+
+    directories = []
+    for directory_name in sorted(os.listdir(base_directory)):
+        directory = os.path.join(base_directory, directory_name)
+        if not os.path.exists(os.path.join(directory, SYNC_MANIFEST_FILENAME)):
+            continue
+        with UploadQueue(directory) as upload_queue:
+            if len(upload_queue):
+                directories.append(directory)
+    return directories
+
+
+def drain_directory_upload_queue(directory, uploader, stop_event=None):
+    """ Open the manifest and upload queue for an experiment directory and drain the queue with drain_upload_queue()
+    """
+    experiment_dir_name = os.path.basename(os.path.normpath(directory))
+    with SyncManifest(directory) as manifest, UploadQueue(directory) as upload_queue:
+        drain_upload_queue(
+            upload_queue, manifest, uploader, f"{experiment_dir_name}/", stop_event
+        )
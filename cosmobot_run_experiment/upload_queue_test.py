@@ -0,0 +1,344 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from . import upload_queue as module
+from .sync_manifest import SyncManifest
+
+
+class FakeUploader:
+    """ Stands in for S3Uploader, completing (or failing) each upload immediately """
+
+    max_workers = 2
+
+    def __init__(self, failing_paths=(), mismatched_paths=()):
+        self.failing_paths = set(failing_paths)
+        self.mismatched_paths = set(mismatched_paths)
+        self.uploaded = []
+
+    def is_uploaded(self, local_file_path, key_name):
+        return local_file_path not in self.mismatched_paths
+
+    def submit(self, local_file_path, key_name, verify=False):
+        upload = Future()
+        if local_file_path in self.failing_paths:
+            upload.set_exception(Exception("no network"))
+        else:
+            self.uploaded.append(key_name)
+            upload.set_result(None)
+        return upload
+
+
+class SlowUploader:
+    """ Stands in for S3Uploader, completing uploads one at a time on a background thread, and keeping track of how
+    many were pending at most
+    """
+
+    max_workers = 2
+    upload_seconds = 0.01
+
+    def __init__(self):
+        self.uploaded = []
+        self.max_pending_count = 0
+        self._pending_uploads = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._complete_uploads)
+        self._thread.start()
+
+    def submit(self, local_file_path, key_name, verify=False):
+        upload = Future()
+        with self._lock:
+            self._pending_uploads.append((key_name, upload))
+            self.max_pending_count = max(
+                self.max_pending_count, len(self._pending_uploads)
+            )
+        return upload
+
+    def _complete_uploads(self):
+        while not self._stopped.is_set():
+            time.sleep(self.upload_seconds)
+            with self._lock:
+                if not self._pending_uploads:
+                    continue
+                key_name, upload = self._pending_uploads.pop(0)
+            self.uploaded.append(key_name)
+            upload.set_result(None)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+@pytest.fixture
+def upload_queue(tmp_path):
+    with module.UploadQueue(str(tmp_path)) as upload_queue:
+        yield upload_queue
+
+
+class TestGetRetryDelay:
+    @pytest.mark.parametrize("attempts", [0, 1, 5, 100])
+    def test_within_exponential_bound(self, attempts):
+        bound = min(module.RETRY_MAX_DELAY, module.RETRY_BASE_DELAY * 2 ** attempts)
+        assert 0 <= module.get_retry_delay(attempts) <= bound
+
+
+class TestUploadQueue:
+    def test_get_due__in_queued_order(self, upload_queue):
+        for path in ["b.jpeg", "a.jpeg", "b.jpeg", "c.jpeg"]:
+            upload_queue.add(path)
+
+        assert len(upload_queue) == 3
+        assert upload_queue.get_due(limit=2) == ["b.jpeg", "a.jpeg"]
+        assert upload_queue.get_due(limit=5, exclude_paths={"a.jpeg"}) == [
+            "b.jpeg",
+            "c.jpeg",
+        ]
+
+    def test_record_failure__backs_off(self, mocker, upload_queue):
+        mocker.patch.object(module, "get_retry_delay", return_value=60)
+        upload_queue.add("a.jpeg")
+
+        assert upload_queue.record_failure("a.jpeg") == 60
+
+        assert upload_queue.get_due(limit=5) == []
+        assert 59 < upload_queue.seconds_until_next_due() <= 60
+
+    def test_remove(self, upload_queue):
+        upload_queue.add("a.jpeg")
+        upload_queue.remove("a.jpeg")
+
+        assert len(upload_queue) == 0
+        assert upload_queue.seconds_until_next_due() is None
+
+    def test_persists_across_instances(self, tmp_path):
+        with module.UploadQueue(str(tmp_path)) as upload_queue:
+            upload_queue.add("a.jpeg")
+
+        with module.UploadQueue(str(tmp_path)) as upload_queue:
+            assert upload_queue.get_due(limit=5) == ["a.jpeg"]
+
+
+class TestDrainUploadQueue:
+    def test_uploads_and_records_queued_files(self, tmp_path):
+        for filename in ["a.jpeg", "b.jpeg", "c.jpeg"]:
+            (tmp_path / filename).write_text(filename)
+        uploader = FakeUploader()
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            for filename in ["a.jpeg", "b.jpeg", "c.jpeg", "deleted.jpeg"]:
+                upload_queue.add(filename)
+
+            module.drain_upload_queue(upload_queue, manifest, uploader, "prefix/")
+
+            assert len(upload_queue) == 0
+            assert manifest.get_entry("b.jpeg")["status"] == "uploaded"
+
+        assert sorted(uploader.uploaded) == [
+            "prefix/a.jpeg",
+            "prefix/b.jpeg",
+            "prefix/c.jpeg",
+        ]
+
+    def test_limits_pending_uploads_with_slow_uploader(self, tmp_path):
+        filenames = [f"{index}.jpeg" for index in range(20)]
+        for filename in filenames:
+            (tmp_path / filename).write_text(filename)
+        uploader = SlowUploader()
+
+        try:
+            with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+                str(tmp_path)
+            ) as upload_queue:
+                for filename in filenames:
+                    upload_queue.add(filename)
+
+                module.drain_upload_queue(upload_queue, manifest, uploader, "prefix/")
+        finally:
+            uploader.stop()
+
+        assert len(uploader.uploaded) == len(filenames)
+        assert uploader.max_pending_count <= 2 * uploader.max_workers
+
+    def test_erase_uploaded_files(self, tmp_path):
+        (tmp_path / "a.jpeg").write_text("a")
+        (tmp_path / "b.jpeg").write_text("b")
+        uploader = FakeUploader(failing_paths=[str(tmp_path / "b.jpeg")])
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            upload_queue.add("a.jpeg")
+            upload_queue.add("b.jpeg")
+
+            stop_event = threading.Event()
+            stop_event.set()
+            module.drain_upload_queue(
+                upload_queue,
+                manifest,
+                uploader,
+                "prefix/",
+                stop_event,
+                erase_uploaded_files=True,
+            )
+
+        assert not (tmp_path / "a.jpeg").exists()
+        assert (tmp_path / "b.jpeg").exists()
+
+    def test_skips_files_already_synced(self, tmp_path):
+        (tmp_path / "a.jpeg").write_text("a")
+        uploader = FakeUploader()
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            manifest.record_uploaded("a.jpeg", str(tmp_path / "a.jpeg"))
+            upload_queue.add("a.jpeg")
+
+            module.drain_upload_queue(upload_queue, manifest, uploader, "prefix/")
+
+            assert len(upload_queue) == 0
+        assert uploader.uploaded == []
+
+    @pytest.mark.parametrize(
+        "name,matches_s3,expected_uploaded",
+        [("matches s3", True, []), ("doesn't match s3", False, ["prefix/a.jpeg"])],
+    )
+    def test_erase_uploaded_files__erases_files_already_synced(
+        self, tmp_path, name, matches_s3, expected_uploaded
+    ):
+        (tmp_path / "a.jpeg").write_text("a")
+        uploader = FakeUploader(
+            mismatched_paths=[] if matches_s3 else [str(tmp_path / "a.jpeg")]
+        )
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            manifest.record_uploaded("a.jpeg", str(tmp_path / "a.jpeg"))
+            upload_queue.add("a.jpeg")
+
+            module.drain_upload_queue(
+                upload_queue, manifest, uploader, "prefix/", erase_uploaded_files=True
+            )
+
+            assert len(upload_queue) == 0
+        assert uploader.uploaded == expected_uploaded
+        assert not (tmp_path / "a.jpeg").exists()
+
+    def test_stop_event_set__leaves_failures_queued(self, mocker, tmp_path):
+        mocker.patch.object(module, "get_retry_delay", return_value=60)
+        (tmp_path / "a.jpeg").write_text("a")
+        (tmp_path / "b.jpeg").write_text("b")
+        uploader = FakeUploader(failing_paths=[str(tmp_path / "a.jpeg")])
+        stop_event = mocker.Mock()
+        stop_event.is_set.return_value = True
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            upload_queue.add("a.jpeg")
+            upload_queue.add("b.jpeg")
+
+            module.drain_upload_queue(
+                upload_queue, manifest, uploader, "prefix/", stop_event
+            )
+
+            assert upload_queue.get_due(limit=5) == []
+            assert len(upload_queue) == 1
+        assert uploader.uploaded == ["prefix/b.jpeg"]
+
+    def test_file_erased_during_upload__requeued_then_dropped(self, mocker, tmp_path):
+        mocker.patch.object(module, "get_retry_delay", return_value=0)
+        (tmp_path / "a.jpeg").write_text("a")
+        uploader = FakeUploader()
+        submit = uploader.submit
+
+        def submit_and_erase(local_file_path, key_name, verify=False):
+            upload = submit(local_file_path, key_name, verify)
+            os.remove(local_file_path)
+            return upload
+
+        uploader.submit = submit_and_erase
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            upload_queue.add("a.jpeg")
+
+            # Returns rather than waiting forever on an upload it never finished
+            module.drain_upload_queue(upload_queue, manifest, uploader, "prefix/")
+
+            assert len(upload_queue) == 0
+            assert manifest.get_entry("a.jpeg") is None
+
+    def test_erase_uploaded_files__file_already_gone(self, mocker, tmp_path):
+        (tmp_path / "a.jpeg").write_text("a")
+        mocker.patch.object(module.os, "remove").side_effect = FileNotFoundError
+
+        with SyncManifest(str(tmp_path)) as manifest, module.UploadQueue(
+            str(tmp_path)
+        ) as upload_queue:
+            upload_queue.add("a.jpeg")
+
+            module.drain_upload_queue(
+                upload_queue,
+                manifest,
+                FakeUploader(),
+                "prefix/",
+                erase_uploaded_files=True,
+            )
+
+            assert len(upload_queue) == 0
+            assert manifest.get_entry("a.jpeg") is not None
+
+    def test_file_moved_out_of_staging_mid_upload__recorded(self, mocker, tmp_path):
+        staging_directory = tmp_path / "staging"
+        staging_directory.mkdir()
+        experiment_directory = tmp_path / "experiment"
+        experiment_directory.mkdir()
+        (experiment_directory / "a.jpeg").write_text("a")
+        # Once the upload is done, found in the staging directory just before the mover moved it
+        mocker.patch.object(module, "find_tiered_file").side_effect = [
+            str(experiment_directory / "a.jpeg"),
+            str(staging_directory / "a.jpeg"),
+        ]
+
+        with SyncManifest(str(experiment_directory)) as manifest, module.UploadQueue(
+            str(experiment_directory)
+        ) as upload_queue:
+            upload_queue.add("a.jpeg")
+
+            module.drain_upload_queue(
+                upload_queue,
+                manifest,
+                FakeUploader(),
+                "prefix/",
+                staging_directory=str(staging_directory),
+            )
+
+            assert len(upload_queue) == 0
+            assert manifest.get_entry("a.jpeg") is not None
+
+
+class TestFindDirectoriesWithQueuedUploads:
+    def test_finds_non_empty_queues(self, tmp_path):
+        for directory_name in ["b_queued", "a_queued", "empty_queue", "no_manifest"]:
+            (tmp_path / directory_name).mkdir()
+        for directory_name in ["b_queued", "a_queued", "empty_queue"]:
+            with module.UploadQueue(str(tmp_path / directory_name)) as upload_queue:
+                if directory_name != "empty_queue":
+                    upload_queue.add("image.jpeg")
+
+        assert module.find_directories_with_queued_uploads(str(tmp_path)) == [
+            str(tmp_path / "a_queued"),
+            str(tmp_path / "b_queued"),
+        ]
+
+    def test_missing_base_directory(self, tmp_path):
+        assert module.find_directories_with_queued_uploads(str(tmp_path / "nope")) == []
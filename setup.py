@@ -16,6 +16,8 @@ setup(
             "review_exposure = cosmobot_run_experiment.exposure:review_exposure",
             "set_led = cosmobot_run_experiment.led_control:set_led_cli",
             "flash_led = cosmobot_run_experiment.led_control:flash_led_cli",
+            "summarize_capture_timing = cosmobot_run_experiment.capture_timing:summarize_capture_timing",
+            "benchmark_raw_bayer = cosmobot_run_experiment.open:benchmark_raw_bayer",
         ]
     },
     install_requires=[
@@ -23,6 +25,7 @@ setup(
         "boto",
         "numpy",
         "picamraw",
+        "Pillow",
         "psutil",
         "pyyaml",
     ],